@@ -27,32 +27,93 @@ import textwrap
 
 from .utils import *
 from .yaml import *
+from .formats import *
+from .batch import *
+from .cache import *
+from .manifest import *
+from .engines import *
+from .sequence import *
+from .watch import *
 
 
 __all__ = [
     "RAW_AUDIO",
     "RAW_VIDEO",
     "OUTPUT_FORMATS",
+    "FORMATS",
+    "FormatRegistry",
+    "TIERS",
+    "get_stream_format",
+    "get_segment_format",
+    "load_formats_file",
     "RemoveHeader",
+    "RecordStream",
     "ConcatenateStreams",
     "ConcatenateShots",
     "Shot",
+    "ShotGroup",
+    "coalesce_shots",
+    "find_repeated_shots",
+    "get_raw_size",
+    "get_loudness",
+    "combine_loudness",
     "Player",
     "Probe",
     "Multiplexer",
+    "parse_output",
+    "get_output_name",
+    "get_output_format",
+    "make_output_dirs",
+    "get_output_height",
     "SubprocessSupervisor",
     "AudioProcessing",
+    "WriteBuffers",
+    "FanOut",
     "YAMLReader",
     "YAML_TEMPLATE",
     "DEFAULT_PATTERN",
+    "SchedulingPolicy",
+    "SCHEDULING",
+    "ThreadBudget",
+    "THREADS",
+    "FilterGraphRender",
+    "ConcatDemuxerRender",
+    "CachedRender",
+    "SmartRender",
+    "ShotCache",
+    "SmartShotCache",
+    "get_video_codec",
+    "get_video_encoder",
+    "get_stream_properties",
+    "get_cache_size",
+    "get_cache_dir",
+    "MusicCache",
+    "DecodedMusic",
+    "IncrementalRender",
+    "RenderManifest",
+    "SegmentedRender",
+    "RenderJournal",
+    "PassLog",
+    "Watcher",
+    "Sequence",
+    "VariantRender",
+    "make_shot",
+    "ENGINES",
+    "BatchJob",
+    "BatchQueue",
+    "BatchScheduler",
+    "DEFAULT_QUEUE",
     ]
 
 
+# The log directory may be moved with the VID_LOGDIR environment variable.
+# vid batch uses it to give each of its concurrent jobs a directory of its own.
+LOGDIR = os.getenv('VID_LOGDIR', "log")
 try:
-    shutil.rmtree("log")
+    shutil.rmtree(LOGDIR)
 except FileNotFoundError:
     pass
-os.mkdir("log")
+os.makedirs(LOGDIR)
 
 
 msg_indent = textwrap.TextWrapper(
@@ -110,7 +171,7 @@ handlers = {
         'class': "logging.FileHandler",
         'level': "DEBUG",
         'formatter': "ff",
-        'filename': "log/main.log".format(os.getpid()),
+        'filename': os.path.join(LOGDIR, "main.log"),
         },
     }
 root = {
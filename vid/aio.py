@@ -0,0 +1,392 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# aio.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+"""asyncio interface to render a movie from a YAML project.
+
+Example usage:
+
+    import asyncio
+    import vid.aio
+
+    asyncio.run(vid.aio.render("movie.yaml", ["movie.webm"]))
+
+Several renders may run concurrently in the same event loop. Cancelling
+the task that awaits render() kills its subprocesses.
+
+Like the other engines, each ffmpeg writes its messages to a file of
+the log directory named after its pid. When a process fails, the end of
+that file is logged and the render raises CalledProcessError.
+"""
+
+
+# Imports                                        {{{1
+import os
+import asyncio
+import logging
+import subprocess
+import collections
+
+from . import utils
+from .utils import (
+    Multiplexer, RAW_AUDIO, SUBPROCESS_LOG, SCHEDULING, THREADS,
+    coalesce_shots,
+    )
+from .formats import FORMATS, load_formats_file
+from .yaml import YAMLReader
+from .sequence import make_shot
+
+
+# Global variables                               {{{1
+BUFSIZE = 64 * 1024
+# The number of lines of the log of a failed process that are logged.
+LOG_LINES = 20
+#}}}
+
+
+async def render(project, outputs, pattern=None, showinfo=False,
+                 progress=None):                 #{{{1
+    """Render project to outputs.
+
+    Arguments:
+    project -- A YAML file name, document or open file, or the data
+               returned by YAMLReader.load().
+    outputs -- A list of output files as accepted by
+               Multiplexer.write_to_files().
+    pattern -- Overrides the pattern of the globals section.
+    showinfo -- Burn file names and timecode information on the video.
+    progress -- A function or coroutine function called with the
+                number of seconds rendered and the length of the movie.
+
+    Returns the length of the movie in seconds.
+    """
+    return await AsyncRender(
+        project, outputs, pattern, showinfo, progress
+        ).run()
+
+
+async def _open_writer(pipe):                    #{{{1
+    """Return a PipeWriter for the writable file object pipe."""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(PipeProtocol, pipe)
+    return PipeWriter(transport, protocol)
+
+
+class PipeProtocol(asyncio.Protocol):            #{{{1
+    """Keep track of the flow control of a write pipe transport."""
+
+    def __init__(self):
+        self.paused = False
+        self.lost = False
+        self.waiters = []
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._wake_up()
+
+    def connection_lost(self, exc):
+        self.lost = True
+        self.paused = False
+        self._wake_up()
+
+    def _wake_up(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = []
+
+
+class PipeWriter():                              #{{{1
+    """Write to a pipe transport, with the interface of a StreamWriter."""
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        """Wait until the pipe is ready for more data."""
+        if self.protocol.paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self.protocol.waiters.append(waiter)
+            await waiter
+        if self.protocol.lost:
+            raise ConnectionResetError("Connection lost")
+
+    def close(self):
+        self.transport.close()
+
+
+async def _copy(reader, writer, remove_header=False, silent=False): #{{{1
+    """Copy reader to writer until EOF.
+
+    If remove_header is true, the first line of input is dropped. If
+    silent is true, every byte is replaced with a zero.
+
+    Returns the number of bytes written.
+    """
+    written = 0
+    if remove_header:
+        await reader.readline()
+    while True:
+        buf = await reader.read(BUFSIZE)
+        if buf == b"":
+            break
+        if silent:
+            buf = b"\x00" * len(buf)
+        writer.write(buf)
+        await writer.drain()
+        written += len(buf)
+    return written
+
+
+class AsyncRender():                             #{{{1
+    """The processes and tasks of one render.
+
+    This is the asyncio counterpart of ConcatenateShots, AudioProcessing
+    and Multiplexer. Bytes are moved between subprocesses by coroutines
+    reading and writing non-blocking pipes instead of threads.
+    """
+
+    def __init__(self, project, outputs, pattern=None, showinfo=False,
+                 progress=None):
+        self.logger = logging.getLogger(__name__+".AsyncRender")
+        self.project = project
+        self.outputs = list(outputs)
+        self.pattern = pattern
+        self.showinfo = showinfo
+        self.progress = progress
+        self.processes = []
+        # The arguments of each process, by pid.
+        self.args = {}
+        self.length = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # Reading YAML and probing files is blocking.
+        data, shots = await loop.run_in_executor(None, self._load)
+        load_formats_file()
+        if 'formats' in data:
+            FORMATS.update(data['formats'])
+        self.length = sum(shot.get_duration() for shot in shots)
+
+        v_r, v_w = os.pipe()
+        a_r, a_w = os.pipe()
+        muxer = Multiplexer(v_r, a_r, shots, data.get('music'))
+        if 'multiplexer' in data:
+            for filter in data['multiplexer'].get('vf', []):
+                muxer.append_vf(filter[0], **filter[1])
+            for filter in data['multiplexer'].get('af', []):
+                muxer.append_af(filter[0], **filter[1])
+        if self.showinfo:
+            muxer.append_vf("showdata", length=self.length)
+        threads = THREADS.acquire("encoder")
+        args = (muxer._args[:1] + ["-nostats", "-progress", "pipe:1"] +
+                muxer._args[1:] +
+                muxer._output_args(*self.outputs, threads=threads.threads))
+        pipes = [open(v_w, "wb", buffering=0), open(a_w, "wb", buffering=0)]
+        writers = []
+        try:
+            for pipe in pipes:
+                writers.append(await _open_writer(pipe))
+            muxer.process = await self._spawn(
+                "encoder", args, pass_fds=(v_r, a_r),
+                )
+        except BaseException:
+            threads.release()
+            for writer in writers:
+                writer.close()
+            for pipe in pipes[len(writers):]:
+                pipe.close()
+            raise
+        finally:
+            os.close(v_r)
+            os.close(a_r)
+
+        tasks = []
+        v_writer, a_writer = writers
+        if 'music' in data:
+            mixer = await self._spawn(
+                "mixer",
+                ["ffmpeg", "-y", "-loglevel", "debug"] + RAW_AUDIO + [
+                    "-i", "pipe:0",
+                    "-i", data['music'],
+                    "-filter_complex", "amix=duration=first",
+                    ] + RAW_AUDIO + ["pipe:1"],
+                stdin=subprocess.PIPE,
+                )
+            tasks.append(self._mix(mixer, a_writer))
+            a_writer = mixer.stdin
+            writers.append(a_writer)
+        v_queue = asyncio.Queue()
+        a_queue = asyncio.Queue()
+        tasks += [
+            self._demux(shots, v_queue, a_queue),
+            self._concatenate(v_queue, v_writer),
+            self._concatenate(a_queue, a_writer),
+            self._report(muxer.process.stdout),
+            ]
+        tasks = [asyncio.ensure_future(task) for task in tasks]
+        try:
+            await asyncio.gather(*tasks)
+            await muxer.process.wait()
+            self._check(muxer.process)
+        except BaseException:
+            # Cancelled or failed: no task nor process must survive the
+            # render.
+            for task in tasks:
+                task.cancel()
+            for process in self.processes:
+                if process.returncode is None:
+                    process.kill()
+            for process in self.processes:
+                await process.wait()
+            raise
+        finally:
+            threads.release()
+            for writer in writers:
+                writer.close()
+        return self.length
+
+    def _load(self):
+        reader = YAMLReader()
+        if isinstance(self.project, dict):
+            reader.data = self.project
+        else:
+            reader.load(self.project)
+        shots = []
+        for args, kwargs in reader.get_shots_arguments(self.pattern):
+            shot = make_shot(args, kwargs)
+            if self.showinfo:
+                shot.append_vf("showdata")
+            shots.append(shot)
+        return reader.data, coalesce_shots(shots)
+
+    async def _spawn(self, role, args, stdin=subprocess.DEVNULL,
+                     pass_fds=()):
+        """Spawn a subprocess with its stdout piped to the event loop."""
+        args = SCHEDULING.wrap_args(role, args)
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            # preexec_fn sends it to the log file of the process.
+            stderr=subprocess.DEVNULL,
+            pass_fds=pass_fds,
+            preexec_fn=SCHEDULING.preexec_fn(role),
+            )
+        self.processes.append(process)
+        self.args[process.pid] = args
+        self.logger.debug(SUBPROCESS_LOG.format(process.pid, args))
+        return process
+
+    async def _demux(self, shots, v_queue, a_queue):
+        """Spawn two processes per shot and queue their outputs.
+
+        As in ConcatenateShots, a semaphore limits the number of shots
+        being demuxed at once.
+        """
+        semaphore = asyncio.Semaphore(2)
+        waiters = []
+        for i, shot in enumerate(shots):
+            await semaphore.acquire()
+            threads = THREADS.acquire("decoder")
+            v_process = await self._spawn(
+                "decoder", shot._video_args("pipe:1", threads.threads),
+                )
+            a_process = await self._spawn(
+                "decoder", shot._audio_args("pipe:1"),
+                )
+            await v_queue.put((v_process.stdout, i > 0, False))
+            await a_queue.put((a_process.stdout, False, shot.silent))
+            waiters.append(asyncio.ensure_future(
+                self._release(semaphore, threads, v_process, a_process)
+                ))
+        await v_queue.put(None)
+        await a_queue.put(None)
+        await asyncio.gather(*waiters)
+
+    def _check(self, process):
+        """Raise CalledProcessError if process failed, logging why.
+
+        The end of the log file of the process is logged as an error.
+        """
+        if process.returncode == 0:
+            return
+        filename = os.path.join(utils.logdir, "p{}.log".format(process.pid))
+        try:
+            with open(filename, errors="replace") as f:
+                tail = "".join(collections.deque(f, LOG_LINES))
+        except FileNotFoundError:
+            tail = ""
+        self.logger.error(
+            "Process {} returned {}. End of {}:\n{}".format(
+                process.pid, process.returncode, filename, tail,
+                )
+            )
+        raise subprocess.CalledProcessError(
+            process.returncode, self.args.get(process.pid),
+            )
+
+    async def _release(self, semaphore, threads, *processes):
+        try:
+            for process in processes:
+                await process.wait()
+                self._check(process)
+        finally:
+            threads.release()
+            semaphore.release()
+
+    async def _concatenate(self, q, writer):
+        while True:
+            item = await q.get()
+            if item is None:
+                break
+            reader, remove_header, silent = item
+            await _copy(reader, writer, remove_header, silent)
+        writer.close()
+
+    async def _mix(self, mixer, writer):
+        await _copy(mixer.stdout, writer)
+        writer.close()
+        await mixer.wait()
+        self._check(mixer)
+
+    async def _report(self, reader):
+        """Parse ffmpeg's -progress output and call the progress callback."""
+        while True:
+            line = await reader.readline()
+            if line == b"":
+                break
+            key, _, value = line.decode().strip().partition("=")
+            # out_time_ms is in microseconds, for historical reasons.
+            if key != "out_time_ms":
+                continue
+            if self.progress is None or not value.isdigit():
+                continue
+            rv = self.progress(int(value) / 1000000, self.length)
+            if asyncio.iscoroutine(rv):
+                await rv
@@ -0,0 +1,305 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# batch.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+# Imports                                        {{{1
+import os
+import json
+import time
+import os.path
+import logging
+import threading
+import subprocess
+
+from . import utils
+
+
+# Global variables                               {{{1
+DEFAULT_QUEUE = ".vid_batch.json"
+# A running "vid yaml" job keeps about this many processes alive: two
+# shots being demuxed (two ffmpeg each), the music mixer and the
+# multiplexer.
+JOB_PROCESSES = 6
+#}}}
+
+
+class BatchJob():                                #{{{1
+    """One project to render to one or more output files.
+
+    The project is a YAML file name. Outputs are file names relative to
+    the directory of the project, which is also the working directory of
+    the job, so that patterns and music file names in the YAML file
+    resolve the same way as with "vid yaml".
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, project, outputs, status=PENDING, elapsed=None,
+                 returncode=None, error=None):
+        self.project = os.path.abspath(project)
+        self.outputs = list(outputs)
+        self.status = status
+        self.elapsed = elapsed
+        self.returncode = returncode
+        # Why the job could not be started, if it failed to.
+        self.error = error
+        self.process = None
+        self.start_time = None
+
+    def __repr__(self):
+        return "<BatchJob({}), {}>".format(self.project, self.status)
+
+    @property
+    def key(self):
+        """Identify the job in the queue file."""
+        return "{} -> {}".format(self.project, ", ".join(self.outputs))
+
+    @property
+    def workdir(self):
+        return os.path.dirname(self.project)
+
+    def get_output_paths(self):
+        """Return the set of absolute output file names."""
+        return {os.path.join(self.workdir, o) for o in self.outputs}
+
+    def get_cpus(self):
+        """Estimate how many cores the job keeps busy.
+
+        Decoding and mixing take about one core, then each output adds
+        one encoder.
+        """
+        return 1 + len(self.outputs)
+
+    def get_processes(self):
+        return JOB_PROCESSES
+
+    def to_dict(self):
+        return {
+            'project': self.project,
+            'outputs': self.outputs,
+            'status': self.status,
+            'elapsed': self.elapsed,
+            'returncode': self.returncode,
+            'error': self.error,
+            }
+
+
+class BatchQueue():                              #{{{1
+    """A list of BatchJob objects persisted to a JSON file.
+
+    The file is rewritten every time the status of a job changes, so a
+    batch that is interrupted may be restarted and will skip the jobs
+    that were finished.
+    """
+
+    def __init__(self, filename=DEFAULT_QUEUE):
+        self.logger = logging.getLogger(__name__+".BatchQueue")
+        self.filename = filename
+        self.jobs = []
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            self._load()
+
+    def _load(self):
+        with open(self.filename) as f:
+            data = json.load(f)
+        for d in data['jobs']:
+            job = BatchJob(**d)
+            if job.status == BatchJob.RUNNING:
+                # The previous batch died while this job was running.
+                job.status = BatchJob.PENDING
+            self.jobs.append(job)
+        self.logger.debug(
+            "Loaded {} jobs from {}.".format(len(self.jobs), self.filename)
+            )
+
+    def save(self):
+        """Atomically write the queue file."""
+        with self.lock:
+            data = {'jobs': [job.to_dict() for job in self.jobs]}
+            tmp = self.filename + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp, self.filename)
+
+    def add(self, project, outputs):
+        """Add a job unless the same job is already queued.
+
+        Returns the BatchJob found or created.
+        """
+        job = BatchJob(project, outputs)
+        for queued in self.jobs:
+            if queued.key == job.key:
+                return queued
+        self.jobs.append(job)
+        self.save()
+        return job
+
+    def get_pending(self):
+        """Return jobs that are not finished, failed jobs included."""
+        return [job for job in self.jobs if job.status != BatchJob.DONE]
+
+    def mark(self, job, status):
+        job.status = status
+        self.save()
+
+
+class BatchScheduler(threading.Thread):          #{{{1
+    """Threading subclass that runs the jobs of a BatchQueue.
+
+    Each job is a "vid yaml" subprocess. Jobs run at the same time as
+    long as the sum of their estimated cores stays under the cpus
+    budget and the sum of their processes stays under the processes
+    budget. Two jobs that write the same file never run together. A job
+    too big for the budget still runs, alone. A job that cannot be
+    started is marked as failed, with the error, and the others go on.
+
+    Keyword arguments:
+    cpus -- The number of cores the batch may use, at least 1. Defaults
+        to all.
+    processes -- The number of processes the batch may spawn, at least
+        1.
+    command -- The vid command, as a list. Defaults to ["vid"].
+    callback -- Called with each BatchJob when it finishes.
+    """
+
+    def __init__(self, batch_queue, cpus=None, processes=None,
+                 command=None, callback=None):
+        self.logger = logging.getLogger(__name__+".BatchScheduler")
+        assert isinstance(batch_queue, BatchQueue)
+        self.queue = batch_queue
+        for name, value in (("cpus", cpus), ("processes", processes)):
+            if value is not None and value < 1:
+                raise ValueError(
+                    "The number of {} must be at least 1.".format(name)
+                    )
+        self.cpus = cpus or os.cpu_count() or 1
+        self.processes = processes or self.cpus * JOB_PROCESSES
+        self.command = command or ["vid"]
+        self.callback = callback
+        self.running = []
+        self.condition = threading.Condition()
+        self.exception = None
+        self.finished = threading.Event()
+
+        super(BatchScheduler, self).__init__(daemon=True)
+
+    def run(self):
+        self.logger.debug("Thread starting: running batch.")
+        try:
+            pending = self.queue.get_pending()
+            with self.condition:
+                while pending or self.running:
+                    for job in pending[:]:
+                        if self._can_start(job):
+                            pending.remove(job)
+                            self._start(job)
+                    if self.running:
+                        self.condition.wait()
+            self.finished.set()
+        except Exception as err:
+            self.logger.error("Error occured: {}.".format(err))
+            self.exception = err
+            raise
+
+    def _can_start(self, job):
+        if not self.running:
+            return True
+        cpus = sum(j.get_cpus() for j in self.running)
+        processes = sum(j.get_processes() for j in self.running)
+        if cpus + job.get_cpus() > self.cpus:
+            return False
+        if processes + job.get_processes() > self.processes:
+            return False
+        for j in self.running:
+            if j.get_output_paths() & job.get_output_paths():
+                return False
+        return True
+
+    def _start(self, job):
+        args = self.command + ["yaml", job.project]
+        for output in job.outputs:
+            args += ["-o", output]
+        n = self.queue.jobs.index(job)
+        env = os.environ.copy()
+        # Each job gets its own log directory.
+        env['VID_LOGDIR'] = os.path.join(utils.logdir, "batch{}".format(n))
+        job.start_time = time.perf_counter()
+        job.error = None
+        try:
+            with open(os.path.join(
+                    utils.logdir, "batch{}.log".format(n)), "w") as log:
+                job.process = subprocess.Popen(
+                    args,
+                    cwd=job.workdir,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    )
+        except OSError as err:
+            self.logger.error("Can't start {}: {}.".format(job.key, err))
+            job.elapsed = time.perf_counter() - job.start_time
+            job.returncode = None
+            job.error = str(err)
+            self.queue.mark(job, BatchJob.FAILED)
+            if self.callback is not None:
+                self.callback(job)
+            return
+        self.logger.debug(utils.SUBPROCESS_LOG.format(job.process.pid, args))
+        self.running.append(job)
+        self.queue.mark(job, BatchJob.RUNNING)
+        utils.SubprocessSupervisor(
+            (job.process.wait,),
+            lambda: self._finish(job),
+            name="Rendering {}.".format(job.project),
+            ).start()
+
+    def _finish(self, job):
+        with self.condition:
+            job.elapsed = time.perf_counter() - job.start_time
+            job.returncode = job.process.returncode
+            if job.returncode == 0:
+                status = BatchJob.DONE
+            else:
+                status = BatchJob.FAILED
+            self.running.remove(job)
+            self.queue.mark(job, status)
+            if self.callback is not None:
+                self.callback(job)
+            self.condition.notify()
+
+    def report(self):
+        """Return a list of lines giving status and timing of each job."""
+        lines = []
+        for job in self.queue.jobs:
+            if job.elapsed is None:
+                elapsed = "-"
+            else:
+                elapsed = "{:.1f}s".format(job.elapsed)
+            line = "{:8} {:>9} {}".format(job.status, elapsed, job.key)
+            if job.error is not None:
+                line += ": {}".format(job.error)
+            lines.append(line)
+        return lines
@@ -0,0 +1,567 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# cache.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+# Imports                                        {{{1
+import os
+import json
+import mmap
+import os.path
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+from .utils import (
+    SUBPROCESS_LOG, SCHEDULING, THREADS, RAW_AUDIO, Probe, get_cache_dir,
+    )
+from .formats import get_segment_format
+
+
+# Global variables                               {{{1
+# The cache directories may be moved with the VID_CACHE and
+# VID_MUSIC_CACHE environment variables and their sizes limited with
+# VID_CACHE_SIZE, in megabytes.
+CACHE_DIR = get_cache_dir("shots", 'VID_CACHE')
+MUSIC_CACHE_DIR = get_cache_dir("music", 'VID_MUSIC_CACHE')
+# The default of VID_CACHE_SIZE. See get_cache_size().
+CACHE_SIZE = 4096  # Megabytes
+# Bump this when the way shots are rendered changes, so that old entries
+# are never used again. They will be evicted eventually.
+CACHE_VERSION = 1
+# Shots are rendered to this format when filters still have to be
+# applied to the whole movie.
+LOSSLESS = ["-vcodec", "ffv1", "-acodec", "flac"]
+# Whatever the codecs, every entry is a matroska file with the same audio
+# layout, so that entries can be joined by the concat demuxer.
+SEGMENT_ARGS = ["-ac", "2", "-ar", "44100", "-f", "matroska"]
+# Bytes per sample frame and per second of RAW_AUDIO: 16 bits stereo at
+# 44100 Hz.
+FRAME_SIZE = 4
+SAMPLE_RATE = 44100
+# The codecs written by the encoders of output formats, where their
+# names differ. See get_video_codec().
+ENCODER_CODECS = {
+    'libx264': "h264",
+    'libx265': "hevc",
+    'libvpx': "vp8",
+    'libvpx-vp9': "vp9",
+    'libtheora': "theora",
+    'libxvid': "mpeg4",
+    }
+# Properties of the video stream that copied and encoded parts of a shot
+# must share. See SmartShotCache.
+STREAM_PROPERTIES = ("width", "height", "pix_fmt", "profile")
+#}}}
+
+
+def get_cache_size():                            #{{{1
+    """Return the size limit of caches in bytes, from VID_CACHE_SIZE.
+
+    Raises ValueError if the variable is not a number of megabytes.
+    """
+    value = os.getenv('VID_CACHE_SIZE', str(CACHE_SIZE))
+    try:
+        size = int(value)
+    except ValueError:
+        size = -1
+    if size < 0:
+        raise ValueError(
+            "VID_CACHE_SIZE must be a number of megabytes, not "
+            "{!r}.".format(value)
+            )
+    return size * 1024 * 1024
+
+
+class ShotCache():                               #{{{1
+    """A directory of rendered shots, named after their parameters.
+
+    The name of an entry is a hash of the identity of the source file
+    (path, size and modification time), the cut, the filters and the
+    output format. Any change to one of those makes another entry.
+
+    Entries are touched when used. evict() deletes the least recently
+    used entries when the cache grows over max_size bytes, by default
+    the size returned by get_cache_size().
+    """
+
+    SUFFIX = ".mkv"
+
+    def __init__(self, directory=CACHE_DIR, max_size=None):
+        self.logger = logging.getLogger(__name__+".ShotCache")
+        self.directory = directory
+        if max_size is None:
+            max_size = get_cache_size()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return "<{}({}), hits={}, misses={}>".format(
+            type(self).__name__, self.directory, self.hits, self.misses,
+            )
+
+    @staticmethod
+    def get_key(shot, format, vf=None):
+        """Return the hash identifying shot rendered in format.
+
+        vf replaces the video filters of shot, if given.
+        """
+        st = os.stat(shot.name)
+        identity = {
+            'version': CACHE_VERSION,
+            'source': [os.path.abspath(shot.name), st.st_size, st.st_mtime_ns],
+            'seek': shot.seek,
+            'dur': shot.dur,
+            'vf': shot.vf if vf is None else vf,
+            'af': shot.af,
+            'silent': shot.silent,
+            'format': format,
+            }
+        data = json.dumps(identity, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def lookup(self, key):
+        """Return the path of the entry, or None if it is not cached."""
+        path = self.get_path(key)
+        try:
+            # Mark the entry as the most recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, shot, format):
+        """Return the path of shot rendered in format.
+
+        The shot is rendered and stored if it is not cached.
+        """
+        key = self.get_key(shot, format)
+        path = self.lookup(key)
+        with self.lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if path is None:
+            path = self.get_path(key)
+            self._render(shot, format, path)
+        return path
+
+    def get_all(self, shots, format, jobs=2):
+        """Return the paths of all shots rendered in format.
+
+        Missing entries are rendered by up to jobs processes at once.
+        A shot used several times is rendered once, and counted as a
+        hit after its first use.
+        """
+        keys = [self.get_key(shot, format) for shot in shots]
+        unique = {}
+        for key, shot in zip(keys, shots):
+            unique.setdefault(key, shot)
+        with self.lock:
+            self.hits += len(keys) - len(unique)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            paths = dict(zip(unique, executor.map(
+                lambda s: self.get(s, format), unique.values()
+                )))
+        return [paths[key] for key in keys]
+
+    def _render(self, shot, format, path, vf=None):
+        af = list(shot.af)
+        if shot.silent:
+            af.append(("volume", {'volume': 0}))
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        threads = THREADS.acquire("encoder")
+        try:
+            args = shot._input_args(threads.threads) + shot._cut_args()
+            if vf is None:
+                args += shot._format_vf()
+            elif vf:
+                args += ["-filter:v", shot._escape_filterchain(vf)]
+            if af:
+                args += ["-filter:a", shot._escape_filterchain(af)]
+            args += get_segment_format(format) + SEGMENT_ARGS + [tmp]
+            args = SCHEDULING.wrap_args("encoder", args)
+            process = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                preexec_fn=SCHEDULING.preexec_fn("encoder"),
+                )
+            self.logger.debug(SUBPROCESS_LOG.format(process.pid, args))
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, args)
+            # Other renders never see a partial entry.
+            os.replace(tmp, path)
+        finally:
+            threads.release()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.logger.debug("Stored {} as {}.".format(shot, path))
+
+    def get_size(self):
+        """Return the total size of the entries in bytes."""
+        return sum(size for mtime, size, path in self._entries())
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self, keep=()):
+        """Delete the least recently used entries over max_size.
+
+        Paths in keep are not deleted, even if the cache stays over
+        max_size. Returns the size of the cache after eviction.
+        """
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            if path in keep:
+                continue
+            os.remove(path)
+            size -= entry_size
+            self.logger.debug("Evicted {}.".format(path))
+        return size
+
+
+def get_video_encoder(format):                   #{{{1
+    """Return the name of the video encoder of format, or None."""
+    encoder = None
+    for n, option in enumerate(format[:-1]):
+        # The last option wins, like in ffmpeg.
+        if option in ("-vcodec", "-c:v", "-codec:v"):
+            encoder = format[n+1]
+    return encoder
+
+
+def get_video_codec(format):                     #{{{1
+    """Return the name of the video codec written by format, or None."""
+    encoder = get_video_encoder(format)
+    return ENCODER_CODECS.get(encoder, encoder)
+
+
+def get_stream_properties(format):               #{{{1
+    """Return the STREAM_PROPERTIES that format sets, as a dict."""
+    properties = {}
+    for n, option in enumerate(format[:-1]):
+        value = format[n+1]
+        if option == "-s":
+            # An abbreviation such as "hd720" never matches.
+            width, _, height = value.partition("x")
+            properties['width'], properties['height'] = width, height
+        elif option == "-pix_fmt":
+            properties['pix_fmt'] = value
+        elif option in ("-profile:v", "-profile"):
+            properties['profile'] = value
+    return properties
+
+
+def has_stream_properties(stream, properties):   #{{{1
+    """Return True if stream, as returned by Probe, has properties."""
+    return all(
+        str(stream.get(key, "")).lower() == str(value).lower()
+        for key, value in properties.items()
+        )
+
+
+class SmartShotCache(ShotCache):                 #{{{1
+    """A ShotCache that copies the video of shots instead of encoding it.
+
+    When the file of a shot is in the video codec of the format, the
+    complete groups of pictures (GOPs) inside the cut are stream copied.
+    Only the partial GOPs before the first keyframe and after the last
+    one are encoded. The audio of the cut is encoded as a whole.
+
+    Shots with video filters other than deinterlacing are encoded
+    whole, like ShotCache does. The other shots are never deinterlaced,
+    even when they are encoded whole because their parts would differ,
+    and the key of their entries leaves out the yadif filter: smart
+    renders of interlaced footage look different from those of the other
+    engines. With sources using open GOPs, the first frames of copied
+    parts may show artifacts.
+
+    The parts are joined by stream copy, so they must have the same
+    width, height, pixel format and profile, see STREAM_PROPERTIES. A shot
+    is encoded whole when the format sets one of them to another value
+    than the file, or when the encoded parts turn out different from
+    the file. Other encoder parameters are not compared: a decoder that
+    can't switch between the parameter sets of the source and those of
+    the encoder may still fail on the joined file.
+    """
+
+    @staticmethod
+    def get_key(shot, format):
+        vf = None
+        if SmartShotCache.get_plan(shot, format) is not None:
+            # These shots are not deinterlaced, see _render().
+            vf = []
+        # Entries are not interchangeable with those of ShotCache.
+        return ShotCache.get_key(shot, ["smart"] + list(format), vf)
+
+    @staticmethod
+    def get_plan(shot, format):
+        """Return the parts of shot as (start, end, copy) tuples.
+
+        start and end are times in the file of the shot. Returns None if
+        the shot must be encoded whole.
+        """
+        if getattr(shot, 'shots', None) is not None:
+            # ShotGroup cuts are not contiguous.
+            return None
+        if any(filter[0] != "yadif" for filter in shot.vf):
+            return None
+        probe = shot._probe
+        if probe.get_codec("video") != get_video_codec(format):
+            return None
+        stream = probe.get_stream("video")
+        if not has_stream_properties(stream, get_stream_properties(format)):
+            return None
+        end = probe.get_duration()
+        if shot.dur is not None:
+            end = min(end, shot.seek + shot.dur)
+        keyframes = [k for k in probe.get_keyframes() if shot.seek <= k <= end]
+        if len(keyframes) < 2:
+            # No complete GOP inside the cut.
+            return None
+        parts = [
+            (shot.seek, keyframes[0], False),
+            (keyframes[0], keyframes[-1], True),
+            (keyframes[-1], end, False),
+            ]
+        return [part for part in parts if part[1] > part[0]]
+
+    def _render(self, shot, format, path):
+        plan = self.get_plan(shot, format)
+        if plan is None:
+            return super(SmartShotCache, self)._render(shot, format, path)
+        tmps = []
+        stream = shot._probe.get_stream("video")
+        properties = {
+            key: stream[key] for key in STREAM_PROPERTIES if key in stream
+            }
+        compatible = True
+        threads = THREADS.acquire("encoder")
+        try:
+            lines = ["ffconcat version 1.0"]
+            for start, end, copy in plan:
+                fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+                os.close(fd)
+                tmps.append(tmp)
+                args = ["ffmpeg", "-loglevel", "debug", "-y"]
+                if threads.threads:
+                    args += ["-threads", str(threads.threads)]
+                args += [
+                    "-ss", str(start), "-i", shot.name,
+                    "-t", str(end - start), "-an",
+                    ]
+                args += get_segment_format(format) + SEGMENT_ARGS
+                if copy:
+                    # This overrides the codec of the format.
+                    args += ["-c:v", "copy"]
+                self._run(args + [tmp])
+                if not copy and not has_stream_properties(
+                        Probe(tmp).get_stream("video"), properties):
+                    compatible = False
+                    break
+                name = tmp.replace("'", "'\\''")
+                lines.append("file '{}'".format(name))
+            if compatible:
+                self._join(shot, format, plan, lines, path, tmps)
+        finally:
+            threads.release()
+            for tmp in tmps:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        if not compatible:
+            self.logger.debug(
+                "Encoded parts of {} differ from {}, encoding it "
+                "whole.".format(shot, properties)
+                )
+            # Like the copied parts, the shot is not deinterlaced.
+            return super(SmartShotCache, self)._render(
+                shot, format, path, vf=[],
+                )
+        self.logger.debug("Stored {} as {}, copying {}.".format(
+            shot, path, [part[:2] for part in plan if part[2]],
+            ))
+
+    def _join(self, shot, format, plan, lines, path, tmps):
+        """Join the parts listed by lines with the audio of the cut."""
+        fd, script = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        tmps.append(script)
+        with open(fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        tmps.append(tmp)
+        af = list(shot.af)
+        if shot.silent:
+            af.append(("volume", {'volume': 0}))
+        args = [
+            "ffmpeg", "-loglevel", "debug", "-y",
+            "-f", "concat", "-safe", "0", "-i", script,
+            "-ss", str(plan[0][0]), "-t", str(plan[-1][1] - plan[0][0]),
+            "-i", shot.name,
+            "-map", "0:v", "-map", "1:a",
+            ]
+        if af:
+            args += ["-filter:a", shot._escape_filterchain(af)]
+        args += get_segment_format(format) + SEGMENT_ARGS
+        args += ["-c:v", "copy", tmp]
+        self._run(args)
+        os.replace(tmp, path)
+
+    def _run(self, args):
+        args = SCHEDULING.wrap_args("encoder", args)
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=SCHEDULING.preexec_fn("encoder"),
+            )
+        self.logger.debug(SUBPROCESS_LOG.format(process.pid, args))
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+
+class MusicCache(ShotCache):                     #{{{1
+    """A directory of music files decoded to RAW_AUDIO.
+
+    Entries are named after the identity of the music file (path, size
+    and modification time). load() maps them in memory, so that a music
+    file is decoded once, whatever part of it each render uses.
+    """
+
+    SUFFIX = ".pcm"
+
+    def __init__(self, directory=MUSIC_CACHE_DIR, max_size=None):
+        super(MusicCache, self).__init__(directory, max_size)
+        self.logger = logging.getLogger(__name__+".MusicCache")
+
+    @staticmethod
+    def get_key(music, format=RAW_AUDIO):
+        """Return the hash identifying music decoded in format."""
+        st = os.stat(music)
+        identity = {
+            'version': CACHE_VERSION,
+            'source': [os.path.abspath(music), st.st_size, st.st_mtime_ns],
+            'format': format,
+            }
+        data = json.dumps(identity, sort_keys=True)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get(self, music, format=RAW_AUDIO):
+        return super(MusicCache, self).get(music, format)
+
+    def load(self, music):
+        """Return music as a DecodedMusic, decoding it if not cached."""
+        path = self.get(music)
+        self.evict(keep={path})
+        return DecodedMusic(path)
+
+    def _render(self, music, format, path):
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        try:
+            args = [
+                "ffmpeg", "-y", "-loglevel", "debug", "-i", music, "-vn",
+                ] + format + [tmp]
+            args = SCHEDULING.wrap_args("decoder", args)
+            process = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                preexec_fn=SCHEDULING.preexec_fn("decoder"),
+                )
+            self.logger.debug(SUBPROCESS_LOG.format(process.pid, args))
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, args)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.logger.debug("Decoded {} as {}.".format(music, path))
+
+
+class DecodedMusic():                            #{{{1
+    """A music file decoded to RAW_AUDIO and mapped in memory.
+
+    slices() returns parts of the music without decoding nor copying
+    them. Pass them to AudioProcessing.mix().
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__+".DecodedMusic")
+        self.path = path
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty files can not be mapped.
+                self.map = b""
+
+    def __repr__(self):
+        return "<DecodedMusic({}), duration={}>".format(
+            self.path, self.get_duration(),
+            )
+
+    def get_duration(self):
+        return len(self.map) / FRAME_SIZE / SAMPLE_RATE
+
+    def _offset(self, seconds):
+        """Return the offset in bytes of seconds, on a frame boundary."""
+        offset = int(round(seconds * SAMPLE_RATE)) * FRAME_SIZE
+        return max(0, min(offset, len(self.map)))
+
+    def slices(self, seek=0, dur=None, loop=False, size=64 * 1024):
+        """Yield memoryviews of the music from seek, lasting dur seconds.
+
+        If loop is true, the part starts over each time it ends, until
+        the caller stops iterating.
+        """
+        start = self._offset(seek)
+        end = len(self.map) if dur is None else self._offset(seek + dur)
+        if start >= end:
+            return
+        view = memoryview(self.map)
+        while True:
+            for offset in range(start, end, size):
+                yield view[offset:min(offset + size, end)]
+            if not loop:
+                break
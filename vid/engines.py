@@ -0,0 +1,830 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# engines.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+# Imports                                        {{{1
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import subprocess
+
+from . import utils
+from .utils import (
+    Multiplexer, OUTPUT_FORMATS, SUBPROCESS_LOG, SCHEDULING, THREADS,
+    SubprocessSupervisor, get_output_format, get_output_height,
+    get_output_name, make_output_dirs,
+    )
+from .formats import FORMATS, get_stream_format, get_segment_format
+from .cache import ShotCache, SmartShotCache, LOSSLESS, SEGMENT_ARGS
+from .manifest import RenderJournal
+
+
+# Global variables                               {{{1
+ENGINES = ("pipes", "graph", "concat", "cache", "smart", "segments")
+SEGMENTS_SUFFIX = ".segments"
+# SegmentedRender cuts the movie in segments of about this length.
+SEGMENT_LENGTH = 60  # Seconds
+
+
+logger = logging.getLogger(__name__)
+#}}}
+
+
+def ffconcat_script(entries):                    #{{{1
+    """Return an ffconcat script as a string.
+
+    Entries are (file name, inpoint, outpoint) tuples. The inpoint and
+    the outpoint may be None.
+    """
+    lines = ["ffconcat version 1.0"]
+    for name, inpoint, outpoint in entries:
+        name = os.path.abspath(name).replace("'", "'\\''")
+        lines.append("file '{}'".format(name))
+        if inpoint:
+            lines.append("inpoint {}".format(inpoint))
+        if outpoint is not None:
+            lines.append("outpoint {}".format(outpoint))
+    return "\n".join(lines) + "\n"
+
+
+def split_output(file):                         #{{{1
+    """Return the file name and the format list of an output.
+
+    See Multiplexer.write_to_files() for the accepted arguments.
+    """
+    if isinstance(file, tuple):
+        if get_output_height(file) is not None:
+            raise ValueError(
+                "Scaled outputs are rendered by the pipes, graph and "
+                "concat engines only."
+                )
+        return file[:2]
+    return file, get_output_format(file)
+
+
+def write_ffconcat_script(script):               #{{{1
+    """Write script to a new file and return its name.
+
+    Scripts are written with the logs. The engines delete them once the
+    ffmpeg process reading them exits.
+    """
+    fd, name = tempfile.mkstemp(suffix=".ffconcat", dir=utils.logdir)
+    with open(fd, "w") as f:
+        f.write(script)
+    logger.debug("Wrote ffconcat script {}.".format(name))
+    return name
+
+
+class TimelineInput():                           #{{{1
+    """One input file of a FilterGraphRender and the shots cut from it.
+
+    The input seeks to the first shot. Shots must come in ascending,
+    non-overlapping order so that the split filter never has to buffer
+    frames for a later shot while an earlier one is being read.
+    """
+
+    def __init__(self, index, shot):
+        self.index = index
+        self.name = shot.name
+        self.seek = shot.seek
+        self.shots = [shot]
+
+    def __repr__(self):
+        return "<TimelineInput({}), {}, seek={}, shots={}>".format(
+            self.index, self.name, self.seek, len(self.shots),
+            )
+
+    def accepts(self, shot):
+        last = self.shots[-1]
+        return (shot.name == self.name and
+                last.dur is not None and
+                shot.seek >= last.seek + last.dur)
+
+    def get_args(self):
+        args = []
+        if self.seek:
+            args += ["-ss", str(self.seek)]
+        return args + ["-i", self.name]
+
+
+def plan_inputs(shots):                          #{{{1
+    """Assign every shot to a TimelineInput.
+
+    A file used in ascending order is opened once. A file used out of
+    order gets another input for the shots that go back in time.
+
+    Returns a list of TimelineInput objects and a list giving the input
+    of each shot.
+    """
+    inputs = []
+    assignments = []
+    for shot in shots:
+        for input in inputs:
+            if input.accepts(shot):
+                input.shots.append(shot)
+                break
+        else:
+            input = TimelineInput(len(inputs), shot)
+            inputs.append(input)
+        assignments.append(input)
+    return inputs, assignments
+
+
+class FilterGraphRender(Multiplexer):            #{{{1
+    """Render a whole movie with a single ffmpeg process.
+
+    The movie is compiled into one filtergraph. Each shot is cut from
+    its input with trim and atrim, filtered, then all shots are joined
+    with concat. The music is mixed with amix and the multiplexer
+    filters come last. No raw stream goes through a pipe or through
+    Python.
+
+    This is a drop-in replacement for Multiplexer: filters are appended
+    with append_vf() and append_af() and the output is written with
+    mux() or write_to_files().
+    """
+
+    def __init__(self, shots, music=None):
+        self.logger = logging.getLogger(__name__+".FilterGraphRender")
+        self.shots = list(shots)
+        self.music = music
+        self.inputs, self.assignments = plan_inputs(self.shots)
+        self.v_fd = None
+        self.a_fd = None
+        self.process = None
+        self.encoders = []
+        # ffconcat scripts to delete when the next process exits.
+        self.scripts = []
+        self.vf = []
+        self.af = []
+        # The time of the first shot in the whole movie, when rendering
+        # part of it. The music and the multiplexer filters start there.
+        self.offset = 0
+
+    def _input_args(self):
+        args = ["ffmpeg", "-loglevel", "debug", "-y"]
+        for input in self.inputs:
+            args += input.get_args()
+        return args + self._music_args()
+
+    def _music_args(self):
+        if self.music is None:
+            return []
+        if self.offset:
+            return ["-ss", str(self.offset), "-i", self.music]
+        return ["-i", self.music]
+
+    def _filtergraph(self, outputs=1, heights=None):
+        """Return the filtergraph and the labels of its outputs.
+
+        The labels are a list of ("[v]", "[a]") tuples, one per output.
+        heights is the height to which each output is scaled, or None.
+        """
+        graph = self._shots_filtergraph()
+        v_label, a_label = "[vcat]", "[acat]"
+        if self.music is not None:
+            graph.append("{}[{}:a]amix=duration=first[amix]".format(
+                a_label, self._music_index()
+                ))
+            a_label = "[amix]"
+        if self.offset:
+            graph.append("{}setpts=PTS+{}/TB[vpts]".format(
+                v_label, self.offset
+                ))
+            graph.append("{}asetpts=PTS+{}/TB[apts]".format(
+                a_label, self.offset
+                ))
+            v_label, a_label = "[vpts]", "[apts]"
+        if self.vf:
+            graph.append("{}{}[vmux]".format(
+                v_label, self._escape_filterchain(self.vf)
+                ))
+            v_label = "[vmux]"
+        if self.af:
+            graph.append("{}{}[amux]".format(
+                a_label, self._escape_filterchain(self.af)
+                ))
+            a_label = "[amux]"
+        if heights is None:
+            heights = [None] * outputs
+        split, labels = self._split_streams(v_label, a_label, heights)
+        return ";".join(graph + split), labels
+
+    def _music_index(self):
+        return len(self.inputs)
+
+    def _shots_filtergraph(self):
+        """Return the filters joining the shots as a list of filterchains.
+
+        The last filter outputs the movie as [vcat] and [acat].
+        """
+        graph = []
+        # Split each input in as many streams as it has shots.
+        for input in self.inputs:
+            n = len(input.shots)
+            for stream, split in (("v", "split"), ("a", "asplit")):
+                graph.append("[{i}:{s}]{split}={n}{labels}".format(
+                    i=input.index, s=stream, split=split, n=n,
+                    labels="".join(
+                        "[i{}{}{}]".format(input.index, stream, k)
+                        for k in range(n)
+                        ),
+                    ))
+        # Cut and filter every shot.
+        used = {input.index: 0 for input in self.inputs}
+        concat = ""
+        for i, (shot, input) in enumerate(zip(self.shots, self.assignments)):
+            k = used[input.index]
+            used[input.index] += 1
+            start = shot.seek - input.seek
+            if shot.dur is None:
+                end = ""
+            else:
+                end = ":end={}".format(start + shot.dur)
+            v_chain = "[i{}v{}]trim=start={}{},setpts=PTS-STARTPTS".format(
+                input.index, k, start, end,
+                )
+            if shot.vf:
+                v_chain += "," + self._escape_filterchain(shot.vf)
+            a_chain = "[i{}a{}]atrim=start={}{},asetpts=PTS-STARTPTS".format(
+                input.index, k, start, end,
+                )
+            if shot.af:
+                a_chain += "," + self._escape_filterchain(shot.af)
+            if shot.silent:
+                a_chain += ",volume=0"
+            graph.append(v_chain + "[v{}]".format(i))
+            graph.append(a_chain + "[a{}]".format(i))
+            concat += "[v{0}][a{0}]".format(i)
+        graph.append("{}concat=n={}:v=1:a=1[vcat][acat]".format(
+            concat, len(self.shots)
+            ))
+        return graph
+
+    def _output_args(self, *files, threads=None):
+        assert files
+        graph, labels = self._filtergraph(
+            len(files), [get_output_height(file) for file in files]
+            )
+        self.logger.debug("Filtergraph:\n{}".format(graph))
+        outputs = ["-filter_complex", graph]
+        if threads:
+            per_output = max(1, threads // len(files))
+            outputs = ["-filter_complex_threads", str(threads)] + outputs
+        for file, (v_label, a_label) in zip(files, labels):
+            outputs += ["-map", v_label, "-map", a_label]
+            outputs += get_output_format(file)
+            if threads:
+                outputs += ["-threads", str(per_output)]
+            outputs.append(get_output_name(file))
+        return outputs
+
+    def _spawn(self, files, stdout):
+        threads = THREADS.acquire("encoder")
+        args = self._input_args() + self._output_args(
+            *files, threads=threads.threads
+            )
+        args = SCHEDULING.wrap_args("encoder", args)
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=SCHEDULING.preexec_fn("encoder"),
+            )
+        self.logger.debug(SUBPROCESS_LOG.format(self.process.pid, args))
+        self._supervise(threads)
+
+    def _supervise(self, threads):
+        """Release threads and delete scripts when the process exits."""
+        scripts, self.scripts = self.scripts, []
+
+        def action():
+            threads.release()
+            self._remove_scripts(scripts)
+
+        SubprocessSupervisor(
+            (self.process.wait,),
+            action,
+            name="Releasing {}.".format(threads),
+            ).start()
+
+    def _remove_scripts(self, scripts):
+        for script in scripts:
+            try:
+                os.remove(script)
+            except FileNotFoundError:
+                pass
+
+    def mux(self, format=OUTPUT_FORMATS['pipe']):
+        if isinstance(format, str):
+            format = FORMATS.get(format)
+        self._spawn([("pipe:1", format)], subprocess.PIPE)
+        self.output = self.process.stdout
+        return self.process.stdout
+
+    def stream(self, output, format="webm"):
+        fd = 1 if output == "-" else self._get_fileno(output)
+        if fd is None:
+            raise ValueError("Can't stream to {}.".format(output))
+        if isinstance(format, str):
+            format = FORMATS.get(format)
+        self._spawn([("pipe:1", get_stream_format(format))], fd)
+
+    def write_to_files(self, *files, parallel=False):
+        make_output_dirs(files)
+        if parallel and len(files) > 1:
+            self._fan_out(files)
+            return
+        self._spawn(files, subprocess.DEVNULL)
+
+
+class ConcatDemuxerRender(FilterGraphRender):    #{{{1
+    """Render a movie of unfiltered shots with ffmpeg's concat demuxer.
+
+    The cut points of every shot are written to an ffconcat script as
+    inpoint and outpoint directives, and a single ffmpeg process reads
+    the shots in sequence as if they were one file. There is no trim,
+    no split and no concat filter: this is about as fast as the encoder.
+
+    The shots must all have the same filters, which are applied once to
+    the whole movie, and none may be silent. See accepts().
+
+    As documented for the concat demuxer, cuts in footage that is not
+    intra-frame coded may start a few frames before the inpoint.
+    """
+
+    def __init__(self, shots, music=None):
+        if not self.accepts(shots):
+            raise ValueError(
+                "The concat engine requires shots without filters of "
+                "their own and without silence."
+                )
+        super().__init__(shots, music)
+        self.logger = logging.getLogger(__name__+".ConcatDemuxerRender")
+        self.script = None
+
+    @staticmethod
+    def accepts(shots):
+        """Return True if all shots may be read by the concat demuxer."""
+        first = shots[0]
+        for shot in shots:
+            if shot.vf != first.vf or shot.af != first.af or shot.silent:
+                return False
+        return True
+
+    def get_script(self):
+        """Return the ffconcat script as a string."""
+        return ffconcat_script(
+            (
+                shot.name,
+                shot.seek,
+                None if shot.dur is None else shot.seek + shot.dur,
+                )
+            for shot in self.shots
+            )
+
+    def _input_args(self):
+        self.script = write_ffconcat_script(self.get_script())
+        self.scripts.append(self.script)
+        args = [
+            "ffmpeg", "-loglevel", "debug", "-y",
+            "-f", "concat", "-safe", "0", "-i", self.script,
+            ]
+        return args + self._music_args()
+
+    def _music_index(self):
+        return 1
+
+    def _shots_filtergraph(self):
+        shot = self.shots[0]
+        vf = self._escape_filterchain(shot.vf) if shot.vf else "null"
+        af = self._escape_filterchain(shot.af) if shot.af else "anull"
+        return ["[0:v]{}[vcat]".format(vf), "[0:a]{}[acat]".format(af)]
+
+
+class CachedRender(FilterGraphRender):           #{{{1
+    """Render a movie by joining shots stored in a ShotCache.
+
+    Shots that are not cached are rendered first, each to a file of its
+    own. Then a single ffmpeg process joins the files with the concat
+    demuxer. After a small edit of a project, only the shots that
+    changed are rendered again.
+
+    Shots are cached in the codecs of the output, and the video is
+    joined by stream copy. If the multiplexer has video filters, shots
+    are cached in a lossless format instead and the whole movie is
+    filtered and encoded as usual. The audio is copied too, unless
+    there is music to mix or audio filters to apply.
+
+    Unlike the other engines, write_to_files() and mux() block while
+    shots are being rendered.
+    """
+
+    def __init__(self, shots, music=None, cache=None):
+        super().__init__(shots, music)
+        self.logger = logging.getLogger(__name__+".CachedRender")
+        self.cache = cache
+        # The files of the shots of each output.
+        self.segments = {}
+        # Other files of the cache that must not be evicted.
+        self.keep = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_cache(self, output):
+        """Return the ShotCache holding the shots of output."""
+        if self.cache is None:
+            self.cache = ShotCache()
+        return self.cache
+
+    def _segment_format(self, format):
+        """Return the format in which to cache shots for format."""
+        if self.vf or "rawvideo" in format:
+            return LOSSLESS
+        return get_segment_format(format)
+
+    def _spawn(self, files, stdout):
+        # Group outputs by the cache and the format of their shots.
+        groups = []
+        outputs = []
+        for file in files:
+            name, format = split_output(file)
+            group = (self._get_cache(name), self._segment_format(format))
+            if group not in groups:
+                groups.append(group)
+            outputs.append((name, format, groups.index(group)))
+
+        args = ["ffmpeg", "-loglevel", "debug", "-y"]
+        inputs = []
+        for cache, segment_format in groups:
+            hits, misses = cache.hits, cache.misses
+            segments = cache.get_all(self.shots, segment_format)
+            self.hits += cache.hits - hits
+            self.misses += cache.misses - misses
+            inputs.append(segments)
+            script = write_ffconcat_script(
+                ffconcat_script((s, None, None) for s in segments)
+                )
+            self.scripts.append(script)
+            args += ["-f", "concat", "-safe", "0", "-i", script]
+        self.logger.debug("{} shots cached, {} rendered.".format(
+            self.hits, self.misses
+            ))
+        for name, format, i in outputs:
+            self.segments[name] = inputs[i]
+        used = {s for segments in inputs for s in segments} | self.keep
+        for cache in {cache for cache, segment_format in groups}:
+            cache.evict(keep=used)
+        args += self._music_args()
+
+        threads = THREADS.acquire("encoder")
+        args += self._output_args(outputs, threads.threads)
+        args = SCHEDULING.wrap_args("encoder", args)
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=SCHEDULING.preexec_fn("encoder"),
+            )
+        self.logger.debug(SUBPROCESS_LOG.format(self.process.pid, args))
+        self._supervise(threads)
+
+    def _output_args(self, outputs, threads=None):
+        """Return the output arguments.
+
+        Outputs is a list of (file name, format, input index) tuples.
+        The filters run once for each input and their result is split
+        between the outputs of the input.
+        """
+        music = len({i for name, format, i in outputs})
+        a_chain = []
+        if self.music is not None:
+            a_chain.append("amix=duration=first")
+        if self.af:
+            a_chain.append(self._escape_filterchain(self.af))
+        # The numbers of the outputs of each input.
+        inputs = {}
+        for n, (name, format, i) in enumerate(outputs):
+            inputs.setdefault(i, []).append(n)
+        graph = []
+        for i, numbers in inputs.items():
+            if self.vf:
+                graph.append("[{}:v]{}{}{}".format(
+                    i,
+                    self._escape_filterchain(self.vf),
+                    ",split={}".format(len(numbers)) if numbers[1:] else "",
+                    "".join("[v{}]".format(n) for n in numbers),
+                    ))
+            if a_chain:
+                graph.append("[{}:a]{}{}{}{}".format(
+                    i,
+                    "[{}:a]".format(music) if self.music is not None else "",
+                    ",".join(a_chain),
+                    ",asplit={}".format(len(numbers)) if numbers[1:] else "",
+                    "".join("[a{}]".format(n) for n in numbers),
+                    ))
+        args = []
+        for n, (name, format, i) in enumerate(outputs):
+            copy = self._segment_format(format) is not LOSSLESS
+            if self.vf:
+                args += ["-map", "[v{}]".format(n)]
+            else:
+                args += ["-map", "{}:v".format(i)]
+            if a_chain:
+                args += ["-map", "[a{}]".format(n)]
+            else:
+                args += ["-map", "{}:a".format(i)]
+            args += format
+            # These override the codecs of the format.
+            if copy:
+                args += ["-c:v", "copy"]
+                if not a_chain:
+                    args += ["-c:a", "copy"]
+            if threads:
+                args += ["-threads", str(max(1, threads // len(outputs)))]
+            args.append(name)
+        if graph:
+            graph = ";".join(graph)
+            self.logger.debug("Filtergraph:\n{}".format(graph))
+            args = ["-filter_complex", graph] + args
+            if threads:
+                args = ["-filter_complex_threads", str(threads)] + args
+        return args
+
+
+class IncrementalRender(CachedRender):           #{{{1
+    """Render a movie by joining the shots of its previous render.
+
+    The shots of each output are kept in a directory next to it, named
+    after the output with a ".segments" suffix. Shots that are not in
+    the directory are rendered and the shots that are no longer part of
+    the movie are deleted. Together with the RenderManifest of the
+    output, this makes rendering a long movie again after a small edit
+    cost only the shots that changed, plus a stream copy.
+    """
+
+    def __init__(self, shots, music=None):
+        super().__init__(shots, music)
+        self.logger = logging.getLogger(__name__+".IncrementalRender")
+        self.caches = {}
+
+    def _get_cache(self, output):
+        if output not in self.caches:
+            self.caches[output] = ShotCache(
+                output + SEGMENTS_SUFFIX, max_size=0,
+                )
+        return self.caches[output]
+
+    def mux(self, format=OUTPUT_FORMATS['pipe']):
+        raise ValueError("Incremental renders are written to files only.")
+
+    def stream(self, output, format="webm"):
+        raise ValueError("Incremental renders are written to files only.")
+
+
+class SmartRender(CachedRender):                 #{{{1
+    """Render a movie by copying the video of its shots where possible.
+
+    This is a CachedRender whose shots are stored by a SmartShotCache:
+    when a file is already in the video codec of the output, only the
+    partial groups of pictures at both ends of a cut are encoded. The
+    rest of the video is stream copied. Plain assembly edits then cost
+    little more than reading and writing the files.
+    """
+
+    def _get_cache(self, output):
+        if self.cache is None:
+            self.cache = SmartShotCache()
+        return self.cache
+
+
+class SegmentedRender(FilterGraphRender):        #{{{1
+    """Render a movie in segments, so that a render may be resumed.
+
+    The movie is cut in segments of whole shots, about segment_length
+    seconds long. Each segment is rendered by a FilterGraphRender to a
+    file of its own and recorded in the RenderJournal of the output.
+    When all segments are done, they are joined by stream copy and the
+    journal is deleted.
+
+    If resume is true, segments found in the journal of a previous
+    render that was interrupted are not rendered again. A segment is
+    identified by its shots, its place in the movie, the music and the
+    multiplexer filters; editing the project invalidates only the
+    segments that changed.
+
+    write_to_files() blocks until the output is finished.
+    """
+
+    def __init__(self, shots, music=None, resume=False,
+                 segment_length=SEGMENT_LENGTH):
+        super().__init__(shots, music)
+        self.logger = logging.getLogger(__name__+".SegmentedRender")
+        self.resume = resume
+        self.segment_length = segment_length
+        self.resumed = 0
+        self.rendered = 0
+
+    def plan_segments(self):
+        """Return a list of (start time, shots) tuples."""
+        segments = []
+        time = 0
+        length = 0
+        for shot in self.shots:
+            if not segments or length >= self.segment_length:
+                segments.append((time, []))
+                length = 0
+            segments[-1][1].append(shot)
+            length += shot.get_duration()
+            time += shot.get_duration()
+        return segments
+
+    def _segment_key(self, start, shots, format):
+        identity = {
+            'shots': [ShotCache.get_key(shot, format) for shot in shots],
+            'start': start,
+            'music': self.music,
+            'vf': self.vf,
+            'af': self.af,
+            }
+        data = json.dumps(identity, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def _render_segment(self, start, shots, parts):
+        """Render shots to parts, a list of (file name, format) tuples."""
+        render = FilterGraphRender(shots, self.music)
+        render.offset = start
+        render.vf = self.vf
+        render.af = self.af
+        tmp = [(name + ".tmp", get_segment_format(format) + SEGMENT_ARGS)
+               for name, format in parts]
+        render.write_to_files(*tmp)
+        if render.process.wait() != 0:
+            raise subprocess.CalledProcessError(
+                render.process.returncode, render.process.args,
+                )
+        for (name, format), (tmp_name, tmp_format) in zip(parts, tmp):
+            os.replace(tmp_name, name)
+
+    def _spawn(self, files, stdout):
+        outputs = [split_output(file) for file in files]
+        journals = []
+        for name, format in outputs:
+            if self.resume:
+                journal = RenderJournal.load(name, format)
+            else:
+                journal = RenderJournal(name, format)
+                journal.remove()
+            journals.append(journal)
+
+        segments = [[] for output in outputs]
+        for start, shots in self.plan_segments():
+            parts = []
+            keys = []
+            for n, (name, format) in enumerate(outputs):
+                key = self._segment_key(start, shots, format)
+                path = journals[n].get(key)
+                if path is None:
+                    path = journals[n].get_path(key)
+                    parts.append((path, format))
+                    keys.append((journals[n], key, path))
+                segments[n].append(path)
+            if parts:
+                self.logger.debug("Rendering segment at {}.".format(start))
+                self._render_segment(start, shots, parts)
+                for journal, key, path in keys:
+                    journal.add(key, path)
+                self.rendered += 1
+            else:
+                self.resumed += 1
+
+        # Join the segments of every output.
+        args = ["ffmpeg", "-loglevel", "debug", "-y"]
+        for paths in segments:
+            script = write_ffconcat_script(
+                ffconcat_script((path, None, None) for path in paths)
+                )
+            self.scripts.append(script)
+            args += ["-f", "concat", "-safe", "0", "-i", script]
+        for n, (name, format) in enumerate(outputs):
+            args += ["-map", str(n)] + format + ["-c", "copy", name]
+        args = SCHEDULING.wrap_args("encoder", args)
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=SCHEDULING.preexec_fn("encoder"),
+            )
+        self.logger.debug(SUBPROCESS_LOG.format(self.process.pid, args))
+        returncode = self.process.wait()
+        self._remove_scripts(self.scripts)
+        self.scripts = []
+        if returncode == 0:
+            for journal in journals:
+                journal.remove()
+
+    def mux(self, format=OUTPUT_FORMATS['pipe']):
+        raise ValueError("Segmented renders are written to files only.")
+
+    def stream(self, output, format="webm"):
+        raise ValueError("Segmented renders are written to files only.")
+
+
+class VariantRender():                           #{{{1
+    """Render several variants of a movie, sharing their common shots.
+
+    Variants is a mapping of names to lists of shots, such as a long cut
+    and a short cut of the same footage. Each variant is a CachedRender
+    sharing one ShotCache. The shots of all variants are rendered first,
+    each unique shot once, then every variant is joined from the cache.
+
+    Filters appended with append_vf() and append_af() apply to every
+    variant. write_to_files() blocks while shots are being rendered,
+    then the variants are joined at the same time.
+    """
+
+    def __init__(self, variants, music=None, cache=None):
+        self.logger = logging.getLogger(__name__+".VariantRender")
+        self.cache = cache if cache is not None else ShotCache()
+        self.renders = {
+            name: CachedRender(shots, music, self.cache)
+            for name, shots in variants.items()
+            }
+
+    def append_vf(self, filtername, **kwargs):
+        for render in self.renders.values():
+            render.append_vf(filtername, **kwargs)
+        return self
+
+    def append_af(self, filtername, **kwargs):
+        for render in self.renders.values():
+            render.append_af(filtername, **kwargs)
+        return self
+
+    def get_unique_shots(self, outputs):
+        """Return the shots to render for outputs.
+
+        Returns a mapping of segment formats, as tuples, to lists of
+        shots appearing once each.
+        """
+        unique = {}
+        for name, files in outputs.items():
+            render = self.renders[name]
+            for file in files:
+                format = render._segment_format(split_output(file)[1])
+                shots = unique.setdefault(tuple(format), {})
+                for shot in render.shots:
+                    shots.setdefault(ShotCache.get_key(shot, format), shot)
+        return {
+            format: list(shots.values())
+            for format, shots in unique.items()
+            }
+
+    def write_to_files(self, outputs):
+        """Write every variant to its files.
+
+        Outputs is a mapping of variant names to lists of files, as
+        accepted by Multiplexer.write_to_files().
+        """
+        keep = set()
+        for format, shots in self.get_unique_shots(outputs).items():
+            self.logger.debug("Rendering {} unique shots.".format(len(shots)))
+            keep.update(self.cache.get_all(shots, list(format)))
+        for name, files in outputs.items():
+            render = self.renders[name]
+            render.keep = keep
+            render.write_to_files(*files)
+
+    def wait(self):
+        """Wait for every variant. Returns the highest return code."""
+        return max(
+            (
+                render.process.wait()
+                for render in self.renders.values()
+                if render.process is not None
+                ),
+            default=0,
+            )
@@ -0,0 +1,385 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# formats.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+# Imports                                        {{{1
+import os
+import logging
+
+import yaml
+
+
+# Global variables                               {{{1
+# Every format comes in these tiers, from the fastest to encode to the
+# best looking.
+TIERS = ("draft", "normal", "final")
+# Formats are added and overridden by this file. It may be moved with
+# the VID_FORMATS environment variable.
+FORMATS_FILE = os.getenv(
+    'VID_FORMATS',
+    os.path.join(
+        os.getenv('XDG_CONFIG_HOME', os.path.expanduser("~/.config")),
+        "vid", "formats.yaml",
+        ),
+    )
+# HLS playlists are cut in segments of about this length, each starting
+# on a keyframe, so that a player may start with the first ones while
+# the others are being encoded.
+HLS_SEGMENT_LENGTH = 6  # Seconds
+HLS_ARGS = [
+    "-f", "hls",
+    "-hls_time", str(HLS_SEGMENT_LENGTH),
+    # The playlist grows as segments are finished, and it is closed
+    # with #EXT-X-ENDLIST at the end.
+    "-hls_playlist_type", "event",
+    # Segments appear once they are complete.
+    "-hls_flags", "independent_segments+temp_file",
+    "-force_key_frames",
+    "expr:gte(t,n_forced*{})".format(HLS_SEGMENT_LENGTH),
+    ]
+# Generally, make keys refer to file extensions. A key may also be a
+# double extension, such as "vp9.webm", which takes precedence over the
+# last extension alone. A format list is used for every tier.
+DEFAULT_FORMATS = {
+    'avi': {
+        'draft': [
+            "-f", "avi",
+            "-vcodec", "libx264",
+            "-crf", "28", "-preset", "ultrafast",
+            "-acodec", "mp3", "-strict", "experimental",
+            "-ac", "2", "-ar", "44100", "-ab", "96k",
+            ],
+        'normal': [
+            "-f", "avi",
+            "-vcodec", "libx264",
+            "-crf", "23", "-preset", "medium",
+            "-acodec", "mp3", "-strict", "experimental",
+            "-ac", "2", "-ar", "44100", "-ab", "128k",
+            "-qscale:v", "6",
+            ],
+        'final': [
+            "-f", "avi",
+            "-vcodec", "libx264",
+            "-crf", "20", "-preset", "slow",
+            "-acodec", "mp3", "-strict", "experimental",
+            "-ac", "2", "-ar", "44100", "-ab", "192k",
+            ],
+        },
+    # Theora and Vorbis encoders are single-threaded: only the quality
+    # changes between tiers.
+    'ogv': {
+        'draft': [
+            "-f", "ogg",
+            "-vcodec", "libtheora",
+            "-qscale:v", "5",
+            "-acodec", "libvorbis",
+            "-qscale:a", "1",
+            ],
+        'normal': [
+            "-f", "ogg",
+            "-vcodec", "libtheora",
+            "-qscale:v", "8",
+            # Max quality is 10.
+            "-acodec", "libvorbis",
+            "-qscale:a", "3",
+            ],
+        'final': [
+            "-f", "ogg",
+            "-vcodec", "libtheora",
+            "-qscale:v", "9",
+            "-acodec", "libvorbis",
+            "-qscale:a", "5",
+            ],
+        },
+    'webm': {
+        'draft': [
+            "-f", "webm",
+            "-vcodec", "libvpx", "-b:v", "1000k",
+            "-deadline", "realtime", "-cpu-used", "8",
+            "-acodec", "libvorbis",
+            ],
+        'normal': [
+            "-f", "webm",
+            "-vcodec", "libvpx", "-b:v", "2000k",
+            "-acodec", "libvorbis",
+            ],
+        'final': [
+            "-f", "webm",
+            "-vcodec", "libvpx", "-b:v", "4000k",
+            "-deadline", "good", "-cpu-used", "0",
+            # Token partitions are encoded by parallel threads.
+            "-slices", "4",
+            "-auto-alt-ref", "1", "-lag-in-frames", "16",
+            "-acodec", "libvorbis", "-qscale:a", "5",
+            ],
+        },
+    'mp4': {
+        'draft': [
+            "-f", "mp4",
+            "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+            "-crf", "28", "-preset", "ultrafast",
+            "-acodec", "aac", "-b:a", "128k",
+            ],
+        'normal': [
+            "-f", "mp4",
+            "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+            "-crf", "23", "-preset", "medium",
+            "-acodec", "aac", "-b:a", "160k",
+            ],
+        'final': [
+            "-f", "mp4",
+            "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+            "-crf", "20", "-preset", "slow",
+            "-acodec", "aac", "-b:a", "192k",
+            ],
+        },
+    # A playlist and MPEG-TS segments written next to it.
+    'm3u8': {
+        'draft': [
+            "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+            "-crf", "28", "-preset", "veryfast",
+            "-acodec", "aac", "-b:a", "128k",
+            ] + HLS_ARGS,
+        'normal': [
+            "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+            "-crf", "23", "-preset", "medium",
+            "-acodec", "aac", "-b:a", "160k",
+            ] + HLS_ARGS,
+        'final': [
+            "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+            "-crf", "20", "-preset", "slow",
+            "-acodec", "aac", "-b:a", "192k",
+            ] + HLS_ARGS,
+        },
+    # VP9 in constant quality mode. row-mt and tile-columns let libvpx
+    # use several threads on the same frame.
+    'vp9.webm': {
+        'draft': [
+            "-f", "webm",
+            "-vcodec", "libvpx-vp9", "-crf", "40", "-b:v", "0",
+            "-deadline", "realtime", "-cpu-used", "8",
+            "-row-mt", "1", "-tile-columns", "2",
+            "-acodec", "libopus", "-b:a", "96k",
+            ],
+        'normal': [
+            "-f", "webm",
+            "-vcodec", "libvpx-vp9", "-crf", "32", "-b:v", "0",
+            "-deadline", "good", "-cpu-used", "2",
+            "-row-mt", "1", "-tile-columns", "2",
+            "-acodec", "libopus", "-b:a", "128k",
+            ],
+        'final': [
+            "-f", "webm",
+            "-vcodec", "libvpx-vp9", "-crf", "28", "-b:v", "0",
+            "-deadline", "good", "-cpu-used", "1",
+            "-row-mt", "1", "-tile-columns", "1",
+            "-auto-alt-ref", "1", "-lag-in-frames", "25",
+            "-acodec", "libopus", "-b:a", "160k",
+            ],
+        },
+    # Low latency, high bandwidth for local pipe.
+    'pipe': [
+        "-f", "matroska",
+        "-vcodec", "rawvideo", # I don't use "copy" because filters may apply.
+        "-acodec", "pcm_s16le", "-ac", "2", "-ar", "44100",
+        ],
+    }
+
+# Muxers that seek back to finish a file are told to write fragments
+# instead when the output is a pipe or a socket. See get_stream_format().
+STREAM_ARGS = {
+    'mp4': ["-movflags", "frag_keyframe+empty_moov+default_base_moof"],
+    'mov': ["-movflags", "frag_keyframe+empty_moov+default_base_moof"],
+    }
+#}}}
+
+
+def get_stream_format(format):                   #{{{1
+    """Return format, fragmented if its muxer needs it for streaming.
+
+    Raises ValueError for muxers that cannot write to a pipe at all.
+    """
+    muxer = None
+    for n, option in enumerate(format[:-1]):
+        if option == "-f":
+            muxer = format[n+1]
+    if muxer in ("avi", "hls"):
+        raise ValueError("The {} format cannot be streamed.".format(muxer))
+    return list(format) + STREAM_ARGS.get(muxer, [])
+
+
+def get_segment_format(format):                  #{{{1
+    """Return format without the muxer and its options.
+
+    This leaves the codecs and their settings, for the parts of a movie
+    written in a container of their own, such as the matroska segments
+    of caches, before they are joined in format.
+    """
+    args = []
+    skip = False
+    for arg in format:
+        if skip:
+            skip = False
+        elif arg == "-f" or arg.startswith("-hls_"):
+            skip = True
+        else:
+            args.append(arg)
+    return args
+
+
+class FormatRegistry():                          #{{{1
+    """The output formats, by file extension and by tier.
+
+    A format is the list of ffmpeg arguments describing an output, from
+    the container to the codecs and their settings. Every format has a
+    list for each of TIERS. get_output_format() returns the format of a
+    file name in the current tier, self.tier.
+
+    Formats are added and overridden with update() and load().
+    """
+
+    def __init__(self, formats=DEFAULT_FORMATS, tier="normal"):
+        self.logger = logging.getLogger(__name__+".FormatRegistry")
+        self.formats = {}
+        self.tier = tier
+        self.update(formats)
+
+    def __repr__(self):
+        return "<FormatRegistry({}), formats={}>".format(
+            self.tier, sorted(self.formats)
+            )
+
+    def __contains__(self, key):
+        return key in self.formats
+
+    @staticmethod
+    def check(formats):
+        """Check and canonicalize formats.
+
+        formats maps keys to a format list, or to a mapping of tiers to
+        format lists. Raises TypeError or KeyError on invalid data.
+        """
+        if not isinstance(formats, dict):
+            raise TypeError("Formats must be a mapping of keys to formats.")
+        sane = {}
+        for key, value in formats.items():
+            if isinstance(value, list):
+                value = {tier: value for tier in TIERS}
+            if not isinstance(value, dict):
+                raise TypeError(
+                    "Format {} must be a list or a mapping of tiers to "
+                    "lists.".format(key)
+                    )
+            if not set(value) <= set(TIERS):
+                raise KeyError(
+                    "Valid tiers of format {} are: {}.".format(key, TIERS)
+                    )
+            for tier, args in value.items():
+                if (not isinstance(args, list) or
+                    not all(isinstance(arg, (str, int, float))
+                            for arg in args)):
+                    raise TypeError(
+                        "Format {} {} must be a list of arguments.".format(
+                            key, tier
+                            )
+                        )
+            sane[str(key)] = {
+                tier: [str(arg) for arg in args]
+                for tier, args in value.items()
+                }
+        return sane
+
+    def update(self, formats):
+        """Add or override formats.
+
+        See check() for the accepted data. Tiers left out are kept from
+        the format being overridden, or else copied from the normal
+        tier.
+        """
+        for key, tiers in self.check(formats).items():
+            merged = dict(self.formats.get(key, {}))
+            merged.update(tiers)
+            if 'normal' not in merged:
+                raise KeyError("Format {} has no normal tier.".format(key))
+            for tier in TIERS:
+                merged.setdefault(tier, merged['normal'])
+            self.formats[key] = merged
+            self.logger.debug("Format {}: {}.".format(key, merged))
+        return self
+
+    def load(self, filename):
+        """Add or override formats with those of a YAML file."""
+        with open(filename) as f:
+            formats = yaml.safe_load(f)
+        if formats is not None:
+            self.update(formats)
+        return self
+
+    def get(self, key, tier=None):
+        """Return a copy of the format list of key in tier."""
+        tier = tier or self.tier
+        if tier not in TIERS:
+            raise KeyError("Valid tiers are: {}.".format(TIERS))
+        return list(self.formats[key][tier])
+
+    def get_key(self, filename):
+        """Return the key of the format of a file name."""
+        parts = os.path.basename(filename).split('.')
+        if len(parts) > 2 and ".".join(parts[-2:]) in self.formats:
+            return ".".join(parts[-2:])
+        return parts[-1]
+
+    def get_output_format(self, filename, tier=None):
+        """Return the format list of a file name, see get()."""
+        return self.get(self.get_key(filename), tier)
+
+
+def load_formats_file(filename=None):           #{{{1
+    """Add the formats of FORMATS_FILE to FORMATS, once.
+
+    This is left to the programs using Vid, before they read projects,
+    so that a broken file doesn't make vid impossible to import. Errors
+    are logged with the name of the file and the formats of the file are
+    ignored.
+
+    Returns True if the file was loaded by this call.
+    """
+    logger = logging.getLogger(__name__+".load_formats_file")
+    filename = filename or FORMATS_FILE
+    if filename in _LOADED or not os.path.isfile(filename):
+        return False
+    _LOADED.append(filename)
+    # Formats are checked on a copy, so that FORMATS is left alone if
+    # the file is not valid.
+    registry = FormatRegistry(FORMATS.formats, FORMATS.tier)
+    try:
+        registry.load(filename)
+    except (OSError, yaml.YAMLError, TypeError, KeyError) as err:
+        logger.error("Ignoring formats file {}: {}".format(filename, err))
+        return False
+    FORMATS.formats = registry.formats
+    return True
+
+
+# The registry used by every module. See load_formats_file().
+FORMATS = FormatRegistry()
+# The formats files added to FORMATS.
+_LOADED = []
@@ -0,0 +1,355 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# manifest.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+# Imports                                        {{{1
+import os
+import json
+import glob
+import shutil
+import os.path
+import hashlib
+import logging
+
+from .formats import FORMATS, get_segment_format
+from .cache import ShotCache, get_video_encoder
+
+
+# Global variables                               {{{1
+MANIFEST_SUFFIX = ".vid.json"
+MANIFEST_VERSION = 1
+JOURNAL_SUFFIX = ".vid-journal.json"
+PARTS_SUFFIX = ".parts"
+PASSLOG_SUFFIX = ".vid-pass"
+# Encoders supporting two-pass encoding, and the arguments making their
+# first pass faster. x264 already runs a fast first pass by itself, and
+# must keep the frame type decisions of the first pass.
+TWO_PASS_ENCODERS = {
+    'libx264': [],
+    'libvpx': ["-cpu-used", "4"],
+    'libvpx-vp9': ["-cpu-used", "4"],
+    }
+# These options are replaced in the formats of both passes.
+RATE_OPTIONS = {"-b:v", "-crf", "-qscale:v", "-pass", "-passlogfile"}
+#}}}
+
+
+class RenderManifest():                          #{{{1
+    """What was rendered to an output file, saved next to it.
+
+    For every shot of the movie, the manifest gives a key identifying
+    the shot rendered in the format of the output, the time range it
+    covers in the output and, when the output was joined from cached
+    shots, the file of the shot.
+
+    The key is computed like ShotCache keys, but it is not always the
+    key of that file: engines may cache shots in a lossless format
+    instead, see CachedRender._segment_format(). Keys are only compared
+    with each other by diff().
+
+    Comparing the manifest with a new version of the movie tells which
+    shots may be reused, at the same place or moved in time, and which
+    must be rendered again. See diff().
+    """
+
+    def __init__(self, output, format=None):
+        self.logger = logging.getLogger(__name__+".RenderManifest")
+        self.output = output
+        self.filename = output + MANIFEST_SUFFIX
+        if format is None:
+            format = FORMATS.get_output_format(output)
+        self.format = format
+        self.shots = []
+
+    def __repr__(self):
+        return "<RenderManifest({}), shots={}>".format(
+            self.output, len(self.shots)
+            )
+
+    @classmethod
+    def load(cls, output, format=None):
+        """Return the manifest of output.
+
+        The manifest is empty if the output has none, or if the output
+        was rendered in another format.
+        """
+        manifest = cls(output, format)
+        try:
+            with open(manifest.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return manifest
+        if (data.get('version') == MANIFEST_VERSION and
+            data.get('format') == manifest.format):
+            manifest.shots = data['shots']
+        return manifest
+
+    def save(self):
+        """Atomically write the manifest file."""
+        data = {
+            'version': MANIFEST_VERSION,
+            'output': os.path.basename(self.output),
+            'format': self.format,
+            'shots': self.shots,
+            }
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.filename)
+        self.logger.debug("Saved {}.".format(self.filename))
+
+    def get_entries(self, shots, segments=None):
+        """Return the manifest entries describing shots.
+
+        Segments is the list of the files of the shots, if any.
+        """
+        entries = []
+        start = 0
+        for n, shot in enumerate(shots):
+            end = start + shot.get_duration()
+            entries.append({
+                'key': ShotCache.get_key(shot, self.format),
+                'number': shot.number,
+                'seek': shot.seek,
+                'dur': shot.dur,
+                'start': start,
+                'end': end,
+                'segment': None if segments is None else segments[n],
+                })
+            start = end
+        return entries
+
+    def update(self, shots, segments=None):
+        self.shots = self.get_entries(shots, segments)
+
+    def get_segments(self):
+        """Return the files of the shots that are still there, by key."""
+        return {
+            entry['key']: entry['segment'] for entry in self.shots
+            if entry['segment'] is not None and
+            os.path.isfile(entry['segment'])
+            }
+
+    def diff(self, shots):
+        """Compare shots with the manifest.
+
+        Returns a dict giving the number of "unchanged" shots, at the
+        same place in the output, "shifted" shots, found elsewhere in
+        the output, and "changed" shots, which must be rendered. Shots
+        are reused from their files only: the shots of an output that
+        was not joined from files, or whose file was deleted, are
+        changed. See get_segments().
+        """
+        segments = self.get_segments()
+        starts = {}
+        for entry in self.shots:
+            if entry['key'] in segments:
+                starts.setdefault(entry['key'], set()).add(entry['start'])
+        counts = {'unchanged': 0, 'shifted': 0, 'changed': 0}
+        for entry in self.get_entries(shots):
+            if entry['key'] not in starts:
+                counts['changed'] += 1
+            elif entry['start'] in starts[entry['key']]:
+                counts['unchanged'] += 1
+            else:
+                counts['shifted'] += 1
+        return counts
+
+
+class RenderJournal():                           #{{{1
+    """The segments of an output rendered so far.
+
+    Segments are written to a directory next to the output, named after
+    it with a ".parts" suffix. The journal is saved after every segment,
+    so an interrupted render may be resumed from the last segment that
+    was finished. Each segment is identified by a key computed by the
+    render; a segment whose key changed is rendered again.
+    """
+
+    def __init__(self, output, format=None):
+        self.logger = logging.getLogger(__name__+".RenderJournal")
+        self.output = output
+        self.filename = output + JOURNAL_SUFFIX
+        self.directory = output + PARTS_SUFFIX
+        if format is None:
+            format = FORMATS.get_output_format(output)
+        self.format = format
+        # Keys to segment file names.
+        self.segments = {}
+
+    def __repr__(self):
+        return "<RenderJournal({}), segments={}>".format(
+            self.output, len(self.segments)
+            )
+
+    @classmethod
+    def load(cls, output, format=None):
+        """Return the journal of output, empty if there is none."""
+        journal = cls(output, format)
+        try:
+            with open(journal.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return journal
+        if data.get('format') == journal.format:
+            journal.segments = data['segments']
+        journal.logger.debug("Loaded {}.".format(journal))
+        return journal
+
+    def save(self):
+        """Atomically write the journal file."""
+        data = {'format': self.format, 'segments': self.segments}
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.filename)
+
+    def get(self, key):
+        """Return the file of a finished segment, or None."""
+        name = self.segments.get(key)
+        if name is None:
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def get_path(self, key):
+        """Return the file name for the segment."""
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, key + ".mkv")
+
+    def add(self, key, path):
+        """Record a finished segment."""
+        self.segments[key] = os.path.basename(path)
+        self.save()
+
+    def remove(self):
+        """Delete the journal and the segments."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+        self.segments = {}
+
+
+def _remove_options(format, options):            #{{{1
+    """Return a copy of format without options and their values."""
+    args = []
+    skip = False
+    for arg in format:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        else:
+            args.append(arg)
+    return args
+
+
+class PassLog():                                 #{{{1
+    """The statistics of the first pass of a two-pass encode of an output.
+
+    The statistics are written next to the output, named after it with
+    a ".vid-pass" suffix. They describe the movie, not the bitrate: a
+    key computed from the entries of the render manifest of the movie
+    tells whether they can be reused by a second pass at any bitrate.
+    See get_key().
+    """
+
+    def __init__(self, output):
+        self.logger = logging.getLogger(__name__+".PassLog")
+        self.output = output
+        # ffmpeg appends the stream index and ".log" to this prefix.
+        self.prefix = output + PASSLOG_SUFFIX
+        self.filename = self.prefix + ".json"
+
+    def __repr__(self):
+        return "<PassLog({})>".format(self.output)
+
+    @staticmethod
+    def accepts(format):
+        """Return True if the video encoder of format has two passes."""
+        return get_video_encoder(format) in TWO_PASS_ENCODERS
+
+    @staticmethod
+    def get_single_format(format, bitrate):
+        """Return format encoding in a single pass at bitrate.
+
+        This is for the encoders that have no two-pass mode, see
+        accepts().
+        """
+        return _remove_options(format, RATE_OPTIONS) + ["-b:v", str(bitrate)]
+
+    def get_formats(self, format, bitrate):
+        """Return the formats of the first and of the second pass.
+
+        The first pass writes no audio and should be written to
+        os.devnull. Raises ValueError if the encoder of format has a
+        single pass.
+        """
+        encoder = get_video_encoder(format)
+        if encoder not in TWO_PASS_ENCODERS:
+            raise ValueError(
+                "The {} encoder has no two-pass mode.".format(encoder)
+                )
+        format = _remove_options(format, RATE_OPTIONS)
+        rate = ["-b:v", str(bitrate), "-passlogfile", self.prefix]
+        speed = TWO_PASS_ENCODERS[encoder]
+        # The options of the muxer go with it.
+        first = _remove_options(get_segment_format(format), set(speed[::2]))
+        first += speed + rate + ["-pass", "1", "-an", "-f", "null"]
+        second = format + rate + ["-pass", "2"]
+        return first, second
+
+    def get_key(self, shots, format, vf=(), height=None):
+        """Return the key of the first pass of shots in format.
+
+        vf are the multiplexer video filters and height is the height
+        to which the output is scaled, if any.
+        """
+        format = _remove_options(format, RATE_OPTIONS)
+        manifest = RenderManifest(self.output, format)
+        data = [
+            [entry['key'] for entry in manifest.get_entries(shots)],
+            format, vf, height,
+            ]
+        return hashlib.sha1(
+            json.dumps(data, sort_keys=True).encode()
+            ).hexdigest()
+
+    def is_valid(self, key):
+        """Return True if the statistics were saved with key."""
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        if data.get('key') != key:
+            return False
+        return bool(glob.glob(glob.escape(self.prefix) + "-*.log"))
+
+    def save(self, key):
+        """Atomically record the key of the statistics."""
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({'key': key}, f)
+        os.replace(tmp, self.filename)
+        self.logger.debug("Saved {}.".format(self.filename))
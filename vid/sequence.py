@@ -0,0 +1,170 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# sequence.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+
+
+# Imports                                        {{{1
+import os
+import json
+import os.path
+import hashlib
+import logging
+import tempfile
+import subprocess
+
+from .utils import Shot, Probe
+from .yaml import YAMLReader
+from .cache import ShotCache, LOSSLESS, SEGMENT_ARGS, CACHE_VERSION
+from .engines import FilterGraphRender
+
+
+# Global variables                               {{{1
+# The absolute names of the sequences being loaded, to detect a sequence
+# that includes itself.
+_LOADING = []
+#}}}
+
+
+def make_shot(args, kwargs, cache=None):         #{{{1
+    """Return a Shot or a Sequence from arguments given by YAMLReader.
+
+    See YAMLReader.get_shots_arguments().
+    """
+    if 'sequence' in kwargs:
+        kwargs = dict(kwargs)
+        return Sequence(kwargs.pop('sequence'), cache=cache, **kwargs)
+    return Shot(*args, **kwargs)
+
+
+class Sequence(Shot):                            #{{{1
+    """A movie described by another YAML file, used as a shot.
+
+    The sub-sequence is rendered once to a lossless file kept in a
+    ShotCache, then it is cut and filtered like any other shot. Its
+    cache key covers the shots of the sub-sequence, their footage, the
+    music and the multiplexer filters, so every parent timeline that
+    includes the same sequence reuses the same file until one of those
+    changes.
+
+    Unlike footage, a sequence is not deinterlaced: it already was.
+
+    The files attribute is the set of the absolute names of the YAML
+    file and of the sequences it includes, at any depth.
+    """
+
+    def __init__(self, filename, seek=0, dur=None, vf=None, af=None,
+                 silent=False, pattern=None, cache=None):
+        self.logger = logging.getLogger(__name__+".Sequence")
+        self.filename = filename
+        self.number = None
+        self.files = set()
+        self.cache = cache if cache is not None else ShotCache()
+        self.name = self._get_rendered(pattern)
+        self._probe = Probe.get(self.name)
+        self.cut(seek, dur)
+        self.process = None
+        self.v_stream = None
+        self.a_stream = None
+        self.silent = silent
+        self.showdata = False
+        self.vf = []
+        self.af = []
+        if vf is not None:
+            for filter in vf:
+                self.append_vf(filter[0], **filter[1])
+        if af is not None:
+            for filter in af:
+                self.append_af(filter[0], **filter[1])
+
+    def __repr__(self):
+        return "<Sequence({}), seek={}, dur={}>".format(
+            self.filename,
+            self.seek,
+            self.dur,
+            )
+
+    def _get_rendered(self, pattern=None):
+        """Return the name of the rendered file, rendering it if needed."""
+        path = os.path.abspath(self.filename)
+        if path in _LOADING:
+            raise ValueError(
+                "Sequence {} includes itself.".format(self.filename)
+                )
+        _LOADING.append(path)
+        try:
+            reader = YAMLReader()
+            data = reader.load(self.filename)
+            shots = [
+                make_shot(args, kwargs, self.cache)
+                for args, kwargs in reader.get_shots_arguments(pattern)
+                ]
+        finally:
+            _LOADING.remove(path)
+        self.files = {path}.union(
+            *(shot.files for shot in shots if isinstance(shot, Sequence))
+            )
+        key = self._get_key(data, shots)
+        rendered = self.cache.lookup(key)
+        with self.cache.lock:
+            if rendered is None:
+                self.cache.misses += 1
+            else:
+                self.cache.hits += 1
+        if rendered is None:
+            rendered = self.cache.get_path(key)
+            self._render(data, shots, rendered)
+        return rendered
+
+    @staticmethod
+    def _get_key(data, shots):
+        music = data.get('music')
+        if music is not None:
+            st = os.stat(music)
+            music = [os.path.abspath(music), st.st_size, st.st_mtime_ns]
+        identity = {
+            'version': CACHE_VERSION,
+            'shots': [ShotCache.get_key(shot, LOSSLESS) for shot in shots],
+            'music': music,
+            'multiplexer': data.get('multiplexer'),
+            }
+        data = json.dumps(identity, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def _render(self, data, shots, path):
+        self.logger.debug("Rendering {} to {}.".format(self.filename, path))
+        render = FilterGraphRender(shots, data.get('music'))
+        for filter in data.get('multiplexer', {}).get('vf', []):
+            render.append_vf(filter[0], **filter[1])
+        for filter in data.get('multiplexer', {}).get('af', []):
+            render.append_af(filter[0], **filter[1])
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cache.directory)
+        os.close(fd)
+        try:
+            render.write_to_files((tmp, LOSSLESS + SEGMENT_ARGS))
+            if render.process.wait() != 0:
+                raise subprocess.CalledProcessError(
+                    render.process.returncode, render.process.args,
+                    )
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
@@ -0,0 +1,93 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# bench_engines.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+"""Compare the render time of the engines.
+
+From the project's base directory, execute:
+    python -m vid.test.bench_engines [yaml_file] [-o output.ogv] [-n 3]
+
+Without a YAML file, a movie of short cuts of the test footage is
+rendered. Each engine renders the movie n times through "vid yaml" and
+the best time is reported.
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import os.path
+import argparse
+import tempfile
+import subprocess
+
+from ..engines import ENGINES
+
+
+workdir = os.path.abspath(os.path.dirname(__file__))
+script = os.path.join(workdir, "..", "..", "scripts", "vid")
+TEST_MOVIE = "movie:\n" + "".join(
+    "  - [54, {}, 0.5]\n".format(seek) for seek in (4, 2, 6, 1, 5, 3, 8, 7)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("file_name", nargs="?", default=None)
+    parser.add_argument("-o", "--output", default="bench.ogv")
+    parser.add_argument("-n", "--repeat", type=int, default=3)
+    options = parser.parse_args()
+    command = [sys.executable, script]
+    if not os.path.isfile(script):
+        command = [shutil.which("vid")]
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.path.join(workdir, "..", "..")
+    with tempfile.TemporaryDirectory() as tmpd:
+        if options.file_name is None:
+            cwd = workdir
+            file_name = os.path.join(tmpd, "movie.yaml")
+            with open(file_name, "w") as f:
+                f.write(TEST_MOVIE)
+        else:
+            cwd = os.path.dirname(os.path.abspath(options.file_name))
+            file_name = os.path.abspath(options.file_name)
+        output = os.path.join(tmpd, options.output)
+        for engine in ENGINES:
+            times = []
+            for i in range(options.repeat):
+                start_time = time.perf_counter()
+                subprocess.check_call(
+                    command + [
+                        "yaml", file_name, "-e", engine, "-o", output,
+                        ],
+                    cwd=cwd,
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    )
+                times.append(time.perf_counter() - start_time)
+            print("{:8} best {:7.2f}s, mean {:7.2f}s".format(
+                engine, min(times), sum(times) / len(times),
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_aio.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+import os
+import asyncio
+import logging
+import unittest
+import tempfile
+import subprocess
+import unittest.mock
+
+from .. import aio
+
+
+workdir = os.path.abspath(os.path.dirname(__file__))
+
+
+class AioTestCase(unittest.TestCase):
+
+    def test_copy(self):
+        logger = logging.getLogger(__name__+".test_copy")
+        logger.debug("Testing aio._copy()")
+
+        async def copy(data, **kwargs):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            r, w = os.pipe()
+            writer = await aio._open_writer(open(w, "wb", buffering=0))
+            written = await aio._copy(reader, writer, **kwargs)
+            writer.close()
+            # Let the event loop close the transport.
+            await asyncio.sleep(0.1)
+            with open(r, "rb") as f:
+                return written, f.read()
+
+        self.assertEqual(
+            asyncio.run(copy(b"YUV4MPEG2\nsome data")),
+            (19, b"YUV4MPEG2\nsome data"),
+            )
+        self.assertEqual(
+            asyncio.run(copy(b"YUV4MPEG2\nsome data", remove_header=True)),
+            (9, b"some data"),
+            )
+        self.assertEqual(
+            asyncio.run(copy(b"1234", silent=True)),
+            (4, b"\x00\x00\x00\x00"),
+            )
+
+        async def write_to_closed_pipe():
+            r, w = os.pipe()
+            writer = await aio._open_writer(open(w, "wb", buffering=0))
+            os.close(r)
+            await asyncio.sleep(0.1)
+            writer.write(b"some data")
+            try:
+                await writer.drain()
+            finally:
+                writer.close()
+
+        with self.assertRaises(ConnectionResetError):
+            asyncio.run(write_to_closed_pipe())
+
+    def test_check(self):
+        logger = logging.getLogger(__name__+".test_check")
+        logger.debug("Testing AsyncRender._check()")
+        render = aio.AsyncRender("movie: []", ["test.ogv"])
+        process = unittest.mock.Mock(pid=123, returncode=0)
+        render.args[123] = ["ffmpeg", "-i", "missing.mov"]
+        render._check(process)
+        with tempfile.TemporaryDirectory() as d, \
+             unittest.mock.patch.object(aio.utils, "logdir", d):
+            with open(os.path.join(d, "p123.log"), "w") as f:
+                f.write("start\n" * 50 + "missing.mov: No such file\n")
+            process.returncode = 1
+            with self.assertLogs("vid.aio", logging.ERROR) as cm, \
+                 self.assertRaises(subprocess.CalledProcessError) as err:
+                render._check(process)
+        # The error of ffmpeg is logged, not the whole log.
+        self.assertIn("No such file", cm.output[0])
+        self.assertEqual(cm.output[0].count("start"), aio.LOG_LINES - 1)
+        self.assertEqual(err.exception.cmd, render.args[123])
+
+    def test_render(self):
+        logger = logging.getLogger(__name__+".test_render")
+        logger.debug("Testing aio.render()")
+        os.chdir(workdir)
+        progress = []
+
+        async def render_both(file1, file2):
+            await asyncio.gather(
+                aio.render("movie:\n  - [54, 0, 1]", [file1]),
+                aio.render(
+                    "movie:\n  - [54, 1, 1]\n  - [54, 3, 1]",
+                    [file2],
+                    progress=lambda t, l: progress.append((t, l)),
+                    ),
+                )
+
+        with tempfile.TemporaryDirectory() as tmpd:
+            file1 = os.path.join(tmpd, "test1.ogv")
+            file2 = os.path.join(tmpd, "test2.ogv")
+            asyncio.run(render_both(file1, file2))
+            self.assertTrue(os.path.isfile(file1))
+            self.assertTrue(os.path.isfile(file2))
+            self.assertTrue(progress)
@@ -0,0 +1,124 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_batch.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+import os.path
+import logging
+import unittest
+import tempfile
+import unittest.mock
+
+from .. import *
+from .. import utils
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def test_batchqueue(self):
+        logger = logging.getLogger(__name__+".test_batchqueue")
+        logger.debug("Testing BatchQueue")
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "queue.json")
+            q = BatchQueue(filename)
+            job1 = q.add(os.path.join(d, "a.yaml"), ["a.ogv"])
+            job2 = q.add(os.path.join(d, "b.yaml"), ["b.ogv", "b.webm"])
+            # Adding the same job twice returns the queued one.
+            self.assertIs(q.add(os.path.join(d, "a.yaml"), ["a.ogv"]), job1)
+            self.assertEqual(len(q.jobs), 2)
+            self.assertEqual(job2.get_cpus(), 3)
+            self.assertEqual(
+                job2.get_output_paths(),
+                {os.path.join(d, "b.ogv"), os.path.join(d, "b.webm")},
+                )
+            q.mark(job1, BatchJob.DONE)
+            q.mark(job2, BatchJob.RUNNING)
+
+            # A restarted batch skips finished jobs and retries the job
+            # that was running.
+            q = BatchQueue(filename)
+            self.assertEqual(len(q.jobs), 2)
+            pending = q.get_pending()
+            self.assertEqual(len(pending), 1)
+            self.assertEqual(pending[0].key, job2.key)
+            self.assertEqual(pending[0].status, BatchJob.PENDING)
+
+    def test_batchscheduler(self):
+        logger = logging.getLogger(__name__+".test_batchscheduler")
+        logger.debug("Testing BatchScheduler")
+        with tempfile.TemporaryDirectory() as d, \
+             unittest.mock.patch.object(utils, "logdir", d):
+            q = BatchQueue(os.path.join(d, "queue.json"))
+            for name in "abcd":
+                q.add(os.path.join(d, name+".yaml"), [name+".ogv"])
+            # Two jobs writing the same file never run together.
+            q.add(os.path.join(d, "e.yaml"), ["a.ogv"])
+            finished = []
+            scheduler = BatchScheduler(
+                q, cpus=4, command=["true"], callback=finished.append,
+                )
+            self.assertTrue(scheduler._can_start(q.jobs[0]))
+            scheduler.running.append(q.jobs[0])
+            self.assertTrue(scheduler._can_start(q.jobs[1]))
+            self.assertFalse(scheduler._can_start(q.jobs[4]))
+            scheduler.running.append(q.jobs[1])
+            # Over the cpus budget.
+            self.assertFalse(scheduler._can_start(q.jobs[2]))
+            scheduler.running = []
+            scheduler.start()
+            scheduler.join(timeout=10)
+            self.assertTrue(scheduler.finished.is_set())
+            self.assertEqual(len(finished), 5)
+            self.assertEqual(q.get_pending(), [])
+            for line in scheduler.report():
+                self.assertTrue(line.startswith(BatchJob.DONE))
+
+            # Job logs are kept in the log directory.
+            self.assertTrue(os.path.isfile(os.path.join(d, "batch0.log")))
+            with self.assertRaises(ValueError):
+                BatchScheduler(q, cpus=0)
+
+            # Failed jobs are retried by the next batch.
+            q = BatchQueue(os.path.join(d, "failed.json"))
+            q.add(os.path.join(d, "a.yaml"), ["a.ogv"])
+            scheduler = BatchScheduler(q, command=["false"])
+            scheduler.start()
+            scheduler.join(timeout=10)
+            self.assertEqual(q.jobs[0].status, BatchJob.FAILED)
+            self.assertEqual(q.jobs[0].returncode, 1)
+            self.assertEqual(len(q.get_pending()), 1)
+
+            # A job that can't be started fails, and the batch goes on.
+            q = BatchQueue(os.path.join(d, "missing.json"))
+            q.add(os.path.join(d, "a.yaml"), ["a.ogv"])
+            q.add(os.path.join(d, "b.yaml"), ["b.ogv"])
+            finished = []
+            scheduler = BatchScheduler(
+                q, command=[os.path.join(d, "missing")],
+                callback=finished.append,
+                )
+            scheduler.start()
+            scheduler.join(timeout=10)
+            self.assertTrue(scheduler.finished.is_set())
+            self.assertEqual(len(finished), 2)
+            for job in BatchQueue(q.filename).jobs:
+                self.assertEqual(job.status, BatchJob.FAILED)
+                self.assertIn("missing", job.error)
+            self.assertIn("missing", scheduler.report()[0])
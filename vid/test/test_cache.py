@@ -0,0 +1,232 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_cache.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+
+
+import os
+import logging
+import unittest
+import tempfile
+import unittest.mock
+
+from .. import *
+
+
+workdir = os.path.abspath(os.path.dirname(__file__))
+
+
+class ShotCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(workdir)
+
+    def test_get_key(self):
+        logger = logging.getLogger(__name__+".test_get_key")
+        logger.debug("Testing ShotCache.get_key()")
+        webm = OUTPUT_FORMATS['webm']
+        key = ShotCache.get_key(Shot(54).cut(1, 2), webm)
+        self.assertEqual(key, ShotCache.get_key(Shot(54).cut(1, 2), webm))
+        # Any change to the cut, the filters or the format is another key.
+        self.assertNotEqual(key, ShotCache.get_key(Shot(54).cut(1, 3), webm))
+        self.assertNotEqual(key, ShotCache.get_key(
+            Shot(54).cut(1, 2).append_vf("hflip"), webm
+            ))
+        self.assertNotEqual(key, ShotCache.get_key(
+            Shot(54).cut(1, 2).generate_silence(), webm
+            ))
+        self.assertNotEqual(key, ShotCache.get_key(
+            Shot(54).cut(1, 2), OUTPUT_FORMATS['ogv']
+            ))
+
+    def test_evict(self):
+        logger = logging.getLogger(__name__+".test_evict")
+        logger.debug("Testing ShotCache.evict()")
+        with tempfile.TemporaryDirectory() as d:
+            cache = ShotCache(d, max_size=250)
+            for n, key in enumerate("abcd"):
+                with open(cache.get_path(key), "wb") as f:
+                    f.write(b"\x00" * 100)
+                os.utime(cache.get_path(key), (n, n))
+            # Using an entry makes it the most recently used.
+            self.assertEqual(cache.lookup("a"), cache.get_path("a"))
+            self.assertIsNone(cache.lookup("e"))
+            self.assertEqual(cache.get_size(), 400)
+            size = cache.evict(keep={cache.get_path("b")})
+            self.assertEqual(size, 200)
+            self.assertEqual(
+                sorted(os.listdir(d)), ["a.mkv", "b.mkv"],
+                )
+
+    def test_get_all(self):
+        logger = logging.getLogger(__name__+".test_get_all")
+        logger.debug("Testing ShotCache.get_all()")
+        rendered = []
+
+        class Cache(ShotCache):
+            @staticmethod
+            def get_key(shot, format):
+                return shot
+
+            def _render(self, shot, format, path):
+                rendered.append(shot)
+                open(path, "w").close()
+
+        with tempfile.TemporaryDirectory() as d:
+            cache = Cache(d, max_size=0)
+            paths = cache.get_all(["a", "b", "a", "a"], [], jobs=4)
+            # A repeated shot is rendered once, for all its places.
+            self.assertEqual(sorted(rendered), ["a", "b"])
+            self.assertEqual(paths[0], paths[2])
+            self.assertEqual(paths[0], paths[3])
+            self.assertNotEqual(paths[0], paths[1])
+            self.assertEqual((cache.misses, cache.hits), (2, 2))
+
+    def test_render_segment_format(self):
+        logger = logging.getLogger(__name__+".test_render_segment_format")
+        logger.debug("Testing the format of the shots of a playlist")
+        shot = unittest.mock.Mock(af=[], silent=False)
+        shot._input_args.return_value = ["ffmpeg", "-i", "input.mp4"]
+        shot._cut_args.return_value = ["-t", "2"]
+        shot._format_vf.return_value = []
+        m3u8 = FORMATS.get("m3u8")
+        self.assertIn("-hls_time", m3u8)
+        with tempfile.TemporaryDirectory() as d, unittest.mock.patch(
+                "subprocess.Popen") as popen:
+            popen.return_value.wait.return_value = 0
+            cache = ShotCache(d, max_size=0)
+            cache._render(shot, m3u8, cache.get_path("a"))
+        args = popen.call_args[0][0]
+        # Shots are written as matroska, the playlist muxer is left out.
+        self.assertFalse([arg for arg in args if arg.startswith("-hls_")])
+        self.assertEqual(args[args.index("-f") + 1], "matroska")
+        self.assertEqual(args.count("-f"), 1)
+        self.assertIn("libx264", args)
+
+    def test_get_cache_size(self):
+        logger = logging.getLogger(__name__+".test_get_cache_size")
+        logger.debug("Testing get_cache_size()")
+        with unittest.mock.patch.dict(os.environ, {'VID_CACHE_SIZE': "2"}):
+            self.assertEqual(get_cache_size(), 2 * 1024 * 1024)
+            with tempfile.TemporaryDirectory() as d:
+                self.assertEqual(ShotCache(d).max_size, 2 * 1024 * 1024)
+        for value in ("4G", "-1"):
+            with unittest.mock.patch.dict(
+                    os.environ, {'VID_CACHE_SIZE': value}):
+                with self.assertRaises(ValueError):
+                    get_cache_size()
+
+    def test_smart_get_plan(self):
+        logger = logging.getLogger(__name__+".test_smart_get_plan")
+        logger.debug("Testing SmartShotCache.get_plan()")
+        probe = unittest.mock.Mock()
+        probe.get_duration.return_value = 100.0
+        probe.get_codec.return_value = "vp8"
+        probe.get_keyframes.return_value = [0.0, 10.0, 20.0, 30.0, 40.0]
+        shot = unittest.mock.Mock(
+            vf=[("yadif", {})], seek=5, dur=30, shots=None, _probe=probe,
+            )
+        webm = OUTPUT_FORMATS['webm']
+        # Complete GOPs are copied, the cut GOPs encoded.
+        self.assertEqual(
+            SmartShotCache.get_plan(shot, webm),
+            [(5, 10.0, False), (10.0, 30.0, True), (30.0, 35, False)],
+            )
+        # A cut ending on a keyframe is copied whole.
+        shot.seek = 10
+        self.assertEqual(
+            SmartShotCache.get_plan(shot, webm), [(10.0, 40.0, True)],
+            )
+        # Other codecs, video filters and short cuts are encoded whole.
+        self.assertIsNone(
+            SmartShotCache.get_plan(shot, OUTPUT_FORMATS['ogv'])
+            )
+        shot.dur = 5
+        self.assertIsNone(SmartShotCache.get_plan(shot, webm))
+        shot.dur = None
+        shot.vf = [("yadif", {}), ("hflip", {})]
+        self.assertIsNone(SmartShotCache.get_plan(shot, webm))
+        self.assertEqual(get_video_codec(OUTPUT_FORMATS['avi']), "h264")
+        # Copied and encoded parts must have the same properties.
+        shot.vf = [("yadif", {})]
+        probe.get_codec.return_value = "h264"
+        probe.get_stream.return_value = {
+            'width': 1920, 'height': 1080, 'pix_fmt': "yuv422p",
+            'profile': "High 4:2:2",
+            }
+        mp4 = FORMATS.get("mp4")
+        self.assertEqual(get_stream_properties(mp4), {'pix_fmt': "yuv420p"})
+        self.assertIsNone(SmartShotCache.get_plan(shot, mp4))
+        probe.get_stream.return_value['pix_fmt'] = "yuv420p"
+        self.assertIsNotNone(SmartShotCache.get_plan(shot, mp4))
+        self.assertIsNotNone(
+            SmartShotCache.get_plan(shot, mp4 + ["-s", "1920x1080"])
+            )
+        self.assertIsNone(SmartShotCache.get_plan(shot, mp4 + ["-s", "hd720"]))
+        # Copied shots are not deinterlaced, and neither is their key.
+        shot.configure_mock(name=__file__, af=[], silent=False)
+        self.assertEqual(
+            SmartShotCache.get_key(shot, mp4),
+            ShotCache.get_key(shot, ["smart"] + mp4, vf=[]),
+            )
+        shot.vf = [("yadif", {}), ("hflip", {})]
+        self.assertEqual(
+            SmartShotCache.get_key(shot, mp4),
+            ShotCache.get_key(shot, ["smart"] + mp4),
+            )
+
+
+class MusicCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(workdir)
+
+    def test_get_key(self):
+        logger = logging.getLogger(__name__+".test_get_key")
+        logger.debug("Testing MusicCache.get_key()")
+        music = "music/Anitek_-_Nightlife.mp3"
+        key = MusicCache.get_key(music)
+        self.assertEqual(key, MusicCache.get_key(os.path.abspath(music)))
+        self.assertNotEqual(key, ShotCache.get_key(Shot(54), RAW_AUDIO))
+        with tempfile.TemporaryDirectory() as d:
+            cache = MusicCache(d)
+            self.assertTrue(cache.get_path(key).endswith(".pcm"))
+
+    def test_decodedmusic(self):
+        logger = logging.getLogger(__name__+".test_decodedmusic")
+        logger.debug("Testing DecodedMusic.slices()")
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "music.pcm")
+            # Two seconds of music, each frame holding its second.
+            with open(path, "wb") as f:
+                f.write(b"\x00" * 4 * 44100 + b"\x01" * 4 * 44100)
+            music = DecodedMusic(path)
+            self.assertEqual(music.get_duration(), 2)
+            self.assertEqual(b"".join(music.slices()), music.map[:])
+            part = b"".join(music.slices(seek=0.5, dur=1))
+            self.assertEqual(part, b"\x00" * 2 * 44100 + b"\x01" * 2 * 44100)
+            # Seeking past the end yields nothing.
+            self.assertEqual(list(music.slices(seek=3)), [])
+            # Loops start over from seek.
+            loop = music.slices(seek=1.5, loop=True, size=4 * 44100)
+            self.assertEqual(
+                [len(next(loop)) for i in range(3)], [2 * 44100] * 3,
+                )
@@ -0,0 +1,246 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_engines.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+import os
+import logging
+import unittest
+import tempfile
+
+from .. import *
+from ..engines import plan_inputs
+
+
+workdir = os.path.abspath(os.path.dirname(__file__))
+
+
+class EnginesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(workdir)
+
+    def test_filtergraphrender(self):
+        logger = logging.getLogger(__name__+".test_filtergraphrender")
+        logger.debug("Testing FilterGraphRender")
+        shots = [
+            Shot(54).cut(1, 1),
+            Shot(54).cut(4, 1).generate_silence(),
+            Shot(54).cut(0, 1),  # Goes back in time, needs a new input.
+            Shot(54).cut(6, 1),
+            ]
+        inputs, assignments = plan_inputs(shots)
+        self.assertEqual(len(inputs), 2)
+        self.assertEqual(inputs[0].shots, [shots[0], shots[1], shots[3]])
+        self.assertEqual(inputs[1].shots, [shots[2]])
+        self.assertEqual(
+            assignments, [inputs[0], inputs[0], inputs[1], inputs[0]]
+            )
+
+        render = FilterGraphRender(shots, "music/Anitek_-_Nightlife.mp3")
+        render.append_vf("showdata", length=4)
+        args = render._input_args()
+        self.assertEqual(args.count("-i"), 3)
+        self.assertEqual(args[args.index("-ss") + 1], "1")
+        graph, labels = render._filtergraph(2)
+        self.assertIn("[0:v]split=3[i0v0][i0v1][i0v2]", graph)
+        self.assertIn(
+            "[i0a1]atrim=start=3:end=4,asetpts=PTS-STARTPTS,volume=0[a1]",
+            graph,
+            )
+        self.assertIn("[i0v2]trim=start=5:end=6,setpts=PTS-STARTPTS", graph)
+        self.assertIn("concat=n=4:v=1:a=1[vcat][acat]", graph)
+        self.assertIn("[acat][2:a]amix=duration=first[amix]", graph)
+        self.assertEqual(
+            labels, [("[vout0]", "[aout0]"), ("[vout1]", "[aout1]")]
+            )
+        graph, labels = render._filtergraph(2, [None, 360])
+        self.assertIn("[vout1]scale=-2:360[vscale1]", graph)
+        self.assertEqual(labels[1], ("[vscale1]", "[aout1]"))
+
+        # Render it.
+        with tempfile.TemporaryDirectory() as tmpd:
+            file1 = os.path.join(tmpd, "test.ogv")
+            file2 = os.path.join(tmpd, "test.webm")
+            render.write_to_files(file1, file2)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertEqual(Probe(file1).get_format(), "ogg")
+            self.assertAlmostEqual(Probe(file2).get_duration(), 4, delta=0.1)
+
+    def test_concatdemuxerrender(self):
+        logger = logging.getLogger(__name__+".test_concatdemuxerrender")
+        logger.debug("Testing ConcatDemuxerRender")
+        shots = [Shot(54).cut(1, 1), Shot(54).cut(0, 2)]
+        self.assertTrue(ConcatDemuxerRender.accepts(shots))
+        self.assertFalse(ConcatDemuxerRender.accepts(
+            shots + [Shot(54).cut(4, 1).generate_silence()]
+            ))
+        self.assertFalse(ConcatDemuxerRender.accepts(
+            shots + [Shot(54).cut(4, 1).append_vf("hflip")]
+            ))
+        with self.assertRaises(ValueError):
+            ConcatDemuxerRender([Shot(54).cut(4, 1).generate_silence()])
+
+        render = ConcatDemuxerRender(shots, "music/Anitek_-_Nightlife.mp3")
+        script = render.get_script().splitlines()
+        name = os.path.abspath(shots[0].name)
+        self.assertEqual(script, [
+            "ffconcat version 1.0",
+            "file '{}'".format(name), "inpoint 1", "outpoint 2",
+            "file '{}'".format(name), "outpoint 2",
+            ])
+        args = render._input_args()
+        self.assertEqual(args[args.index("-f") + 1], "concat")
+        with open(render.script) as f:
+            self.assertEqual(f.read(), render.get_script())
+        graph, labels = render._filtergraph()
+        self.assertIn("[0:v]yadif[vcat]", graph)
+        self.assertIn("[acat][1:a]amix=duration=first[amix]", graph)
+
+        # Render it.
+        with tempfile.TemporaryDirectory() as tmpd:
+            file1 = os.path.join(tmpd, "test.webm")
+            render.write_to_files(file1)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertAlmostEqual(Probe(file1).get_duration(), 3, delta=0.2)
+
+    def test_cachedrender(self):
+        logger = logging.getLogger(__name__+".test_cachedrender")
+        logger.debug("Testing CachedRender")
+        with tempfile.TemporaryDirectory() as tmpd:
+            cache = ShotCache(os.path.join(tmpd, "cache"))
+            shots = [Shot(54).cut(1, 1), Shot(54).cut(4, 1).generate_silence()]
+            file1 = os.path.join(tmpd, "test.webm")
+            render = CachedRender(shots, cache=cache)
+            render.write_to_files(file1)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertEqual(cache.misses, 2)
+            self.assertAlmostEqual(Probe(file1).get_duration(), 2, delta=0.2)
+
+            # Only the new shot is rendered.
+            shots.append(Shot(54).cut(6, 1))
+            render = CachedRender(shots, "music/Anitek_-_Nightlife.mp3", cache)
+            render.write_to_files(file1)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertEqual(cache.hits, 2)
+            self.assertEqual(cache.misses, 3)
+            args = render._output_args([(file1, OUTPUT_FORMATS['webm'], 0)])
+            self.assertEqual(args[1], "[0:a][1:a]amix=duration=first[a0]")
+            self.assertIn("copy", args)
+
+            # Multiplexer filters need lossless shots.
+            render = CachedRender(shots, cache=cache)
+            render.append_vf("hflip")
+            # They run once for all the outputs.
+            args = render._output_args([
+                (file1, OUTPUT_FORMATS['webm'], 0),
+                (file1, OUTPUT_FORMATS['ogv'], 0),
+                ])
+            self.assertEqual(args[1], "[0:v]hflip,split=2[v0][v1]")
+            render.write_to_files(file1)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertEqual(cache.misses, 6)
+            self.assertAlmostEqual(Probe(file1).get_duration(), 3, delta=0.2)
+
+    def test_incrementalrender(self):
+        logger = logging.getLogger(__name__+".test_incrementalrender")
+        logger.debug("Testing IncrementalRender")
+        shots = [Shot(54).cut(1, 1), Shot(54).cut(4, 1), Shot(54).cut(6, 1)]
+        # The shots are kept next to a file, not a pipe.
+        with self.assertRaises(ValueError):
+            IncrementalRender(shots).stream("-")
+        with tempfile.TemporaryDirectory() as tmpd:
+            file1 = os.path.join(tmpd, "test.webm")
+            render = IncrementalRender(shots)
+            render.write_to_files(file1)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertEqual(render.misses, 3)
+            self.assertEqual(
+                len(os.listdir(file1 + ".segments")), 3,
+                )
+
+            # Trim the first shot: the others are joined as they are, and
+            # the old version of the first shot is deleted.
+            shots[0].cut(1, 0.5)
+            render = IncrementalRender(shots)
+            render.write_to_files(file1)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertEqual(render.hits, 2)
+            self.assertEqual(render.misses, 1)
+            self.assertEqual(
+                sorted(os.listdir(file1 + ".segments")),
+                sorted(os.path.basename(s) for s in render.segments[file1]),
+                )
+            self.assertAlmostEqual(
+                Probe(file1).get_duration(), 2.5, delta=0.2,
+                )
+
+    def test_segmentedrender(self):
+        logger = logging.getLogger(__name__+".test_segmentedrender")
+        logger.debug("Testing SegmentedRender")
+        shots = [Shot(54).cut(n, 1) for n in range(0, 8, 2)]
+        render = SegmentedRender(shots, segment_length=2)
+        segments = render.plan_segments()
+        self.assertEqual([start for start, s in segments], [0, 2])
+        self.assertEqual(segments[1][1], shots[2:])
+        with self.assertRaises(ValueError):
+            render.mux()
+        with self.assertRaises(ValueError):
+            render.stream("-")
+        render.append_vf("showdata", length=4)
+        with tempfile.TemporaryDirectory() as tmpd:
+            file1 = os.path.join(tmpd, "test.webm")
+            # Pretend the first render died after its first segment.
+            journal = RenderJournal(file1)
+            key = render._segment_key(0, shots[:2], OUTPUT_FORMATS['webm'])
+            render._render_segment(0, shots[:2], [
+                (journal.get_path(key), OUTPUT_FORMATS['webm'])
+                ])
+            journal.add(key, journal.get_path(key))
+
+            render = SegmentedRender(shots, resume=True, segment_length=2)
+            render.append_vf("showdata", length=4)
+            render.write_to_files(file1)
+            self.assertEqual(render.process.wait(), 0)
+            self.assertEqual((render.resumed, render.rendered), (1, 1))
+            self.assertAlmostEqual(Probe(file1).get_duration(), 4, delta=0.2)
+            self.assertFalse(os.path.exists(file1 + ".parts"))
+
+    def test_variantrender(self):
+        logger = logging.getLogger(__name__+".test_variantrender")
+        logger.debug("Testing VariantRender")
+        long = [Shot(54).cut(1, 1), Shot(54).cut(4, 1), Shot(54).cut(6, 1)]
+        short = [Shot(54).cut(1, 1), Shot(54).cut(6, 1)]
+        with tempfile.TemporaryDirectory() as tmpd:
+            cache = ShotCache(os.path.join(tmpd, "cache"))
+            render = VariantRender({'long': long, 'short': short}, cache=cache)
+            outputs = {
+                'long': [os.path.join(tmpd, "long.webm")],
+                'short': [os.path.join(tmpd, "short.webm")],
+                }
+            unique = render.get_unique_shots(outputs)
+            self.assertEqual(list(unique.values()), [long])
+            render.write_to_files(outputs)
+            self.assertEqual(render.wait(), 0)
+            # Shared shots were rendered once.
+            self.assertEqual(cache.misses, 3)
+            self.assertAlmostEqual(
+                Probe(outputs['short'][0]).get_duration(), 2, delta=0.2,
+                )
@@ -0,0 +1,119 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_formats.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+import os.path
+import logging
+import unittest
+import tempfile
+
+from .. import *
+
+
+class FormatRegistryTestCase(unittest.TestCase):
+
+    def test_formatregistry(self):
+        logger = logging.getLogger(__name__+".test_formatregistry")
+        logger.debug("Testing FormatRegistry")
+        registry = FormatRegistry()
+        self.assertEqual(registry.get("webm"), OUTPUT_FORMATS['webm'])
+        self.assertEqual(set(registry.formats['webm']), set(TIERS))
+        self.assertIn("ultrafast", registry.get("avi", "draft"))
+        # A double extension takes precedence over the last one.
+        self.assertEqual(registry.get_key("a.movie.webm"), "webm")
+        self.assertEqual(registry.get_key("movie.vp9.webm"), "vp9.webm")
+        vp9 = registry.get_output_format("movie.vp9.webm", "final")
+        self.assertIn("libvpx-vp9", vp9)
+        self.assertIn("-row-mt", vp9)
+        registry.tier = "draft"
+        self.assertEqual(
+            registry.get_output_format("movie.ogv"),
+            registry.get("ogv", "draft"),
+            )
+        with self.assertRaises(KeyError):
+            registry.get("ogv", "best")
+
+        # Tiers left out are kept, or copied from the normal tier.
+        registry.update({
+            'webm': {'final': ["-f", "webm", "-b:v", 8000]},
+            'mp4': ["-f", "mp4", "-vcodec", "libx264"],
+            })
+        self.assertEqual(registry.get("webm", "final")[-1], "8000")
+        self.assertEqual(
+            registry.get("webm", "normal"), OUTPUT_FORMATS['webm'],
+            )
+        self.assertEqual(registry.get("mp4", "final"), registry.get("mp4"))
+        with self.assertRaises(KeyError):
+            registry.update({'mkv': {'final': ["-f", "matroska"]}})
+        with self.assertRaises(KeyError):
+            registry.update({'mkv': {'best': ["-f", "matroska"]}})
+        with self.assertRaises(TypeError):
+            registry.update({'mkv': "-f matroska"})
+
+        # Formats are loaded from a YAML file.
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "formats.yaml")
+            with open(filename, "w") as f:
+                f.write("mkv:\n  normal: [-f, matroska]\n")
+            registry.load(filename)
+        self.assertEqual(registry.get("mkv", "draft"), ["-f", "matroska"])
+        # The registry of projects is left alone.
+        self.assertNotIn("mkv", FORMATS)
+
+    def test_load_formats_file(self):
+        logger = logging.getLogger(__name__+".test_load_formats_file")
+        logger.debug("Testing the formats file of the user")
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "formats.yaml")
+            with open(filename, "w") as f:
+                f.write("mkv: -f matroska\n")
+            # A file that is not valid is ignored, not raised.
+            with self.assertLogs("vid.formats", logging.ERROR) as cm:
+                self.assertFalse(load_formats_file(filename))
+            self.assertIn(filename, cm.output[0])
+            self.assertNotIn("mkv", FORMATS)
+            # It is read once.
+            self.assertFalse(load_formats_file(filename))
+
+    def test_playlist(self):
+        logger = logging.getLogger(__name__+".test_playlist")
+        logger.debug("Testing the m3u8 format")
+        registry = FormatRegistry()
+        for tier in TIERS:
+            format = registry.get_output_format("movie.m3u8", tier)
+            self.assertEqual(format[format.index("-f") + 1], "hls")
+            self.assertEqual(
+                format[format.index("-hls_playlist_type") + 1], "event",
+                )
+        # A playlist is made of files, it can't be streamed.
+        with self.assertRaises(ValueError):
+            get_stream_format(format)
+        self.assertIn(
+            "-movflags", get_stream_format(registry.get("mp4")),
+            )
+        self.assertEqual(
+            get_stream_format(registry.get("webm")), registry.get("webm"),
+            )
+        # Playlists are written in a directory of their own.
+        with tempfile.TemporaryDirectory() as d:
+            output = os.path.join(d, "preview", "movie.m3u8")
+            make_output_dirs([(output, format), "movie.webm"])
+            self.assertTrue(os.path.isdir(os.path.dirname(output)))
@@ -0,0 +1,137 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_manifest.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+
+
+import os
+import logging
+import unittest
+import tempfile
+
+from .. import *
+
+
+workdir = os.path.abspath(os.path.dirname(__file__))
+
+
+class RenderManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(workdir)
+
+    def test_rendermanifest(self):
+        logger = logging.getLogger(__name__+".test_rendermanifest")
+        logger.debug("Testing RenderManifest")
+        shots = [Shot(54).cut(1, 1), Shot(54).cut(4, 2), Shot(54).cut(0, 1)]
+        with tempfile.TemporaryDirectory() as tmpd:
+            output = os.path.join(tmpd, "movie.webm")
+            manifest = RenderManifest.load(output)
+            self.assertEqual(manifest.shots, [])
+            segments = [os.path.join(tmpd, n) for n in ("a", "b", "c")]
+            manifest.update(shots, segments)
+            self.assertEqual(manifest.shots[1]['start'], 1)
+            self.assertEqual(manifest.shots[1]['end'], 3)
+            self.assertEqual(manifest.shots[1]['segment'], segments[1])
+            manifest.save()
+            self.assertTrue(os.path.isfile(output + ".vid.json"))
+
+            manifest = RenderManifest.load(output)
+            self.assertEqual(len(manifest.shots), 3)
+            # Shots whose file is gone must be rendered again.
+            self.assertEqual(
+                manifest.diff(shots),
+                {'unchanged': 0, 'shifted': 0, 'changed': 3},
+                )
+            for segment in segments:
+                open(segment, "w").close()
+            self.assertEqual(
+                manifest.diff(shots),
+                {'unchanged': 3, 'shifted': 0, 'changed': 0},
+                )
+            # Trimming the first shot shifts the others.
+            shots[0].cut(1, 0.5)
+            self.assertEqual(
+                manifest.diff(shots),
+                {'unchanged': 0, 'shifted': 2, 'changed': 1},
+                )
+            # A manifest for another format is ignored.
+            manifest = RenderManifest.load(output, OUTPUT_FORMATS['ogv'])
+            self.assertEqual(manifest.shots, [])
+
+    def test_renderjournal(self):
+        logger = logging.getLogger(__name__+".test_renderjournal")
+        logger.debug("Testing RenderJournal")
+        with tempfile.TemporaryDirectory() as tmpd:
+            output = os.path.join(tmpd, "movie.webm")
+            journal = RenderJournal.load(output)
+            self.assertEqual(journal.segments, {})
+            path = journal.get_path("abc")
+            self.assertTrue(os.path.isdir(output + ".parts"))
+            # A segment counts only once its file is there.
+            journal.add("abc", path)
+            self.assertIsNone(journal.get("abc"))
+            open(path, "w").close()
+            self.assertEqual(journal.get("abc"), path)
+
+            journal = RenderJournal.load(output)
+            self.assertEqual(journal.get("abc"), path)
+            self.assertIsNone(journal.get("def"))
+            journal.remove()
+            self.assertFalse(os.path.exists(output + ".parts"))
+            self.assertFalse(os.path.exists(output + ".vid-journal.json"))
+
+    def test_passlog(self):
+        logger = logging.getLogger(__name__+".test_passlog")
+        logger.debug("Testing PassLog")
+        with tempfile.TemporaryDirectory() as tmpd:
+            output = os.path.join(tmpd, "movie.webm")
+            passlog = PassLog(output)
+            webm = OUTPUT_FORMATS['webm']
+            first, second = passlog.get_formats(webm, "3000k")
+            self.assertEqual(first[-5:], ["-pass", "1", "-an", "-f", "null"])
+            self.assertNotIn("webm", first)
+            # The first pass is faster.
+            self.assertEqual(first[first.index("-cpu-used") + 1], "4")
+            self.assertEqual(second[second.index("-b:v") + 1], "3000k")
+            self.assertEqual(second.count("-b:v"), 1)
+            self.assertEqual(
+                second[second.index("-passlogfile") + 1], passlog.prefix,
+                )
+            self.assertTrue(PassLog.accepts(OUTPUT_FORMATS['avi']))
+            with self.assertRaises(ValueError):
+                passlog.get_formats(OUTPUT_FORMATS['ogv'], "3000k")
+            # Such outputs are encoded in a single pass at the bitrate.
+            ogv = PassLog.get_single_format(OUTPUT_FORMATS['ogv'], "3000k")
+            self.assertEqual(ogv[-2:], ["-b:v", "3000k"])
+            self.assertEqual(ogv.count("-b:v"), 1)
+
+            # The key does not depend on the bitrate.
+            key = passlog.get_key([], webm)
+            self.assertEqual(key, passlog.get_key([], second))
+            self.assertNotEqual(key, passlog.get_key([], webm, height=360))
+            self.assertFalse(passlog.is_valid(key))
+            passlog.save(key)
+            # The statistics must be there too.
+            self.assertFalse(passlog.is_valid(key))
+            open(passlog.prefix + "-0.log", "w").close()
+            self.assertTrue(passlog.is_valid(key))
+            self.assertFalse(passlog.is_valid(passlog.get_key([], webm, [1])))
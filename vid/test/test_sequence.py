@@ -0,0 +1,70 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_sequence.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+
+
+import os
+import logging
+import unittest
+import tempfile
+
+from .. import *
+
+
+workdir = os.path.abspath(os.path.dirname(__file__))
+
+
+class SequenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(workdir)
+
+    def test_sequence(self):
+        logger = logging.getLogger(__name__+".test_sequence")
+        logger.debug("Testing Sequence")
+        with tempfile.TemporaryDirectory() as tmpd:
+            cache = ShotCache(os.path.join(tmpd, "cache"))
+            intro = os.path.join(tmpd, "intro.yaml")
+            with open(intro, "w") as f:
+                f.write("movie:\n  - [54, 1, 1]\n  - [54, 4, 1]\n")
+            sequence = make_shot([], {'sequence': intro, 'seek': 0.5}, cache)
+            self.assertIsInstance(sequence, Sequence)
+            self.assertEqual(sequence.vf, [])
+            self.assertAlmostEqual(sequence.get_duration(), 1.5, delta=0.1)
+            self.assertEqual(cache.misses, 1)
+
+            # Another movie including it reuses the rendered file.
+            again = Sequence(intro, cache=cache)
+            self.assertEqual(again.name, sequence.name)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Editing the sub-sequence renders it again.
+            with open(intro, "a") as f:
+                f.write("  - [54, 6, 1]\n")
+            self.assertNotEqual(Sequence(intro, cache=cache).name, again.name)
+
+            # A sequence must not include itself.
+            loop = os.path.join(tmpd, "loop.yaml")
+            with open(loop, "w") as f:
+                f.write("movie:\n  - {{sequence: {}}}\n".format(loop))
+            with self.assertRaises(ValueError):
+                Sequence(loop, cache=cache)
@@ -23,6 +23,7 @@
 import io
 import queue
 import select
+import socket
 import shutil
 import os.path
 import logging
@@ -479,6 +480,92 @@ class UtilsTestCase(unittest.TestCase):
         muxer.process.wait()
         player.process.wait()
 
+    def test_recordstream(self):
+        logger = logging.getLogger(__name__+".test_recordstream")
+        logger.debug("Testing RecordStream")
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "record")
+            r, w = os.pipe()
+            input = io.BytesIO(b"YUV4MPEG2\nsome data")
+            output_r = open(r, "rb")
+            t = RecordStream(
+                input, open(w, "wb"), open(filename, "wb"), True,
+                )
+            t.start()
+            self.assertEqual(output_r.read(), b"YUV4MPEG2\nsome data")
+            t.join()
+            output_r.close()
+            self.assertIsNone(t.exception)
+            self.assertTrue(input.closed)
+            # The header is piped but not recorded.
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"some data")
+
+    def test_fanout(self):
+        logger = logging.getLogger(__name__+".test_fanout")
+        logger.debug("Testing FanOut")
+        data = os.urandom(1024 * 1024)
+        input = io.BytesIO(data)
+        r1, w1 = os.pipe()
+        r2, w2 = os.pipe()
+        # The reader of the second output goes away: it is dropped
+        # instead of stalling the first one.
+        os.close(r2)
+        output_r = open(r1, "rb")
+        t = FanOut(input, [open(w1, "wb"), open(w2, "wb")], maxsize=2)
+        t.start()
+        self.assertEqual(output_r.read(), data)
+        t.join(timeout=10)
+        output_r.close()
+        self.assertFalse(t.is_alive())
+        self.assertEqual(t.bytes_read, len(data))
+        self.assertEqual(t.writers[0].bytes_written, len(data))
+        self.assertLess(t.writers[1].bytes_written, len(data))
+        self.assertTrue(input.closed)
+
+    def test_concatenateshots_replay(self):
+        logger = logging.getLogger(__name__+".test_concatenateshots_replay")
+        logger.debug("Testing ConcatenateShots with repeated shots.")
+        shots = [
+            Shot(54).cut(0, 0.5),
+            Shot(54).cut(2, 0.5),
+            Shot(54).cut(0, 0.5),
+            Shot(54).cut(0, 0.5).generate_silence(),
+            Shot(54).cut(0, 0.5),
+            ]
+        repeated = find_repeated_shots(shots)
+        self.assertEqual(list(repeated.values()), [3])
+        self.assertEqual(find_repeated_shots(shots[:2]), {})
+        # Recordings are limited in size.
+        size = get_raw_size(shots[0])
+        self.assertGreater(size, 0.5 * 4 * 44100)
+        self.assertEqual(find_repeated_shots(shots, max_size=size), repeated)
+        self.assertEqual(find_repeated_shots(shots, max_size=size - 1), {})
+        fvr, fvw = os.pipe()
+        far, faw = os.pipe()
+        vr = open(fvr, "rb")
+        ar = open(far, "rb")
+        q = queue.Queue()
+        cat = ConcatenateShots(q, open(fvw, "wb"), open(faw, "wb"), repeated)
+        for shot in shots:
+            q.put(shot)
+        q.put(None)
+        with unittest.mock.patch.object(
+                Shot, "demux", autospec=True, side_effect=Shot.demux,
+                ) as demux:
+            cat.start()
+            video = vr.read()
+            audio = ar.read()
+            cat.join()
+        vr.close()
+        ar.close()
+        self.assertIsNone(cat.exception)
+        self.assertEqual(demux.call_count, 3)
+        # One header, 2.5 seconds of movie.
+        self.assertEqual(video.count(b"YUV4MPEG2"), 1)
+        self.assertAlmostEqual(len(audio) / 4 / 44100, 2.5, delta=0.1)
+        self.assertIsNone(cat.scratch)
+
     def test_shot_silent(self):
         logger = logging.getLogger(__name__+".test_shot_silent")
         logger.debug("Testing Shot.silent()")
@@ -538,6 +625,79 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEqual(shot.a_process.wait(), 0)
         self.assertEqual(shot.v_process.wait(), 0)
 
+    def test_append_filter_stabilize(self):
+        logger = logging.getLogger(__name__+".test_append_filter_stabilize")
+        logger.debug("Testing the stabilize preset filter")
+        with tempfile.TemporaryDirectory() as d:
+            with unittest.mock.patch("vid.utils.TRANSFORMS_DIR", d):
+                shot = Shot(54).cut(4, 1)
+                shot.append_vf("stabilize", shakiness=8, smoothing=20)
+                name, options = shot.vf[-1]
+                self.assertEqual(name, "vidstabtransform")
+                self.assertEqual(options['smoothing'], 20)
+                self.assertNotIn('shakiness', options)
+                self.assertTrue(os.path.isfile(options['input']))
+                self.assertEqual(os.listdir(d), [
+                    os.path.basename(options['input'])
+                    ])
+                # The analysis is not run again for the same cut.
+                with unittest.mock.patch("subprocess.Popen") as popen:
+                    Shot(54).cut(4, 1).append_vf("stabilize", shakiness=8)
+                    self.assertFalse(popen.called)
+                # Another cut is analysed again.
+                Shot(54).cut(5, 1).append_vf("stabilize", shakiness=8)
+                self.assertEqual(len(os.listdir(d)), 2)
+            shot.demux()
+            self.assertTrue(shot.v_stream.read().startswith(b"YUV4MPEG2"))
+            shot.v_stream.close()
+            shot.a_stream.close()
+            self.assertEqual(shot.v_process.wait(), 0)
+
+    def test_append_filter_normalize(self):
+        logger = logging.getLogger(__name__+".test_append_filter_normalize")
+        logger.debug("Testing the normalize preset filter")
+        with tempfile.TemporaryDirectory() as d:
+            with unittest.mock.patch("vid.utils.LOUDNESS_DIR", d):
+                shot = Shot(54).cut(4, 1).append_af("normalize", I=-23)
+                self.assertEqual(
+                    [f[0] for f in shot.af], ["loudnorm", "aresample"],
+                    )
+                options = shot.af[0][1]
+                self.assertEqual(options['I'], -23)
+                self.assertEqual(options['linear'], "true")
+                self.assertIn('measured_I', options)
+                # The measurement is not run again for the same cut.
+                with unittest.mock.patch("subprocess.Popen") as popen:
+                    Shot(54).cut(4, 1).append_af("normalize", I=-23)
+                    self.assertFalse(popen.called)
+                # Silent shots are not measured nor amplified.
+                silent = Shot(54).cut(4, 1).generate_silence()
+                self.assertEqual(silent.append_af("normalize").af, [])
+                self.assertEqual(len(os.listdir(d)), 1)
+                with open(os.devnull, "rb") as f:
+                    muxer = Multiplexer(
+                        f, f, [shot, silent], "music/Anitek_-_Nightlife.mp3",
+                        )
+                    muxer.append_af("normalize")
+                self.assertEqual(muxer.af[0][0], "loudnorm")
+
+    def test_combine_loudness(self):
+        logger = logging.getLogger(__name__+".test_combine_loudness")
+        logger.debug("Testing combine_loudness()")
+        quiet = {'input_i': "-30", 'input_tp': "-10", 'input_lra': "2"}
+        loud = {'input_i': "-20", 'input_tp': "-1", 'input_lra': "8"}
+        self.assertIsNone(combine_loudness([(1, None)]))
+        measured = combine_loudness([(3, quiet), (3, quiet)])
+        self.assertEqual(measured['input_i'], "-30.00")
+        self.assertEqual(measured['input_thresh'], "-40.00")
+        # Silence lowers the average.
+        measured = combine_loudness([(1, loud), (9, None)])
+        self.assertEqual(measured['input_i'], "-30.00")
+        measured = combine_loudness([(1, loud), (1, quiet)])
+        self.assertEqual(measured['input_i'], "-22.60")
+        self.assertEqual(measured['input_tp'], "-1.00")
+        self.assertEqual(measured['input_lra'], "8.00")
+
     def test_audioprocessing_mix(self):
         logger = logging.getLogger(__name__+".test_audioprocessing_mix")
         logger.debug("Testing AudioProcessing()")
@@ -562,3 +722,211 @@ class UtilsTestCase(unittest.TestCase):
         logger.debug("Testing Probe().get_duration()")
         probe = Probe("footage/testsequence/M2U00054.mpg")
         self.assertIsInstance(probe.get_duration(), float)
+
+    def test_probe_get(self):
+        logger = logging.getLogger(__name__+".test_probe_get")
+        logger.debug("Testing Probe.get()")
+        with tempfile.NamedTemporaryFile() as tmpf:
+            probe = Probe.get(tmpf.name)
+            self.assertIs(Probe.get(tmpf.name), probe)
+            # A modified file is probed again.
+            tmpf.write(b"\x00")
+            tmpf.flush()
+            self.assertIsNot(Probe.get(tmpf.name), probe)
+
+    def test_schedulingpolicy(self):
+        logger = logging.getLogger(__name__+".test_schedulingpolicy")
+        logger.debug("Testing SchedulingPolicy")
+        # The default policy leaves processes alone.
+        policy = SchedulingPolicy()
+        args = ["ffmpeg", "-i", "x"]
+        self.assertEqual(policy.wrap_args("encoder", args), args)
+        self.assertEqual(policy.get_settings("decoder"), {})
+
+        policy.update({
+            'encoder': {'nice': -1, 'cpus': "0-1,3"},
+            'decoder': {'nice': 5, 'ioclass': "best-effort", 'iolevel': 7},
+            })
+        self.assertEqual(
+            policy.get_settings("encoder"), {'nice': -1, 'cpus': {0, 1, 3}}
+            )
+        self.assertEqual(SchedulingPolicy._parse_cpus([2, 3]), {2, 3})
+        if policy._ionice is not None:
+            self.assertEqual(
+                policy.wrap_args("decoder", args)[1:],
+                ["-c", "2", "-n", "7"] + args,
+                )
+        # Background renders yield to interactive work.
+        policy.background = True
+        self.assertEqual(
+            policy.get_settings("decoder"), {'nice': 15, 'ioclass': "idle"}
+            )
+        with self.assertRaises(KeyError):
+            policy.update({'demuxer': {}})
+        with self.assertRaises(KeyError):
+            policy.update({'encoder': {'threads': 2}})
+        with self.assertRaises(ValueError):
+            policy.update({'encoder': {'ioclass': "fast"}})
+
+        # Settings are applied in the subprocess.
+        policy = SchedulingPolicy({'player': {'nice': 3, 'cpus': [0]}})
+        p = subprocess.Popen(
+            ["sh", "-c", "nice; grep Cpus_allowed_list /proc/self/status"],
+            stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            universal_newlines=True,
+            preexec_fn=policy.preexec_fn("player"),
+            )
+        output = p.stdout.read().split()
+        p.stdout.close()
+        p.wait()
+        self.assertEqual(int(output[0]), os.nice(0) + 3)
+        self.assertEqual(output[-1], "0")
+
+    def test_threadbudget(self):
+        logger = logging.getLogger(__name__+".test_threadbudget")
+        logger.debug("Testing ThreadBudget")
+        budget = ThreadBudget(cpus=8)
+        # Decoders leave room for the encoder that follows them.
+        decoder1 = budget.acquire("decoder")
+        self.assertEqual(decoder1.threads, 2)
+        decoder2 = budget.acquire("decoder")
+        self.assertEqual(decoder2.threads, 2)
+        encoder = budget.acquire("encoder")
+        self.assertEqual(encoder.threads, 4)
+        self.assertEqual(budget.allocated, 8)
+        # Allocations follow the load.
+        decoder1.release()
+        decoder1.release()
+        decoder2.release()
+        self.assertEqual(budget.running, {'encoder': 1, 'decoder': 0})
+        self.assertEqual(budget.allocated, 4)
+        self.assertEqual(budget.acquire("decoder").threads, 2)
+        encoder.release()
+        self.assertEqual(budget.acquire("encoder").threads, 5)
+        # Never more than the cores left.
+        budget = ThreadBudget(cpus=8)
+        self.assertEqual(budget.acquire("encoder").threads, 8)
+        self.assertEqual(budget.acquire("decoder").threads, 1)
+        # Never less than one thread.
+        budget = ThreadBudget(cpus=1)
+        for i in range(4):
+            self.assertEqual(budget.acquire("decoder").threads, 1)
+
+        # Threads are split among outputs.
+        muxer = Multiplexer(3, 4)
+        args = muxer._output_args("a.ogv", "b.webm", threads=5)
+        self.assertEqual(args[:2], ["-filter_complex_threads", "5"])
+        self.assertEqual(args.count("-threads"), 2)
+        self.assertEqual(args[args.index("a.ogv") - 1], "2")
+
+    def test_multiplexer_outputs(self):
+        logger = logging.getLogger(__name__+".test_multiplexer_outputs")
+        logger.debug("Testing Multiplexer with several outputs")
+        muxer = Multiplexer(3, 4)
+        muxer.append_vf("drawbox")
+        # A single output has simple filtergraphs.
+        args = muxer._output_args("a.ogv")
+        self.assertEqual(args[:2], ["-filter:v", "drawbox"])
+        self.assertNotIn("-filter_complex", args)
+
+        # The filters run once for all outputs.
+        output = parse_output("b-360.webm@360")
+        self.assertEqual(
+            output, ("b-360.webm", OUTPUT_FORMATS['webm'], 360),
+            )
+        self.assertEqual(parse_output("b.webm"), "b.webm")
+        args = muxer._output_args("a.ogv", output)
+        graph = args[args.index("-filter_complex") + 1].split(";")
+        self.assertEqual(graph, [
+            "[0:v]drawbox[vmux]",
+            "[vmux]split=2[vout0][vout1]",
+            "[1:a]asplit=2[aout0][aout1]",
+            "[vout1]scale=-2:360[vscale1]",
+            ])
+        self.assertNotIn("-filter:v", args)
+        self.assertEqual(args[2:6], ["-map", "[vout0]", "-map", "[aout0]"])
+        i = args.index("a.ogv")
+        self.assertEqual(
+            args[i+1:i+5], ["-map", "[vscale1]", "-map", "[aout1]"],
+            )
+        self.assertEqual(args[-1], "b-360.webm")
+
+        # Unfiltered streams are mapped by their specifier.
+        args = Multiplexer(3, 4)._output_args(output)
+        self.assertEqual(
+            args[args.index("-filter_complex") + 1],
+            "[0:v]scale=-2:360[vscale0]",
+            )
+        self.assertEqual(args[2:6], ["-map", "[vscale0]", "-map", "1:a"])
+
+    def test_multiplexer_stream(self):
+        logger = logging.getLogger(__name__+".test_multiplexer_stream")
+        logger.debug("Testing Multiplexer.stream()")
+        sink, source = socket.socketpair()
+        v_r, v_w = os.pipe()
+        a_r, a_w = os.pipe()
+        with unittest.mock.patch("subprocess.Popen") as popen:
+            muxer = Multiplexer(v_r, a_r)
+            muxer.stream(sink, "mp4")
+            args = popen.call_args[0][0]
+            self.assertEqual(popen.call_args[1]['stdout'], sink.fileno())
+        self.assertEqual(args[-1], "pipe:1")
+        # MP4 is fragmented to be written to a socket.
+        self.assertIn("frag_keyframe", args[args.index("-movflags") + 1])
+        with self.assertRaises(ValueError):
+            Multiplexer(v_r, a_r).stream(sink, "avi")
+        for fd in (v_w, a_w):
+            os.close(fd)
+        sink.close()
+        source.close()
+
+    def test_coalesce_shots(self):
+        logger = logging.getLogger(__name__+".test_coalesce_shots")
+        logger.debug("Testing coalesce_shots()")
+        shots = [
+            Shot(54).cut(1, 1),
+            Shot(54).cut(2, 1),
+            Shot(54).cut(4.5, 0.5),
+            Shot(54).cut(0, 1),  # Before the previous cut.
+            Shot(54).cut(2, 1),
+            Shot(54).cut(3, 1).generate_silence(),
+            Shot(54).cut(5),  # No duration.
+            Shot(54).cut(6, 1),
+            ]
+        coalesced = coalesce_shots(shots)
+        self.assertEqual(len(coalesced), 5)
+        self.assertIsInstance(coalesced[0], ShotGroup)
+        self.assertEqual(coalesced[0].shots, shots[0:3])
+        self.assertEqual(coalesced[0].dur, 2.5)
+        self.assertIsInstance(coalesced[1], ShotGroup)
+        self.assertEqual(coalesced[1].shots, shots[3:5])
+        self.assertEqual(coalesced[2:], shots[5:])
+        # Burned timecodes must stay those of each shot.
+        shots[1].append_vf("showdata")
+        self.assertEqual(coalesce_shots(shots[:3]), shots[:3])
+
+        graph = coalesced[0]._filtergraph("v")
+        self.assertEqual(
+            graph,
+            "[0:v]split=3[s0][s1][s2];"
+            "[s0]trim=start=1:end=2,setpts=PTS-STARTPTS,yadif[c0];"
+            "[s1]trim=start=2:end=3,setpts=PTS-STARTPTS,yadif[c1];"
+            "[s2]trim=start=4.5:end=5.0,setpts=PTS-STARTPTS,yadif[c2];"
+            "[c0][c1][c2]concat=n=3:v=1:a=0[out]"
+            )
+        self.assertIn("atrim", coalesced[0]._filtergraph("a"))
+
+        # Demux the group like any shot.
+        group = coalesced[0]
+        group.demux(remove_header=True)
+        video = group.v_stream.read()
+        audio = group.a_stream.read()
+        group.v_stream.close()
+        group.a_stream.close()
+        self.assertEqual(group.v_process.wait(), 0)
+        self.assertEqual(group.a_process.wait(), 0)
+        self.assertTrue(video.startswith(b"FRAME"))
+        # 2.5 seconds of 16 bits stereo audio at 44100 Hz, give or take
+        # a frame.
+        self.assertAlmostEqual(len(audio) / 4 / 44100, 2.5, delta=0.05)
@@ -0,0 +1,81 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# test_watch.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+
+
+import os
+import logging
+import unittest
+import tempfile
+
+from .. import *
+
+
+workdir = os.path.abspath(os.path.dirname(__file__))
+PROJECT = """\
+movie:
+  - [54, 1, 1]
+  - [54, 4, 2]
+  - [54, 0, 1]
+"""
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(workdir)
+
+    def test_watcher(self):
+        logger = logging.getLogger(__name__+".test_watcher")
+        logger.debug("Testing Watcher")
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml") as f:
+            f.write(PROJECT)
+            f.flush()
+            watcher = Watcher(f.name, pattern=DEFAULT_PATTERN)
+            data, specs, shots = watcher.load()
+            self.assertEqual(len(shots), 3)
+            self.assertEqual(watcher.find_first_change(data, specs), 0)
+            watcher.data, watcher.specs = data, specs
+            self.assertIsNone(watcher.find_first_change(data, specs))
+
+            # Change the second shot. The others are the same objects.
+            f.seek(0)
+            f.write(PROJECT.replace("[54, 4, 2]", "[54, 4, 3]"))
+            f.flush()
+            data, new_specs, new_shots = watcher.load()
+            self.assertEqual(watcher.find_first_change(data, new_specs), 1)
+            self.assertIs(new_shots[0], shots[0])
+            self.assertIsNot(new_shots[1], shots[1])
+            self.assertIs(new_shots[2], shots[2])
+
+            # Adding music plays the movie from the start.
+            data['music'] = "music/Anitek_-_Nightlife.mp3"
+            self.assertEqual(watcher.find_first_change(data, new_specs), 0)
+
+    def test_watcher_missing_file(self):
+        logger = logging.getLogger(__name__+".test_watcher_missing_file")
+        logger.debug("Testing Watcher with a file being saved")
+        with tempfile.TemporaryDirectory() as d:
+            # Editors may remove the file for a moment while saving it.
+            watcher = Watcher(os.path.join(d, "movie.yaml"))
+            self.assertFalse(watcher.check())
+            self.assertEqual(watcher.mtimes, {})
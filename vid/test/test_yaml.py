@@ -262,3 +262,148 @@ class YAMLTestCase(unittest.TestCase):
                     'music': n.name,
                     }
                 self.assertEqual(reader.load(data), canonical)
+
+    def test_get_shots_arguments(self):
+        logger = logging.getLogger(__name__+".test_get_shots_arguments")
+        logger.debug("Testing YAMLReader.get_shots_arguments()")
+        reader = YAMLReader()
+        reader.data = {
+            'movie': [
+                [1, {}],
+                [4, 1, 10.25, {'pattern': "shot", 'silent': False}],
+                ],
+            'globals': {'pattern': "globals", 'silent': True},
+            }
+        self.assertEqual(
+            reader.get_shots_arguments(),
+            [
+                ([1], {'pattern': "globals", 'silent': True}),
+                ([4, 1, 10.25], {'pattern': "shot", 'silent': False}),
+            ]
+            )
+        # The pattern argument overrides globals but not the shot.
+        self.assertEqual(
+            reader.get_shots_arguments("option"),
+            [
+                ([1], {'pattern': "option", 'silent': True}),
+                ([4, 1, 10.25], {'pattern': "shot", 'silent': False}),
+            ]
+            )
+        del reader.data['globals']
+        self.assertEqual(reader.get_shots_arguments()[0], ([1], {}))
+
+    def test_check_sequence(self):
+        logger = logging.getLogger(__name__+".test_check_sequence")
+        logger.debug("Testing sub-sequences in the movie section")
+        reader = YAMLReader()
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml") as f:
+            sequence = {'sequence': f.name, 'seek': 1, 'af': ["volume"]}
+            self.assertEqual(
+                reader._check_shot(dict(sequence), ["movie"]),
+                [{'sequence': f.name, 'seek': 1, 'af': [["volume", {}]]}],
+                )
+            with self.assertRaises(KeyError):
+                reader._check_shot({'seek': 1}, ["movie"])
+            with self.assertRaises(KeyError):
+                reader._check_shot(
+                    {'sequence': f.name, 'pattern': "x"}, ["movie"]
+                    )
+            with self.assertRaises(FileNotFoundError):
+                reader._check_shot({'sequence': f.name+"x"}, ["movie"])
+            self.assertEqual(
+                reader._check_shot(
+                    {'sequence': f.name, 'filters': ["hflip"]}, ["movie"]
+                    ),
+                [{'sequence': f.name, 'vf': [["hflip", {}]]}],
+                )
+            with self.assertRaises(TypeError):
+                reader._check_shot(
+                    {'sequence': f.name, 'seek': "1"}, ["movie"]
+                    )
+            with self.assertRaises(ValueError):
+                reader._check_shot({'sequence': f.name, 'dur': -1}, ["movie"])
+
+            # Sequences are relative to the including file.
+            with tempfile.TemporaryDirectory() as d:
+                project = os.path.join(d, "movie.yaml")
+                with open(project, "w") as p:
+                    p.write("movie:\n  - {sequence: intro.yaml}\n")
+                with open(os.path.join(d, "intro.yaml"), "w") as p:
+                    p.write("movie:\n  - 1\n")
+                data = YAMLReader(cache_dir=None).load(project)
+                self.assertEqual(
+                    data['movie'][0][0]['sequence'],
+                    os.path.join(d, "intro.yaml"),
+                    )
+
+            # Globals do not apply to sub-sequences.
+            reader.data = {
+                'movie': [[1, {}], [{'sequence': f.name}]],
+                'globals': {'silent': True},
+                }
+            self.assertEqual(
+                reader.get_shots_arguments("option")[1],
+                ([], {'sequence': f.name, 'pattern': "option"}),
+                )
+
+    def test_check_variants(self):
+        logger = logging.getLogger(__name__+".test_check_variants")
+        logger.debug("Testing the variants section")
+        reader = YAMLReader()
+        self.assertEqual(
+            reader._check_variants({'short': [42, [43, 1]]}),
+            {'short': [[42, {}], [43, 1, {}]]},
+            )
+        with self.assertRaises(TypeError):
+            reader._check_variants([[42]])
+        with self.assertRaises(KeyError):
+            reader._check_variants({'movie': [42]})
+        # Errors name the variant.
+        with self.assertRaisesRegex(ValueError, "Variant short"):
+            reader._check_variants({'short': []})
+        with self.assertRaisesRegex(TypeError, "variants.*short"):
+            reader._check_variants({'short': ["x"]})
+        reader.data = {
+            'movie': [[1, {}]],
+            'variants': {'short': [[2, {}]]},
+            'globals': {'silent': True},
+            }
+        self.assertEqual(
+            reader.get_shots_arguments(variant="short"),
+            [([2], {'silent': True})],
+            )
+
+    def test_yamlreader_cache(self):
+        logger = logging.getLogger(__name__+".test_yamlreader_cache")
+        logger.debug("Testing the cache of checked projects")
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "movie.yaml")
+            with open(filename, "w") as f:
+                f.write("movie:\n  - [1, 2, 3]\n")
+            reader = YAMLReader(os.path.join(d, "cache"))
+            data = reader.load(filename)
+            self.assertEqual(data, {'movie': [[1, 2, 3, {}]]})
+            self.assertEqual(len(os.listdir(os.path.join(d, "cache"))), 1)
+            # The cached data is used without checking it again.
+            reader._check = None
+            self.assertEqual(reader.load(filename), data)
+            os.utime(filename, ns=(0, 0))
+            self.assertEqual(reader.load(filename), data)
+            del reader._check
+            # A modified project is checked again.
+            with open(filename, "w") as f:
+                f.write("movie:\n  - [4]\n")
+            self.assertEqual(reader.load(filename), {'movie': [[4, {}]]})
+            self.assertEqual(
+                YAMLReader(None).load(filename), {'movie': [[4, {}]]},
+                )
+            # Files named by a cached project must still exist.
+            sequence = os.path.join(d, "intro.yaml")
+            with open(sequence, "w") as f:
+                f.write("movie:\n  - [4]\n")
+            with open(filename, "w") as f:
+                f.write("movie:\n  - {sequence: intro.yaml}\n")
+            reader.load(filename)
+            os.remove(sequence)
+            with self.assertRaises(FileNotFoundError):
+                reader.load(filename)
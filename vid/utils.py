@@ -28,8 +28,11 @@ import sys
 import glob
 import stat
 import json
+import math
 import errno
 import queue
+import fractions
+import hashlib
 import pprint
 import shutil
 import select
@@ -38,53 +41,89 @@ import os.path
 import logging
 import warnings
 import threading
+import tempfile
 import subprocess
 
+import yaml
+
+from .formats import FORMATS, get_stream_format
+
+
+def get_cache_dir(name, variable):               #{{{1
+    """Return the cache directory of Vid called name.
+
+    The directory is named by the environment variable, or else it is
+    vid/name in XDG_CACHE_HOME, ~/.cache by default.
+    """
+    return os.getenv(
+        variable,
+        os.path.join(
+            os.getenv('XDG_CACHE_HOME', os.path.expanduser("~/.cache")),
+            "vid", name,
+            ),
+        )
+
 
 # Global variables                               {{{1
 FASTSEEK_THRESHOLD = 30  # Seconds
+# Consecutive cuts of at most COALESCE_THRESHOLD seconds from the same
+# file are demuxed by the same processes, as long as they fit in a span
+# of COALESCE_SPAN seconds of the file. Set to None to disable.
+COALESCE_THRESHOLD = 5  # Seconds
+COALESCE_SPAN = 30  # Seconds
+# Shots that appear more than once in a movie and last less than
+# REPLAY_THRESHOLD seconds are demuxed once. The raw streams are recorded
+# in a scratch directory of the log directory and replayed at later
+# positions. Set to None to disable.
+REPLAY_THRESHOLD = 30  # Seconds
+# The raw streams recorded by a render take at most about this much
+# space. Shots are recorded in the order they first appear until their
+# estimated size would exceed it. See find_repeated_shots().
+REPLAY_SIZE = 2048  # Megabytes
+# Bytes per pixel of raw video, by pixel format. Other formats count as
+# 4 bytes.
+PIXEL_SIZES = {
+    'yuv420p': 1.5, 'yuvj420p': 1.5, 'yuv422p': 2, 'yuvj422p': 2,
+    'yuv444p': 3, 'yuvj444p': 3,
+    }
+# When outputs are encoded by parallel processes, each encoder may lag
+# behind the fastest by at most FANOUT_BUFFERS buffers of 64 KiB.
+FANOUT_BUFFERS = 64
 RAW_VIDEO = ["-f", "yuv4mpegpipe", "-vcodec", "rawvideo"]
 RAW_AUDIO = [
     "-f", "s16le", "-acodec", "pcm_s16le",
     "-ac", "2", "-ar", "44100",
     ]
 SUBPROCESS_LOG = "Subprocess pid {}:\n{}"
+# The transforms files of the stabilize preset filter are kept in this
+# directory, so that the motion of a cut is analysed once. It may be
+# moved with the VID_TRANSFORMS_CACHE environment variable.
+TRANSFORMS_DIR = get_cache_dir("transforms", 'VID_TRANSFORMS_CACHE')
+# Options of the stabilize preset filter which are passed to the
+# vidstabdetect filter. The others are passed to vidstabtransform.
+DETECT_OPTIONS = {"shakiness", "accuracy", "stepsize", "mincontrast"}
+# The loudness measured by the normalize preset filter is kept in this
+# directory, so that the audio of a cut or of a music file is measured
+# once. It may be moved with the VID_LOUDNESS_CACHE environment variable.
+LOUDNESS_DIR = get_cache_dir("loudness", 'VID_LOUDNESS_CACHE')
+# Default arguments of the normalize preset filter, passed to loudnorm.
+LOUDNESS_TARGET = {'I': -16, 'TP': -1.5, 'LRA': 11}
 # Set the default font for drawtext filter.
 FONTFILE = "/usr/share/fonts/OTF/Inconsolata.otf"
 DEFAULT_PATTERN = "footage/*/M2U{number:05d}.mpg"
-OUTPUT_FORMATS = { # Generally, make keys refer to file extensions.
-    'avi': [
-        "-f", "avi",
-        "-vcodec", "libx264",
-        "-crf", "23", "-preset", "medium",
-        "-acodec", "mp3", "-strict", "experimental",
-        "-ac", "2", "-ar", "44100", "-ab", "128k",
-        "-qscale:v", "6",
-        ],
-    'ogv': [
-        "-f", "ogg",
-        "-vcodec", "libtheora",
-        "-qscale:v", "8",
-        # Max quality is 10.
-        "-acodec", "libvorbis",
-        "-qscale:a", "3",
-        ],
-    'webm': [
-        "-f", "webm",
-        "-vcodec", "libvpx", "-b:v", "2000k",
-        "-acodec", "libvorbis",
-        ],
-    # Low latency, high bandwidth for local pipe.
-    'pipe': [
-        "-f", "matroska",
-        "-vcodec", "rawvideo", # I don't use "copy" because filters may apply.
-        "-acodec", "pcm_s16le", "-ac", "2", "-ar", "44100",
-        ],
+# The built-in formats of the normal tier. Outputs are encoded in the
+# formats of vid.formats.FORMATS, in the tier of the user's choosing.
+OUTPUT_FORMATS = {
+    key: FORMATS.get(key, "normal") for key in FORMATS.formats
     }
 
 
 logger = logging.getLogger(__name__)
-logdir = os.getcwd() + "/log"
+logdir = os.path.abspath(os.getenv('VID_LOGDIR', "log"))
+# Probes and footage file names are shared by all shots of the process.
+_PROBES = {}
+_PROBES_LOCK = threading.Lock()
+_FOOTAGE = {}
 
 
 @atexit.register
@@ -116,6 +155,229 @@ def _redirect_stderr_to_log_file():              #{{{1
             continue
     sys.stderr.write(ls)
     sys.stderr.write("\n-- start stderr stream -- \n\n")
+
+
+class SchedulingPolicy():                        #{{{1
+    """Priority and CPU placement of subprocesses according to their role.
+
+    The roles are:
+    decoder -- ffmpeg processes spawned by Shot.demux();
+    mixer -- the ffmpeg process spawned by AudioProcessing;
+    encoder -- the ffmpeg process spawned by Multiplexer;
+    player -- ffplay.
+
+    Each role may be given these settings:
+    nice -- An increment to the niceness of the process;
+    ioclass -- "realtime", "best-effort" or "idle", see ionice(1);
+    iolevel -- The priority within the ioclass, 0 to 7;
+    cpus -- The cores the process may run on, as a list of integers or
+            a string such as "0-3,6".
+
+    When background is true, every process is niced by 10 more and
+    gets the idle I/O class, so that background renders yield to
+    interactive previews.
+
+    The default policy leaves processes alone.
+    """
+
+    ROLES = ("decoder", "mixer", "encoder", "player")
+    IOCLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+    BACKGROUND_NICE = 10
+
+    def __init__(self, roles=None, background=False):
+        self.logger = logging.getLogger(__name__+".SchedulingPolicy")
+        self.roles = {}
+        self.background = background
+        self._ionice = shutil.which("ionice")
+        if roles is not None:
+            self.update(roles)
+
+    def update(self, roles):
+        """Validate and merge a mapping of roles to settings."""
+        for role, settings in roles.items():
+            if role == "background":
+                self.background = bool(settings)
+                continue
+            if role not in self.ROLES:
+                raise KeyError(
+                    "Unknown role {}. Valid roles are: {}.".format(
+                        role, ", ".join(self.ROLES)
+                        )
+                    )
+            settings = dict(settings or {})
+            if not set(settings) <= {'nice', 'ioclass', 'iolevel', 'cpus'}:
+                raise KeyError(
+                    "Invalid settings for role {}: {}.".format(role, settings)
+                    )
+            if 'cpus' in settings:
+                settings['cpus'] = self._parse_cpus(settings['cpus'])
+            if ('ioclass' in settings and
+                settings['ioclass'] not in self.IOCLASSES):
+                raise ValueError(
+                    "ioclass must be one of {}.".format(
+                        ", ".join(self.IOCLASSES)
+                        )
+                    )
+            self.roles.setdefault(role, {}).update(settings)
+        return self
+
+    def load(self, filename):
+        """Update the policy with the mapping found in a YAML file."""
+        with open(filename) as f:
+            data = yaml.safe_load(f)
+        if data is None:
+            return self
+        if not isinstance(data, dict):
+            raise TypeError(
+                "Scheduling file {} must contain a mapping.".format(filename)
+                )
+        return self.update(data)
+
+    @staticmethod
+    def _parse_cpus(cpus):
+        """Return a set of integers from "0-3,6" or [0, 1, 2, 3, 6]."""
+        if isinstance(cpus, int):
+            return {cpus}
+        if isinstance(cpus, str):
+            parsed = set()
+            for part in cpus.split(","):
+                first, _, last = part.strip().partition("-")
+                parsed.update(range(int(first), int(last or first) + 1))
+            return parsed
+        return set(int(cpu) for cpu in cpus)
+
+    def get_settings(self, role):
+        """Return the settings of role, background adjustments applied."""
+        assert role in self.ROLES
+        settings = dict(self.roles.get(role, {}))
+        if self.background:
+            settings['nice'] = settings.get('nice', 0) + self.BACKGROUND_NICE
+            settings['ioclass'] = "idle"
+            settings.pop('iolevel', None)
+        return settings
+
+    def wrap_args(self, role, args):
+        """Return args prefixed with an ionice command if needed."""
+        settings = self.get_settings(role)
+        if 'ioclass' not in settings:
+            return args
+        if self._ionice is None:
+            self.logger.warning("ionice not found, I/O class ignored.")
+            return args
+        prefix = [
+            self._ionice, "-c", str(self.IOCLASSES[settings['ioclass']]),
+            ]
+        if 'iolevel' in settings and settings['ioclass'] != "idle":
+            prefix += ["-n", str(settings['iolevel'])]
+        return prefix + args
+
+    def preexec_fn(self, role):
+        """Return a function to pass as the preexec_fn to subprocess.Popen.
+
+        It redirects stderr to a log file, then applies the niceness and
+        the CPU affinity of role.
+        """
+        settings = self.get_settings(role)
+
+        def preexec():
+            _redirect_stderr_to_log_file()
+            try:
+                if settings.get('nice'):
+                    os.nice(settings['nice'])
+                if settings.get('cpus'):
+                    cpus = settings['cpus'] & os.sched_getaffinity(0)
+                    if cpus:
+                        os.sched_setaffinity(0, cpus)
+            except OSError as err:
+                sys.stderr.write("Scheduling policy not applied: {}\n".format(
+                    err
+                    ))
+            sys.stderr.write("Role: {} {}\n".format(role, settings))
+
+        return preexec
+
+
+# The policy used by every class of this module.
+SCHEDULING = SchedulingPolicy()
+
+
+class ThreadBudget():                            #{{{1
+    """Share the cores among concurrent ffmpeg processes.
+
+    Left alone, every ffmpeg process starts as many threads as there
+    are cores, and a few decoders running alongside the encoder
+    oversubscribe the machine. Instead, each process acquires a
+    ThreadAllocation which gives it a share of the cores proportional
+    to the weight of its role, counting the processes already running.
+    The share is fixed for the life of the process, but it is computed
+    again for every new process, so allocations follow the load as
+    shots start and finish.
+
+    A share is capped by the threads not yet allocated, so the sum of
+    the allocations stays within cpus. Decoders usually start before
+    the encoder, so the weight of one encoder is counted even when none
+    is running yet. A process always gets at least one thread, which is
+    the only case where the sum may exceed cpus.
+
+    Audio decoders and the mixer are cheap and are left out of the
+    budget.
+    """
+
+    WEIGHTS = {'decoder': 1, 'encoder': 2}
+
+    def __init__(self, cpus=None):
+        self.logger = logging.getLogger(__name__+".ThreadBudget")
+        self.cpus = cpus or len(os.sched_getaffinity(0))
+        self.running = {role: 0 for role in self.WEIGHTS}
+        self.allocated = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, role):
+        """Return a ThreadAllocation for a new process of the given role."""
+        with self.lock:
+            self.running[role] += 1
+            running = dict(self.running)
+            running['encoder'] = max(1, running['encoder'])
+            total = sum(self.WEIGHTS[r] * n for r, n in running.items())
+            share = self.cpus * self.WEIGHTS[role] // total
+            threads = max(1, min(share, self.cpus - self.allocated))
+            self.allocated += threads
+        self.logger.debug(
+            "{} threads for a new {}, running: {}.".format(
+                threads, role, self.running
+                )
+            )
+        return ThreadAllocation(self, role, threads)
+
+    def _release(self, role, threads):
+        with self.lock:
+            self.running[role] -= 1
+            self.allocated -= threads
+
+
+class ThreadAllocation():                        #{{{1
+    """The number of threads given to one process by a ThreadBudget."""
+
+    def __init__(self, budget, role, threads):
+        self.budget = budget
+        self.role = role
+        self.threads = threads
+        self.released = False
+
+    def __repr__(self):
+        return "<ThreadAllocation({}), threads={}>".format(
+            self.role, self.threads
+            )
+
+    def release(self):
+        """Give the threads back to the budget. May be called many times."""
+        if not self.released:
+            self.released = True
+            self.budget._release(self.role, self.threads)
+
+
+# The budget shared by every class of this module.
+THREADS = ThreadBudget()
 #}}}
 
 
@@ -291,6 +553,171 @@ class PipeHelper(threading.Thread):              #{{{1
                 self._output.close()
 
 
+class RecordStream(threading.Thread):            #{{{1
+    """Threading subclass that pipes data and records a copy in a file.
+
+    Passed parameters must be one readable file object, one writable
+    file object and one writable file object to record to. If
+    remove_header is true, the first line is piped but not recorded.
+
+    All files are closed upon completion of the task, the record first.
+    Therefore, the record is complete once output reaches end of file.
+    """
+
+    def __init__(self, input, output, record, remove_header=False):
+        self.logger = logging.getLogger(__name__+".RecordStream")
+
+        assert isinstance(input, io.IOBase)
+        assert input.readable()
+        assert isinstance(output, io.IOBase)
+        assert output.writable()
+        assert isinstance(record, io.IOBase)
+        assert record.writable()
+
+        self.input = input
+        self.output = output
+        self.record = record
+        self.remove_header = remove_header
+        self.bytes_read = 0     # Number of bytes read.
+        self.bytes_written = 0  # Number of bytes written to output.
+        self.exception = None
+
+        super(RecordStream, self).__init__(daemon=True)
+
+    def run(self):
+        self.logger.debug(
+            "Thread starting: "
+            "piping {} to {}, recording to {}.".format(
+                self.input, self.output, self.record
+                )
+            )
+        try:
+            if self.remove_header:
+                line = self.input.readline()
+                self.bytes_read += len(line)
+                self.bytes_written += self.output.write(line)
+            while True:
+                buf = self.input.read1(64 * 1024)
+                if buf == b"":
+                    break
+                self.bytes_read += len(buf)
+                self.record.write(buf)
+                self.bytes_written += self.output.write(buf)
+        except OSError as err:
+            self.exception = err
+            self.logger.warning("Pipe unexpectedly broken.")
+        finally:
+            for file in (self.input, self.record, self.output):
+                if not file.closed:
+                    file.close()
+                    self.logger.debug("Closed {}".format(file))
+
+
+class WriteBuffers(threading.Thread):            #{{{1
+    """Threading subclass that writes bytes-like objects to a file.
+
+    Passed parameters must be an iterable of bytes-like objects and one
+    writable file object, which is closed upon completion of the task.
+    The reader may close its end before the iterable is exhausted, which
+    is how endless iterables are stopped.
+    """
+
+    def __init__(self, buffers, output):
+        self.logger = logging.getLogger(__name__+".WriteBuffers")
+
+        assert isinstance(output, io.IOBase)
+        assert output.writable()
+
+        self.buffers = buffers
+        self.output = output
+        self.bytes_written = 0
+        self.exception = None
+
+        super(WriteBuffers, self).__init__(daemon=True)
+
+    def run(self):
+        self.logger.debug("Thread starting: writing to {}.".format(
+            self.output
+            ))
+        try:
+            for buf in self.buffers:
+                self.bytes_written += self.output.write(buf)
+            self.output.flush()
+        except BrokenPipeError:
+            self.logger.debug("Reader closed {}.".format(self.output))
+        except OSError as err:
+            self.exception = err
+            self.logger.warning("Pipe unexpectedly broken.")
+        finally:
+            try:
+                self.output.close()
+            except BrokenPipeError:
+                pass
+
+
+class FanOut(threading.Thread):                  #{{{1
+    """Threading subclass that copies one input to many outputs.
+
+    Passed parameters must be one readable file object and a list of
+    writable file objects. Each output is written by a WriteBuffers
+    thread of its own, fed through a queue of at most maxsize buffers:
+    a slow reader does not hold back the others until its queue is
+    full. An output whose reader went away is dropped.
+
+    All files are closed upon completion of the task.
+    """
+
+    def __init__(self, input, outputs, maxsize=FANOUT_BUFFERS):
+        self.logger = logging.getLogger(__name__+".FanOut")
+
+        assert isinstance(input, io.IOBase)
+        assert input.readable()
+
+        self.input = input
+        self.queues = [queue.Queue(maxsize) for output in outputs]
+        self.writers = [
+            WriteBuffers(iter(q.get, None), output)
+            for q, output in zip(self.queues, outputs)
+            ]
+        self.bytes_read = 0
+        self.exception = None
+
+        super(FanOut, self).__init__(daemon=True)
+
+    def run(self):
+        self.logger.debug("Thread starting: copying {} to {}.".format(
+            self.input, [writer.output for writer in self.writers]
+            ))
+        for writer in self.writers:
+            writer.start()
+        try:
+            while True:
+                buf = self.input.read1(64 * 1024)
+                if buf == b"":
+                    break
+                self.bytes_read += len(buf)
+                for q, writer in zip(self.queues, self.writers):
+                    self._put(q, writer, buf)
+        except OSError as err:
+            self.exception = err
+            self.logger.warning("Pipe unexpectedly broken.")
+        finally:
+            for q, writer in zip(self.queues, self.writers):
+                self._put(q, writer, None)
+            self.input.close()
+            for writer in self.writers:
+                writer.join()
+
+    def _put(self, q, writer, item):
+        # Block while the queue is full, unless nobody empties it.
+        while writer.is_alive():
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                self.logger.debug("Waiting for {}.".format(writer.output))
+
+
 class GenerateSilence(threading.Thread):         #{{{1
     """Threading subclass that pipes raw audio replacing all bytes with zeroes.
     """
@@ -432,9 +859,15 @@ class ConcatenateShots(threading.Thread):        #{{{1
     file object to write video and another for audio.
 
     Queued objects must be Shot instances, and None to signal end of queue.
+
+    The optional repeated argument maps the specs of shots that appear
+    more than once in the queue to their number of occurrences, as
+    returned by find_repeated_shots(). Those shots are demuxed once,
+    their streams recorded in scratch files and replayed at their later
+    positions.
     """
 
-    def __init__(self, q, v_out, a_out):
+    def __init__(self, q, v_out, a_out, repeated=None):
         self.logger = logging.getLogger(__name__+".ConcatenateShots")
 
         assert isinstance(q, queue.Queue)
@@ -453,6 +886,10 @@ class ConcatenateShots(threading.Thread):        #{{{1
         self.a_queue = queue.Queue()
         self.v_out = v_out
         self.a_out = a_out
+        self.repeated = dict(repeated or {})
+        # Maps specs to the recorded (video, audio) file names.
+        self.recordings = {}
+        self.scratch = None
 
         super(ConcatenateShots, self).__init__(daemon=True)
 
@@ -476,6 +913,12 @@ class ConcatenateShots(threading.Thread):        #{{{1
                     self.queue.task_done()
                     raise queue.Empty
                 assert isinstance(shot, Shot)
+                spec = shot.get_spec() if self.repeated else None
+                if spec in self.recordings:
+                    self.logger.debug("Replaying {}.".format(shot))
+                    self._replay(spec)
+                    i += 1
+                    continue
                 buffer.append(shot.dur or 0)  # In case shot.dur is None
                 if (sum(buffer) < min_buffer and
                     not self.semaphore.acquire(blocking=False)
@@ -491,6 +934,8 @@ class ConcatenateShots(threading.Thread):        #{{{1
                     "Concatenating {}.".format(shot)
                     )
                 shot.demux(remove_header=i)
+                if spec in self.repeated:
+                    self._record(shot, spec, remove_header=i == 0)
                 i += 1
                 self.v_queue.put(shot.v_stream)
                 self.a_queue.put(shot.a_stream)
@@ -506,6 +951,53 @@ class ConcatenateShots(threading.Thread):        #{{{1
             self.exception = err
             raise
 
+    def _record(self, shot, spec, remove_header):
+        """Pipe the streams of shot through RecordStream threads.
+
+        The yuv4mpeg header is never recorded, since replays never start
+        the movie.
+        """
+        if self.scratch is None:
+            os.makedirs(logdir, exist_ok=True)
+            self.scratch = tempfile.mkdtemp(prefix="replay-", dir=logdir)
+        n = len(self.recordings)
+        files = (
+            os.path.join(self.scratch, "{}.y4m".format(n)),
+            os.path.join(self.scratch, "{}.pcm".format(n)),
+            )
+        streams = []
+        for stream, file, header in zip(
+                (shot.v_stream, shot.a_stream), files, (remove_header, False)
+                ):
+            r, w = os.pipe()
+            RecordStream(
+                stream, open(w, "wb"), open(file, "wb"), header,
+                ).start()
+            streams.append(open(r, "rb"))
+        shot.v_stream, shot.a_stream = streams
+        self.recordings[spec] = files
+        self.repeated[spec] -= 1
+        self.logger.debug("Recording {} to {}.".format(shot, files))
+
+    def _replay(self, spec):
+        """Queue the recorded streams of spec.
+
+        The files are read by ConcatenateStreams only after the recorded
+        shot reached end of file, at which point the record is complete.
+        """
+        files = self.recordings[spec]
+        self.v_queue.put(open(files[0], "rb"))
+        self.a_queue.put(open(files[1], "rb"))
+        self.repeated[spec] -= 1
+        if self.repeated[spec] == 0:
+            # Open files outlive their names.
+            for file in files:
+                os.remove(file)
+            del self.recordings[spec]
+            if not self.recordings:
+                os.rmdir(self.scratch)
+                self.scratch = None
+
 
 class FFmpegWrapper():                           #{{{1
     """Provides utilities for subclasses that spawn ffmpeg subprocesses."""
@@ -540,7 +1032,38 @@ class FFmpegWrapper():                           #{{{1
             )
         return ["-filter:a", self._escape_filterchain(self.af)]
 
-    def _escape_filterchain(self, filters_list):
+    @staticmethod
+    def _split_streams(v_label, a_label, heights):
+        """Return the filterchains feeding every output from one stream.
+
+        heights has one item per output: the height to which its video
+        is scaled, or None. Returns a list of filterchains and a list of
+        ("[v]", "[a]") label tuples, one per output.
+        """
+        graph = []
+        if len(heights) == 1:
+            v_labels, a_labels = [v_label], [a_label]
+        else:
+            v_labels = ["[vout{}]".format(n) for n in range(len(heights))]
+            a_labels = ["[aout{}]".format(n) for n in range(len(heights))]
+            graph.append("{}split={}{}".format(
+                v_label, len(heights), "".join(v_labels)
+                ))
+            graph.append("{}asplit={}{}".format(
+                a_label, len(heights), "".join(a_labels)
+                ))
+        for n, height in enumerate(heights):
+            if height is None:
+                continue
+            # -2 keeps the aspect ratio with an even width.
+            graph.append("{}scale=-2:{}[vscale{}]".format(
+                v_labels[n], height, n
+                ))
+            v_labels[n] = "[vscale{}]".format(n)
+        return graph, list(zip(v_labels, a_labels))
+
+    @staticmethod
+    def _escape_filterchain(filters_list):
         """Transform filters_list into an FFmpeg filtergraph syntax string.
 
         Parameter filters_list is list of lists of 2 items.
@@ -657,6 +1180,160 @@ class FFmpegWrapper():                           #{{{1
         return self
 
 
+def _cached_analysis(directory, identity, suffix, analyse): #{{{1
+    """Return the path of the result of an analysis, running it if needed.
+
+    The result is stored in directory under a hash of identity, which
+    must be serializable to JSON. analyse is called with a temporary
+    file name to write the result to.
+    """
+    data = json.dumps(identity, sort_keys=True, default=str)
+    key = hashlib.sha1(data.encode()).hexdigest()
+    path = os.path.join(directory, key + suffix)
+    if os.path.exists(path):
+        logger.debug("Found analysis {}.".format(path))
+        return path
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    os.close(fd)
+    try:
+        analyse(tmp)
+        # Other processes never see a partial result.
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    logger.debug("Stored analysis {}.".format(path))
+    return path
+
+
+def _get_source(filename):                       #{{{1
+    """Return the identity of a file: its path, size and mtime."""
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_size, st.st_mtime_ns]
+
+
+def _run_analysis(args, role="decoder"):         #{{{1
+    """Run an ffmpeg analysis and return its standard error output."""
+    args = SCHEDULING.wrap_args(role, args)
+    process = subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        preexec_fn=SCHEDULING.preexec_fn(role),
+        )
+    logger.debug(SUBPROCESS_LOG.format(process.pid, args))
+    stderr = process.communicate()[1]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return stderr.decode(errors="replace")
+
+
+def _measure_loudness(args, af, target, path):   #{{{1
+    """Measure the loudness of the audio of an ffmpeg input.
+
+    args are the ffmpeg arguments up to the output options and af the
+    audio filters to measure after. Video is not decoded. The
+    measurement printed by the loudnorm filter is saved to path.
+    """
+    loudnorm = ("loudnorm", dict(target, print_format="json"))
+    args = args + [
+        "-vn", "-filter:a", FFmpegWrapper._escape_filterchain(
+            list(af) + [loudnorm]
+            ),
+        "-f", "null", "-",
+        ]
+    # The measurement is the last thing loudnorm prints. Debug output
+    # would only make it longer.
+    args[args.index("-loglevel") + 1] = "info"
+    stderr = _run_analysis(args)
+    measured = json.loads(stderr[stderr.rindex("{"):stderr.rindex("}")+1])
+    with open(path, "w") as f:
+        json.dump(measured, f)
+
+
+def get_loudness(filename, **target):            #{{{1
+    """Return the loudness of an audio file, such as the music.
+
+    The measurement is cached in LOUDNESS_DIR. See Shot.get_loudness().
+    """
+    target = dict(LOUDNESS_TARGET, **target)
+    identity = {'source': _get_source(filename), 'target': target}
+    path = _cached_analysis(
+        LOUDNESS_DIR, identity, ".json",
+        lambda tmp: _measure_loudness(
+            ["ffmpeg", "-loglevel", "debug", "-y", "-i", filename],
+            [], target, tmp,
+            ),
+        )
+    with open(path) as f:
+        return json.load(f)
+
+
+def combine_loudness(parts):                     #{{{1
+    """Estimate the loudness of parts played one after the other.
+
+    parts is a list of (duration, measurement) tuples, the measurements
+    being those returned by get_loudness(), or None for silence. The
+    integrated loudness is the average of the energy of the parts
+    weighted by their durations. The true peak and the loudness range
+    are those of the loudest part.
+    """
+    total = sum(duration for duration, measured in parts)
+    energy = 0
+    peak = lra = float("-inf")
+    for duration, measured in parts:
+        if measured is None:
+            continue
+        energy += duration * 10 ** (float(measured['input_i']) / 10)
+        peak = max(peak, float(measured['input_tp']))
+        lra = max(lra, float(measured['input_lra']))
+    if not total or not energy:
+        return None
+    loudness = 10 * math.log10(energy / total)
+    return {
+        'input_i': "{:.2f}".format(loudness),
+        'input_tp': "{:.2f}".format(peak),
+        'input_lra': "{:.2f}".format(lra),
+        # loudnorm's relative gate is 10 LU under the integrated loudness.
+        'input_thresh': "{:.2f}".format(loudness - 10),
+        'target_offset': "0.00",
+        }
+
+
+def _normalize_filters(target, measured):        #{{{1
+    """Return the second pass of loudnorm for a measurement."""
+    if measured is None:
+        # Silence is not amplified.
+        return []
+    options = dict(target)
+    options.update(
+        measured_I=measured['input_i'],
+        measured_TP=measured['input_tp'],
+        measured_LRA=measured['input_lra'],
+        measured_thresh=measured['input_thresh'],
+        offset=measured['target_offset'],
+        linear="true",
+        )
+    # loudnorm upsamples to 192 kHz.
+    return [("loudnorm", options), ("aresample", {'out_sample_rate': 44100})]
+
+
+def _find_footage(pathname):                     #{{{1
+    """Return the first file matching pathname.
+
+    Results are remembered for as long as the file exists, so that a
+    long-running process does not search the same directories again.
+    Raises IndexError if no file matches.
+    """
+    name = _FOOTAGE.get(pathname)
+    if name is None or not os.path.exists(name):
+        name = glob.glob(pathname)[0]
+        _FOOTAGE[pathname] = name
+    return name
+
+
 class Shot(FFmpegWrapper):                       #{{{1
     """Abstraction for a movie file copied from the camcorder.
 
@@ -672,7 +1349,7 @@ class Shot(FFmpegWrapper):                       #{{{1
         self.logger = logging.getLogger(__name__+".Shot")
         self.number = int(number)
         try:
-            self.name = glob.glob(pattern.format(number=self.number))[0]
+            self.name = _find_footage(pattern.format(number=self.number))
         except IndexError as err:
             self.name = None
             raise FileNotFoundError(
@@ -681,12 +1358,14 @@ class Shot(FFmpegWrapper):                       #{{{1
                 ) from err
         except :
             self.logger.exception("That's a new exception?!")
-        self._probe = Probe(self.name)
+        self._probe = Probe.get(self.name)
         self.cut(seek, dur)
         self.process = None
         self.v_stream = None
         self.a_stream = None
         self.silent = silent
+        # True when timecodes are burned on the video, see append_vf().
+        self.showdata = False
         self.vf = [("yadif", {})]  # Always deinterlace.
         self.af = []
         if vf is not None:
@@ -715,6 +1394,15 @@ class Shot(FFmpegWrapper):                       #{{{1
         duration = endtime - starttime
         return duration if duration > 0 else 0
 
+    def get_spec(self):
+        """Return a string identifying the raw streams of the shot.
+
+        Two shots with the same spec demux to the same bytes.
+        """
+        return json.dumps(
+            [self._video_args("-"), self._audio_args("-"), self.silent]
+            )
+
     def demux(self, video=True, audio=True, remove_header=False):
         """Return readable video and audio streams.
 
@@ -732,19 +1420,13 @@ class Shot(FFmpegWrapper):                       #{{{1
         I call one subprocess per stream.
         """
         assert video or audio
-        args = ["ffmpeg", "-loglevel", "debug", "-y"]
         write_fds = []
         returnvalue = []
         self.logger.debug("Demuxing {}.".format(self))
 
-        # Define input arguments.
-        if self.fastseek:
-            args += ["-ss", str(self.fastseek)]
-        args += ["-i", self.name]
-
         # Define video arguments.
         if video:
-            v_args = args[:]  # Shallow copy.
+            threads = THREADS.acquire("decoder")
             if remove_header:
                 video1_r, video1_w = os.pipe()
                 video2_r, video2_w = os.pipe()
@@ -758,12 +1440,9 @@ class Shot(FFmpegWrapper):                       #{{{1
                 t = RemoveHeader(open(video1_r, "rb"), open(video2_w, "wb"))
                 write_fds.append(video1_w)
                 self.v_stream = open(video2_r, "rb")
-                if self.slowseek:
-                    v_args += ["-ss", str(self.slowseek)]
-                if self.dur:
-                    v_args += ["-t", str(self.dur)]
-                v_args += self._format_vf()
-                v_args += RAW_VIDEO + ["-an", "pipe:{}".format(video1_w)]
+                v_args = self._video_args(
+                    "pipe:{}".format(video1_w), threads.threads,
+                    )
                 t.start()
             else:
                 video_r, video_w = os.pipe()
@@ -775,31 +1454,33 @@ class Shot(FFmpegWrapper):                       #{{{1
                     )
                 write_fds.append(video_w)
                 self.v_stream = open(video_r, "rb")
-                if self.slowseek:
-                    v_args += ["-ss", str(self.slowseek)]
-                if self.dur:
-                    v_args += ["-t", str(self.dur)]
-                v_args += self._format_vf()
-                v_args += RAW_VIDEO + ["-an", "pipe:{}".format(video_w)]
+                v_args = self._video_args(
+                    "pipe:{}".format(video_w), threads.threads,
+                    )
             returnvalue.append(self.v_stream)
 
             # Create subprocess
+            v_args = SCHEDULING.wrap_args("decoder", v_args)
             self.v_process = subprocess.Popen(
                 v_args,
                 pass_fds=write_fds,
                 stdout=subprocess.DEVNULL,
                 stdin=subprocess.DEVNULL,
-                preexec_fn=_redirect_stderr_to_log_file,
+                preexec_fn=SCHEDULING.preexec_fn("decoder"),
                 )
             self.logger.debug(
                 SUBPROCESS_LOG.format(
                     self.v_process.pid, v_args
                     )
                 )
+            SubprocessSupervisor(
+                (self.v_process.wait,),
+                threads.release,
+                name="Releasing {}.".format(threads),
+                ).start()
 
         # Define audio arguments
         if audio:
-            a_args = args[:]  # Shallow copy
             if self.silent:
                 audio1_r, audio1_w = os.pipe()
                 audio2_r, audio2_w = os.pipe()
@@ -814,12 +1495,7 @@ class Shot(FFmpegWrapper):                       #{{{1
                 t = GenerateSilence(open(audio1_r, "rb"), open(audio2_w, "wb"))
                 write_fds.append(audio1_w)
                 self.a_stream = open(audio2_r, "rb")
-                if self.slowseek:
-                    a_args += ["-ss", str(self.slowseek)]
-                if self.dur:
-                    a_args += ["-t", str(self.dur)]
-                a_args += self._format_af()
-                a_args += RAW_AUDIO + ["-vn", "pipe:{}".format(audio1_w)]
+                a_args = self._audio_args("pipe:{}".format(audio1_w))
                 t.start()
             else:
                 audio_r, audio_w = os.pipe()
@@ -831,21 +1507,17 @@ class Shot(FFmpegWrapper):                       #{{{1
                         )
                     )
                 write_fds.append(audio_w)
-                if self.slowseek:
-                    a_args += ["-ss", str(self.slowseek)]
-                if self.dur:
-                    a_args += ["-t", str(self.dur)]
-                a_args += self._format_af()
-                a_args += RAW_AUDIO + ["-vn", "pipe:{}".format(audio_w)]
+                a_args = self._audio_args("pipe:{}".format(audio_w))
             returnvalue.append(self.a_stream)
 
             # Create subprocess.
+            a_args = SCHEDULING.wrap_args("decoder", a_args)
             self.a_process = subprocess.Popen(
                 a_args,
                 pass_fds=(audio_w,),
                 stdout=subprocess.DEVNULL,
                 stdin=subprocess.DEVNULL,
-                preexec_fn=_redirect_stderr_to_log_file,
+                preexec_fn=SCHEDULING.preexec_fn("decoder"),
                 )
             self.logger.debug(
                 SUBPROCESS_LOG.format(
@@ -858,6 +1530,53 @@ class Shot(FFmpegWrapper):                       #{{{1
         self.logger.debug("Streams returned: {}.".format(returnvalue))
         return tuple(returnvalue)
 
+    def _input_args(self, threads=None):
+        """Return ffmpeg arguments up to and including the input file.
+
+        If threads is given, it limits the decoder and filter threads.
+        """
+        args = ["ffmpeg", "-loglevel", "debug", "-y"]
+        if threads:
+            args += ["-filter_threads", str(threads), "-threads", str(threads)]
+        if self.fastseek:
+            args += ["-ss", str(self.fastseek)]
+        args += ["-i", self.name]
+        return args
+
+    def _cut_args(self):
+        """Return the output seek and duration ffmpeg arguments."""
+        args = []
+        if self.slowseek:
+            args += ["-ss", str(self.slowseek)]
+        if self.dur:
+            args += ["-t", str(self.dur)]
+        return args
+
+    def _video_args(self, output, threads=None):
+        """Return the ffmpeg arguments to write raw video to output."""
+        return (self._input_args(threads) + self._cut_args() +
+                self._format_vf() + RAW_VIDEO + ["-an", output])
+
+    def _audio_args(self, output):
+        """Return the ffmpeg arguments to write raw audio to output."""
+        return (self._input_args() + self._cut_args() + self._format_af() +
+                RAW_AUDIO + ["-vn", output])
+
+    @staticmethod
+    def _split_seek(seek):
+        """Return the seeks before and after -i reaching seek.
+
+        The first, None if the whole seek is accurate, seeks quickly to
+        a keyframe FASTSEEK_THRESHOLD - 10 seconds before seek. The
+        second decodes frames up to seek.
+        """
+        if (FASTSEEK_THRESHOLD is not None and
+            FASTSEEK_THRESHOLD > 10 and
+            seek > FASTSEEK_THRESHOLD
+            ):
+            return seek - (FASTSEEK_THRESHOLD - 10), FASTSEEK_THRESHOLD - 10
+        return None, seek
+
     def cut(self, seek=0, dur=None):
         """Sets the starting position and duration of the output stream.
 
@@ -876,16 +1595,7 @@ class Shot(FFmpegWrapper):                       #{{{1
             assert isinstance(seek, (int, float))
         self.seek = seek
         self.dur = dur
-
-        if (FASTSEEK_THRESHOLD is not None and
-            FASTSEEK_THRESHOLD > 10 and
-            self.seek > FASTSEEK_THRESHOLD
-            ):
-            self.fastseek = self.seek - (FASTSEEK_THRESHOLD - 10)
-            self.slowseek = FASTSEEK_THRESHOLD - 10
-        else:
-            self.fastseek = None
-            self.slowseek = self.seek
+        self.fastseek, self.slowseek = self._split_seek(self.seek)
 
         # Validate end time against length of file.
         endtime = seek + (dur if dur is not None else 0)
@@ -908,9 +1618,14 @@ class Shot(FFmpegWrapper):                       #{{{1
     def append_vf(self, filtername, **kwargs):
         """Append a video filter to the video stream filtergraph.
 
-        Provides preset filter "showdata" and calls parent class'
-        append_vf method.
+        Provides preset filters "showdata" and "stabilize" and calls
+        parent class' append_vf method.
 
+        Like "showdata", "stabilize" depends on the cut, so it must be
+        appended after cut() is called. It analyses the motion of the
+        cut with the vidstabdetect filter, then appends a
+        vidstabtransform filter which reads the result. The result is
+        cached in TRANSFORMS_DIR, see _get_transforms().
         """
         self.logger.debug(
             "Adding video filter {} with options {}.".format(
@@ -918,6 +1633,7 @@ class Shot(FFmpegWrapper):                       #{{{1
                 )
             )
         if filtername == "showdata":
+            self.showdata = True
             # Add a gliding cursor which indicates the current position
             # along the bottom of the frame.
             self.append_vf(
@@ -947,10 +1663,291 @@ class Shot(FFmpegWrapper):                       #{{{1
                 x="30",
                 box="1",
                 )
+        elif filtername == "stabilize":
+            detect = {k: v for k, v in kwargs.items() if k in DETECT_OPTIONS}
+            transform = {
+                k: v for k, v in kwargs.items() if k not in DETECT_OPTIONS
+                }
+            if 'tripod' in kwargs:
+                # Tripod mode is an option of both filters.
+                detect['tripod'] = kwargs['tripod']
+            transform['input'] = self._get_transforms(detect)
+            super().append_vf("vidstabtransform", **transform)
         else:
             super().append_vf(filtername, **kwargs)
         return self
 
+    def _get_transforms(self, options):
+        """Return the vidstabdetect result for the cut and filters so far.
+
+        The analysis decodes the whole cut. Its result is stored under a
+        hash of the identity of the source file (path, size and
+        modification time), the cut, the video filters and the options,
+        and read from there by later calls.
+        """
+        identity = {
+            'source': _get_source(self.name),
+            'seek': self.seek,
+            'dur': self.dur,
+            'vf': self.vf,
+            'options': options,
+            }
+
+        def analyse(tmp):
+            threads = THREADS.acquire("decoder")
+            try:
+                _run_analysis(
+                    self._input_args(threads.threads) + self._cut_args() +
+                    ["-filter:v", self._escape_filterchain(
+                        self.vf +
+                        [("vidstabdetect", dict(options, result=tmp))]
+                        )] +
+                    ["-an", "-f", "null", "-"]
+                    )
+            finally:
+                threads.release()
+
+        return _cached_analysis(TRANSFORMS_DIR, identity, ".trf", analyse)
+
+    def append_af(self, filtername, **kwargs):
+        """Append an audio filter to the audio stream filtergraph.
+
+        Provides preset filter "normalize", the second pass of the
+        loudnorm filter for the cut and the filters so far. The first
+        pass is cached, see get_loudness(). Arguments are those of
+        loudnorm, with LOUDNESS_TARGET as defaults.
+        """
+        if filtername == "normalize":
+            target = dict(LOUDNESS_TARGET, **kwargs)
+            for filter in _normalize_filters(
+                    target, self.get_loudness(**target)
+                    ):
+                super().append_af(filter[0], **filter[1])
+        else:
+            super().append_af(filtername, **kwargs)
+        return self
+
+    def get_loudness(self, **target):
+        """Return the loudness of the audio of the cut, as filtered so far.
+
+        The return value is the measurement printed by the first pass of
+        the loudnorm filter, or None if the shot is silent. Only the
+        audio is decoded. The measurement is cached in LOUDNESS_DIR under
+        a hash of the identity of the source file, the cut, the audio
+        filters and the target.
+        """
+        if self.silent:
+            return None
+        target = dict(LOUDNESS_TARGET, **target)
+        identity = {
+            'source': _get_source(self.name),
+            'seek': self.seek,
+            'dur': self.dur,
+            'af': self.af,
+            'target': target,
+            }
+        path = _cached_analysis(
+            LOUDNESS_DIR, identity, ".json",
+            lambda tmp: _measure_loudness(
+                self._input_args() + self._cut_args(), self.af, target, tmp,
+                ),
+            )
+        with open(path) as f:
+            return json.load(f)
+
+
+class ShotGroup(Shot):                           #{{{1
+    """Consecutive cuts from the same file, demuxed as one shot.
+
+    Each of the two demuxing processes seeks once to the first cut and
+    decodes the span of the file covered by the cuts. The cuts are
+    extracted with the trim and atrim filters and joined with the
+    concat filter. This saves the start-up, file opening and seeking
+    cost of one ffmpeg per cut. The file is seeked like for the first
+    cut alone, so the trim filters start on the same frames as the cuts
+    of Shot.
+
+    The shots must use the same file, filters and silent setting, have
+    a duration, and be in ascending, non-overlapping order. See
+    coalesce_shots().
+    """
+
+    def __init__(self, shots):
+        self.logger = logging.getLogger(__name__+".ShotGroup")
+        assert len(shots) > 1
+        first = shots[0]
+        self.shots = list(shots)
+        self.number = first.number
+        self.name = first.name
+        self._probe = first._probe
+        self.seek = first.seek
+        self.dur = sum(shot.dur for shot in shots)
+        # Only the seek before -i applies: the trim filters do the rest.
+        self.fastseek, self.slowseek = self._split_seek(self.seek)
+        self.process = None
+        self.v_stream = None
+        self.a_stream = None
+        self.silent = first.silent
+        self.showdata = False
+        self.vf = first.vf
+        self.af = first.af
+
+    def __repr__(self):
+        return "<ShotGroup({}), cuts={}>".format(
+            self.number,
+            [(shot.seek, shot.dur) for shot in self.shots],
+            )
+
+    def get_duration(self):
+        return sum(shot.get_duration() for shot in self.shots)
+
+    def get_loudness(self, **target):
+        return combine_loudness([
+            (shot.get_duration(), shot.get_loudness(**target))
+            for shot in self.shots
+            ])
+
+    def _filtergraph(self, stream):
+        """Return the filtergraph that cuts and joins the video or audio.
+
+        stream is "v" or "a". The graph looks like this for two cuts:
+        [0:v]split=2[s0][s1];
+        [s0]trim=start=0:end=1,setpts=PTS-STARTPTS,yadif[c0];
+        [s1]trim=start=5:end=7,setpts=PTS-STARTPTS,yadif[c1];
+        [c0][c1]concat=n=2:v=1:a=0[out]
+        """
+        if stream == "v":
+            split, trim, setpts, filters = "split", "trim", "setpts", self.vf
+            concat = "v=1:a=0"
+        else:
+            split, trim, setpts, filters = (
+                "asplit", "atrim", "asetpts", self.af
+                )
+            concat = "v=0:a=1"
+        n = len(self.shots)
+        graph = ["[0:{}]{}={}{}".format(
+            stream, split, n, "".join("[s{}]".format(i) for i in range(n))
+            )]
+        for i, shot in enumerate(self.shots):
+            # Timestamps start at the seek before -i.
+            start = shot.seek - (self.fastseek or 0)
+            chain = "[s{}]{}=start={}:end={},{}=PTS-STARTPTS".format(
+                i, trim, start, start + shot.dur, setpts,
+                )
+            if filters:
+                chain += "," + self._escape_filterchain(filters)
+            graph.append(chain + "[c{}]".format(i))
+        graph.append("{}concat=n={}:{}[out]".format(
+            "".join("[c{}]".format(i) for i in range(n)), n, concat
+            ))
+        return ";".join(graph)
+
+    def _video_args(self, output, threads=None):
+        return (self._input_args(threads) +
+                ["-filter_complex", self._filtergraph("v"), "-map", "[out]"] +
+                RAW_VIDEO + ["-an", output])
+
+    def _audio_args(self, output):
+        return (self._input_args() +
+                ["-filter_complex", self._filtergraph("a"), "-map", "[out]"] +
+                RAW_AUDIO + ["-vn", output])
+
+
+def coalesce_shots(shots):                       #{{{1
+    """Return shots with runs of short cuts replaced by ShotGroups.
+
+    Consecutive shots are grouped when they cut the same file with the
+    same filters and silent setting, when each lasts at most
+    COALESCE_THRESHOLD seconds, when each starts after the previous one
+    ends, and when the whole group spans at most COALESCE_SPAN seconds
+    of the file.
+
+    Shots with the "showdata" filter are left alone: trim and setpts
+    would make the burned timecodes relative to the group.
+    """
+    def short(shot):
+        return (shot.dur is not None and
+                not isinstance(shot, ShotGroup) and
+                not shot.showdata and
+                shot.dur <= COALESCE_THRESHOLD)
+
+    def fits(run, shot):
+        last = run[-1]
+        return (shot.name == last.name and
+                shot.vf == last.vf and
+                shot.af == last.af and
+                shot.silent == last.silent and
+                shot.seek >= last.seek + last.dur and
+                shot.seek + shot.dur - run[0].seek <= COALESCE_SPAN)
+
+    if COALESCE_THRESHOLD is None:
+        return list(shots)
+    coalesced = []
+    run = []
+    for shot in list(shots) + [None]:
+        if shot is not None and short(shot) and run and fits(run, shot):
+            run.append(shot)
+            continue
+        if len(run) > 1:
+            coalesced.append(ShotGroup(run))
+        else:
+            coalesced += run
+        if shot is not None and short(shot):
+            run = [shot]
+        else:
+            run = []
+            if shot is not None:
+                coalesced.append(shot)
+    return coalesced
+
+
+def get_raw_size(shot):                          #{{{1
+    """Estimate the size in bytes of the raw streams of shot."""
+    stream = shot._probe.get_stream("video")
+    try:
+        rate = float(fractions.Fraction(stream.get('avg_frame_rate')))
+    except (TypeError, ValueError, ZeroDivisionError):
+        rate = 0
+    frame = (stream.get('width', 0) * stream.get('height', 0) *
+             PIXEL_SIZES.get(stream.get('pix_fmt'), 4))
+    # RAW_AUDIO is 16 bits stereo at 44100 Hz.
+    return int(shot.get_duration() * (rate * frame + 4 * 44100))
+
+
+def find_repeated_shots(shots, max_size=None):   #{{{1
+    """Return the specs of shots that appear more than once in shots.
+
+    The return value maps Shot.get_spec() values to their number of
+    occurrences, as expected by ConcatenateShots. Shots without a
+    duration or lasting more than REPLAY_THRESHOLD seconds are left out,
+    and so are those whose raw streams, added to those of the shots
+    before, would take more than max_size bytes, by default REPLAY_SIZE
+    megabytes.
+    """
+    if REPLAY_THRESHOLD is None:
+        return {}
+    if max_size is None:
+        max_size = REPLAY_SIZE * 1024 * 1024
+    counts = {}
+    # The first occurrence of each spec, in order.
+    first = {}
+    for shot in shots:
+        if shot.dur is None or shot.dur > REPLAY_THRESHOLD:
+            continue
+        spec = shot.get_spec()
+        counts[spec] = counts.get(spec, 0) + 1
+        first.setdefault(spec, shot)
+    repeated = {}
+    size = 0
+    for spec, shot in first.items():
+        if counts[spec] < 2:
+            continue
+        size += get_raw_size(shot)
+        if size > max_size:
+            break
+        repeated[spec] = counts[spec]
+    return repeated
+
 
 class Player():                                  #{{{1
     """A wrapper for ffplay.
@@ -978,12 +1975,13 @@ class Player():                                  #{{{1
                     type(file)
                     )
                 )
+        args = SCHEDULING.wrap_args("player", args)
         self.process = subprocess.Popen(
             args,
             stdin=file,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
-            preexec_fn=_redirect_stderr_to_log_file,
+            preexec_fn=SCHEDULING.preexec_fn("player"),
             )
         self.logger.debug(
             SUBPROCESS_LOG.format(
@@ -998,11 +1996,72 @@ class Player():                                  #{{{1
             file.close()
             self.logger.debug("Closed file object {}.".format(file))
 
+def parse_output(output):                        #{{{1
+    """Parse an output file name given on the command line.
+
+    "movie.webm" is returned unchanged. "movie-360.webm@360" is returned
+    as ("movie-360.webm", formatlist, 360), an output scaled to a height
+    of 360 pixels. See Multiplexer.write_to_files().
+    """
+    match = re.fullmatch(r"(.+)@(\d+)", output)
+    if match is None:
+        return output
+    name, height = match.group(1), int(match.group(2))
+    return name, FORMATS.get_output_format(name), height
+
+
+def get_output_name(file):                       #{{{1
+    """Return the file name of an output.
+
+    See Multiplexer.write_to_files() for the accepted arguments.
+    """
+    if isinstance(file, tuple):
+        return file[0]
+    return file
+
+
+def get_output_format(file):                     #{{{1
+    """Return the format list of an output.
+
+    The format of a file name is looked up in FORMATS, in its current
+    tier. See Multiplexer.write_to_files() for the accepted arguments.
+    """
+    if isinstance(file, tuple):
+        return file[1]
+    assert isinstance(file, str)
+    return FORMATS.get_output_format(file)
+
+
+def make_output_dirs(files):                     #{{{1
+    """Create the missing directories of the outputs.
+
+    HLS playlists, for instance, are written to a directory of their
+    own with their segments.
+    """
+    for file in files:
+        directory = os.path.dirname(get_output_name(file))
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+
+def get_output_height(file):                     #{{{1
+    """Return the height to which an output is scaled, or None."""
+    if isinstance(file, tuple) and len(file) > 2:
+        return file[2]
+    return None
+
+
 class Multiplexer(FFmpegWrapper):                #{{{1
-    """Multiplex video and audio stream in a container format."""
+    """Multiplex video and audio stream in a container format.
 
-    def __init__(self, v_stream, a_stream):
+    shots and music are what the audio stream is made of. They are only
+    needed by the normalize preset filter, see append_af().
+    """
+
+    def __init__(self, v_stream, a_stream, shots=(), music=None):
         self.logger = logging.getLogger(__name__+".Multiplexer")
+        self.shots = list(shots)
+        self.music = music
         self.v_fd = self._get_fileno(v_stream)
         self.a_fd = self._get_fileno(a_stream)
         self._args = [
@@ -1010,30 +2069,39 @@ class Multiplexer(FFmpegWrapper):                #{{{1
             ] + RAW_VIDEO + ["-i", "pipe:{}".format(self.v_fd),
             ] + RAW_AUDIO + ["-i", "pipe:{}".format(self.a_fd),
             ]
+        # The processes encoding the outputs, see write_to_files().
+        self.encoders = []
         super().__init__()
 
     def mux(self, format=OUTPUT_FORMATS['pipe']):
         self.logger.debug("Muxing video {} and audio {}.".format(
             self.v_fd, self.a_fd))
         if isinstance(format, str):
-            format = OUTPUT_FORMATS[format]
+            format = FORMATS.get(format)
         else:
             assert isinstance(format, list)
-        args = (self._args + self._format_vf() + self._format_af() +
-                format + ["pipe:1"])
+        threads = THREADS.acquire("encoder")
+        args = (self._args + self._thread_args(threads.threads) +
+                self._format_vf() + self._format_af() + format + ["pipe:1"])
+        args = SCHEDULING.wrap_args("encoder", args)
         self.process = subprocess.Popen(
             args,
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL,
             pass_fds=(self.v_fd, self.a_fd),
-            preexec_fn=_redirect_stderr_to_log_file,
+            preexec_fn=SCHEDULING.preexec_fn("encoder"),
             )
         self.logger.debug(
             SUBPROCESS_LOG.format(
                 self.process.pid, args
                 )
             )
+        SubprocessSupervisor(
+            (self.process.wait,),
+            threads.release,
+            name="Releasing {}.".format(threads),
+            ).start()
         os.close(self.v_fd)
         os.close(self.a_fd)
         self.output = self.process.stdout
@@ -1045,46 +2113,92 @@ class Multiplexer(FFmpegWrapper):                #{{{1
             )
         return self.process.stdout
 
-    def write_to_files(self, *files):
+    def stream(self, output, format="webm"):
+        """Multiplex streams and write them to output while encoding.
+
+        output is a file descriptor, an object with a fileno() method
+        such as an open file or a socket, or "-" for the standard
+        output. format is a key of FORMATS or a list of arguments.
+        Containers which would seek back to finish the file, such as
+        MP4, are written as fragments. Use wait() to wait for the end.
+        """
+        fd = 1 if output == "-" else self._get_fileno(output)
+        if fd is None:
+            raise ValueError("Can't stream to {}.".format(output))
+        if isinstance(format, str):
+            format = FORMATS.get(format)
+        format = get_stream_format(format)
+        self.logger.debug("Streaming video {} and audio {} to {}.".format(
+            self.v_fd, self.a_fd, fd
+            ))
+        threads = THREADS.acquire("encoder")
+        args = (self._args + self._thread_args(threads.threads) +
+                self._format_vf() + self._format_af() + format + ["pipe:1"])
+        args = SCHEDULING.wrap_args("encoder", args)
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=fd,
+            stderr=subprocess.DEVNULL,
+            pass_fds=(self.v_fd, self.a_fd),
+            preexec_fn=SCHEDULING.preexec_fn("encoder"),
+            )
+        self.logger.debug(SUBPROCESS_LOG.format(self.process.pid, args))
+        SubprocessSupervisor(
+            (self.process.wait,),
+            threads.release,
+            name="Releasing {}.".format(threads),
+            ).start()
+        os.close(self.v_fd)
+        os.close(self.a_fd)
+
+    def write_to_files(self, *files, parallel=False):
         """Multiplex streams and write to files.
 
-        Each file extension will be used as a key to the OUTPUT_FORMATS
-        dictionary.
+        Each file extension will be used as a key to the FORMATS
+        registry, in its current tier. See vid.formats.
 
         Files may also be a tuple of (filename, formatlist) where
         filename is a string and formatlist is a list of arguments passed to
         ffmpeg describing the output format for that specific file.
+
+        A third item, (filename, formatlist, height), scales the video
+        of that file to height pixels, keeping the aspect ratio. The
+        filters run once whatever the number of files: their output is
+        split between the encoders of every file.
+
+        If parallel is true, each file is encoded by a process of its
+        own, fed with the raw output of mux() by a FanOut thread. Use
+        wait() to wait for all of them.
         """
+        make_output_dirs(files)
+        if parallel and len(files) > 1:
+            self._fan_out(files)
+            return
         self.logger.debug("Muxing video {} and audio {} to files {}.".format(
             self.v_fd, self.a_fd, files
             ))
-        assert files
-        outputs = []
-        for file in files:
-            if isinstance(file, tuple):
-                outputs += self._format_vf() + self._format_af()
-                outputs += file[1]
-                outputs.append(file[0])
-            else:
-                assert isinstance(file, str)
-                ext = file.rsplit('.', 1)[-1]
-                outputs += self._format_vf() + self._format_af()
-                outputs += OUTPUT_FORMATS[ext]
-                outputs.append(file)
-        args = self._args + outputs
+        threads = THREADS.acquire("encoder")
+        args = self._args + self._output_args(*files, threads=threads.threads)
+        args = SCHEDULING.wrap_args("encoder", args)
         self.process = subprocess.Popen(
             args,
             stdin=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
             pass_fds=(self.v_fd, self.a_fd),
-            preexec_fn=_redirect_stderr_to_log_file,
+            preexec_fn=SCHEDULING.preexec_fn("encoder"),
             )
         self.logger.debug(
             SUBPROCESS_LOG.format(
                 self.process.pid, args
                 )
             )
+        SubprocessSupervisor(
+            (self.process.wait,),
+            threads.release,
+            name="Releasing {}.".format(threads),
+            ).start()
         os.close(self.v_fd)
         os.close(self.a_fd)
         self.logger.debug(
@@ -1094,6 +2208,118 @@ class Multiplexer(FFmpegWrapper):                #{{{1
             )
         return
 
+    def wait(self):
+        """Wait for every process writing the files.
+
+        Returns the first non-zero return code, or 0.
+        """
+        returncodes = [
+            process.wait() for process in [self.process] + self.encoders
+            ]
+        return next((rv for rv in returncodes if rv), 0)
+
+    def _fan_out(self, files):
+        """Spawn one encoder per file and feed them the output of mux()."""
+        stream = self.mux()
+        self.encoders = []
+        for file in files:
+            format = get_output_format(file)
+            args = ["ffmpeg", "-loglevel", "debug", "-y", "-i", "pipe:0"]
+            height = get_output_height(file)
+            if height is not None:
+                args += ["-filter:v", "scale=-2:{}".format(height)]
+            threads = THREADS.acquire("encoder")
+            args += format + [
+                "-threads", str(threads.threads), get_output_name(file),
+                ]
+            args = SCHEDULING.wrap_args("encoder", args)
+            process = subprocess.Popen(
+                args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                preexec_fn=SCHEDULING.preexec_fn("encoder"),
+                )
+            self.logger.debug(SUBPROCESS_LOG.format(process.pid, args))
+            SubprocessSupervisor(
+                (process.wait,),
+                threads.release,
+                name="Releasing {}.".format(threads),
+                ).start()
+            self.encoders.append(process)
+        FanOut(stream, [process.stdin for process in self.encoders]).start()
+
+    def _output_args(self, *files, threads=None):
+        """Return the output part of the ffmpeg arguments for files.
+
+        See write_to_files() for the accepted arguments. If threads is
+        given, the filter threads and the encoder threads of every
+        output are limited so that the sum is about threads.
+        """
+        assert files
+        heights = [get_output_height(file) for file in files]
+        if len(files) > 1 or heights[0] is not None:
+            return self._split_output_args(files, heights, threads)
+        outputs = []
+        if threads:
+            per_output = max(1, threads // len(files))
+            outputs += ["-filter_threads", str(threads)]
+        for file in files:
+            outputs += self._format_vf() + self._format_af()
+            outputs += get_output_format(file)
+            if threads:
+                outputs += ["-threads", str(per_output)]
+            outputs.append(get_output_name(file))
+        return outputs
+
+    def _split_output_args(self, files, heights, threads=None):
+        """Return the output arguments of several or scaled files.
+
+        The filters are evaluated once in a filter_complex, then split
+        into one stream per file.
+        """
+        graph = []
+        v_label, a_label = "[0:v]", "[1:a]"
+        if self.vf:
+            self.logger.debug(
+                "Processing video filters. {}.".format(self.vf)
+                )
+            graph.append("{}{}[vmux]".format(
+                v_label, self._escape_filterchain(self.vf)
+                ))
+            v_label = "[vmux]"
+        if self.af:
+            self.logger.debug(
+                "Processing audio filters. {}.".format(self.af)
+                )
+            graph.append("{}{}[amux]".format(
+                a_label, self._escape_filterchain(self.af)
+                ))
+            a_label = "[amux]"
+        split, labels = self._split_streams(v_label, a_label, heights)
+        graph = ";".join(graph + split)
+        self.logger.debug("Filtergraph:\n{}".format(graph))
+        outputs = ["-filter_complex", graph]
+        if threads:
+            per_output = max(1, threads // len(files))
+            outputs = ["-filter_complex_threads", str(threads)] + outputs
+        for file, streams in zip(files, labels):
+            for label in streams:
+                # An unfiltered input stream, such as [1:a], is mapped by
+                # its specifier rather than by a label.
+                if ":" in label:
+                    label = label.strip("[]")
+                outputs += ["-map", label]
+            outputs += get_output_format(file)
+            if threads:
+                outputs += ["-threads", str(per_output)]
+            outputs.append(get_output_name(file))
+        return outputs
+
+    def _thread_args(self, threads):
+        """Return the ffmpeg arguments limiting filter and encoder threads."""
+        return ["-filter_threads", str(threads), "-threads", str(threads)]
+
     @staticmethod
     def _get_fileno(file):
         # Find out what is file.
@@ -1137,8 +2363,67 @@ class Multiplexer(FFmpegWrapper):                #{{{1
             super().append_vf(filtername, **kwargs)
         return self
 
+    def append_af(self, filtername, **kwargs):
+        """Append an audio filter to the audio stream filtergraph.
+
+        Provides preset filter "normalize", the second pass of the
+        loudnorm filter for the whole movie. The loudness of the movie
+        is estimated from the cached loudness of its shots and music,
+        see get_loudness(), so no first pass is run on the movie. Audio
+        filters appended before it are not taken into account.
+        """
+        if filtername == "normalize":
+            target = dict(LOUDNESS_TARGET, **kwargs)
+            for filter in _normalize_filters(
+                    target, self.get_loudness(**target)
+                    ):
+                super().append_af(filter[0], **filter[1])
+        else:
+            super().append_af(filtername, **kwargs)
+        return self
+
+    def get_loudness(self, **target):
+        """Estimate the loudness of the audio stream.
+
+        See combine_loudness(). The music is mixed with amix, which
+        halves both of its inputs.
+        """
+        if not self.shots:
+            raise ValueError(
+                "The normalize preset filter needs the shots of the movie."
+                )
+        parts = [
+            (shot.get_duration(), shot.get_loudness(**target))
+            for shot in self.shots
+            ]
+        measured = combine_loudness(parts)
+        if self.music is None:
+            return measured
+        length = sum(duration for duration, loudness in parts)
+        music = min(length, Probe.get(self.music).get_duration())
+        measured = combine_loudness([
+            (length, measured),
+            (music, get_loudness(self.music, **target)),
+            ])
+        if measured is None:
+            return None
+        # Both parts play at the same time, at half their amplitude.
+        measured['input_i'] = "{:.2f}".format(
+            float(measured['input_i']) +
+            10 * math.log10((length + music) / length) - 20 * math.log10(2)
+            )
+        measured['input_thresh'] = "{:.2f}".format(
+            float(measured['input_i']) - 10
+            )
+        return measured
+
 class AudioProcessing():                         #{{{1
-    """Apply audio filters to a stream."""
+    """Apply audio filters to a stream.
+
+    mix() accepts a music file name, which ffmpeg decodes, or an
+    iterable of RAW_AUDIO buffers such as DecodedMusic.slices(), which
+    is decoded already.
+    """
 
     def __init__(self, audio_stream):
         self.logger = logging.getLogger(__name__+".AudioProcessing")
@@ -1149,29 +2434,40 @@ class AudioProcessing():                         #{{{1
         self.process = None
 
     def mix(self, music):
-        assert isinstance(music, str)
+        if isinstance(music, str):
+            music_args = ["-i", music]
+            pass_fds = ()
+        else:
+            music_r, music_w = os.pipe()
+            music_args = RAW_AUDIO + ["-i", "pipe:{}".format(music_r)]
+            pass_fds = (music_r,)
 
         args = [
             "ffmpeg", "-y", "-loglevel", "debug",
             ] + RAW_AUDIO + [
             "-i", "pipe:0",
-            "-i", music,
+            ] + music_args + [
             "-filter_complex", "amix=duration=first",
             ] + RAW_AUDIO + [
             "pipe:1",
             ]
+        args = SCHEDULING.wrap_args("mixer", args)
         self.process = subprocess.Popen(
             args,
             stdin=self.input_audio,
             stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL,
-            preexec_fn=_redirect_stderr_to_log_file,
+            pass_fds=pass_fds,
+            preexec_fn=SCHEDULING.preexec_fn("mixer"),
             )
         self.logger.debug(
             SUBPROCESS_LOG.format(
                 self.process.pid, args
                 )
             )
+        if pass_fds:
+            os.close(music_r)
+            WriteBuffers(music, open(music_w, "wb")).start()
         p = PipeHelper(self.process.stdout)
         p.start()
         self.output_audio = p.output
@@ -1191,6 +2487,24 @@ class Probe():                                   #{{{1
     def __init__(self, filename):
         self.filename = filename
         self.data = None
+        self.keyframes = None
+
+    @classmethod
+    def get(cls, filename):
+        """Return a Probe for filename, shared with previous callers.
+
+        A file is probed again only if it was modified since.
+        """
+        try:
+            st = os.stat(filename)
+            key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+        except OSError:
+            return cls(filename)
+        with _PROBES_LOCK:
+            probe = _PROBES.get(key)
+            if probe is None:
+                probe = _PROBES[key] = cls(filename)
+        return probe
 
     def get_duration(self):
         self._probe()
@@ -1200,6 +2514,54 @@ class Probe():                                   #{{{1
         self._probe()
         return self.data['format']['format_name']
 
+    def get_codec(self, codec_type="video"):
+        """Return the codec name of the first stream of codec_type."""
+        return self.get_stream(codec_type).get('codec_name')
+
+    def get_stream(self, codec_type="video"):
+        """Return the ffprobe data of the first stream of codec_type.
+
+        Returns an empty dict if there is no such stream.
+        """
+        self._probe()
+        for stream in self.data.get('streams', []):
+            if stream.get('codec_type') == codec_type:
+                return stream
+        return {}
+
+    def get_keyframes(self):
+        """Return the times of the keyframes of the first video stream.
+
+        Times are in seconds from the start of the file, as expected by
+        the -ss option. Only packets are read, no frame is decoded.
+        """
+        if self.keyframes is not None:
+            return self.keyframes
+        self._probe()
+        start = float(self.data['format'].get('start_time', 0))
+        process = subprocess.Popen(
+            [
+                "ffprobe", "-of", "json",
+                "-select_streams", "v:0",
+                "-show_entries", "packet=pts_time,flags",
+                self.filename
+            ],
+            stderr=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            universal_newlines=True,
+            )
+        data = json.load(process.stdout)
+        process.stdout.close()
+        process.wait()
+        self.keyframes = sorted(
+            float(packet['pts_time']) - start
+            for packet in data.get('packets', [])
+            if "K" in packet.get('flags', "") and
+                packet.get('pts_time', "N/A") != "N/A"
+            )
+        return self.keyframes
+
     def _probe(self):
         """Actually call ffprobe and parse json output.
 
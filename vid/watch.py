@@ -0,0 +1,212 @@
+# vim:cc=80:fdm=marker:fdl=0:fdc=1
+#
+# watch.py
+# Copyright © 2013  Alexandre de Verteuil        {{{1
+#
+# This file is part of Vid.
+#
+# Vid is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Vid is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#}}}
+
+
+
+
+# Imports                                        {{{1
+import os
+import json
+import time
+import logging
+
+from .utils import Player
+from .yaml import YAMLReader
+from .engines import FilterGraphRender
+from .sequence import Sequence, make_shot
+
+
+# Global variables                               {{{1
+WATCH_INTERVAL = 0.5  # Seconds
+#}}}
+
+
+class Watcher():                                 #{{{1
+    """Preview a YAML project again every time it is saved.
+
+    The preview starts from the first shot that changed, so that the
+    edit is seen right away. The rest of the movie plays after it, the
+    music and the multiplexer filters being at the same time as in the
+    whole movie.
+
+    Shots whose description did not change are reused, and files are
+    probed and searched for only once. The YAML files of the sequences
+    of the project are watched too. If the project is not valid, the
+    error is reported and the previous preview keeps playing.
+
+    Arguments:
+    filename -- The YAML file to watch.
+    pattern -- Overrides the pattern of the globals section.
+    showinfo -- Burn file names and timecode information on the video.
+    callback -- Called with the number of the first changed shot and its
+                time in the movie when a preview starts.
+    """
+
+    def __init__(self, filename, pattern=None, showinfo=False,
+                 callback=None, interval=WATCH_INTERVAL):
+        self.logger = logging.getLogger(__name__+".Watcher")
+        self.filename = filename
+        self.pattern = pattern
+        self.showinfo = showinfo
+        self.callback = callback
+        self.interval = interval
+        # The project and its sequences, and their modification times.
+        self.files = {filename}
+        self.mtimes = {}
+        self.data = None
+        self.specs = []
+        self.shots = {}
+        self.render = None
+        self.player = None
+
+    def load(self, changed=()):
+        """Read the project.
+
+        Shots are reused from the previous load, except sequences when
+        changed, a set of file names, is not empty.
+
+        Returns the data, the list of shot specs and the list of Shot
+        objects. A spec is the description of a shot and the name of the
+        file it is cut from. The file of a sequence is named after its
+        content, so its spec changes with the files of the sequence.
+        """
+        reader = YAMLReader()
+        data = reader.load(self.filename)
+        specs = []
+        shots = {}
+        ordered = []
+        for args, kwargs in reader.get_shots_arguments(self.pattern):
+            description = json.dumps([args, kwargs], sort_keys=True)
+            shot = self.shots.get(description)
+            if shot is None or changed and isinstance(shot, Sequence):
+                shot = make_shot(args, kwargs)
+                if self.showinfo:
+                    shot.append_vf("showdata")
+            specs.append(json.dumps([description, shot.name]))
+            shots[description] = shot
+            ordered.append(shot)
+        self.shots = shots
+        return data, specs, ordered
+
+    def get_mtimes(self):
+        """Return the modification times of the watched files.
+
+        Missing files have None.
+        """
+        mtimes = {}
+        for filename in self.files:
+            try:
+                mtimes[filename] = os.stat(filename).st_mtime_ns
+            except FileNotFoundError:
+                mtimes[filename] = None
+        return mtimes
+
+    def find_first_change(self, data, specs):
+        """Return the index of the first changed shot, or None.
+
+        If the music or the multiplexer changed, that is the first shot.
+        """
+        if self.data is None:
+            return 0
+        for key in ("music", "multiplexer"):
+            if data.get(key) != self.data.get(key):
+                return 0
+        for i, (old, new) in enumerate(zip(self.specs, specs)):
+            if old != new:
+                return i
+        if len(specs) > len(self.specs):
+            return len(self.specs)
+        if len(specs) < len(self.specs):
+            # Shots were removed from the end; show the new ending.
+            return len(specs) - 1
+        return None
+
+    def check(self):
+        """Preview the project if it was saved since the last check.
+
+        Returns True if a preview started.
+        """
+        mtimes = self.get_mtimes()
+        if mtimes[self.filename] is None:
+            # Editors may save by renaming a new file over the old one.
+            # The file will be back at the next check.
+            return False
+        if mtimes == self.mtimes:
+            return False
+        changed = {f for f, t in mtimes.items() if t != self.mtimes.get(f)}
+        self.mtimes = mtimes
+        try:
+            data, specs, shots = self.load(changed - {self.filename})
+        except Exception as err:
+            self.logger.error("Can't read {}: {}".format(self.filename, err))
+            return False
+        self.files = {self.filename}.union(
+            *(shot.files for shot in shots if isinstance(shot, Sequence))
+            )
+        for filename, mtime in self.get_mtimes().items():
+            self.mtimes.setdefault(filename, mtime)
+        first = self.find_first_change(data, specs)
+        self.data, self.specs = data, specs
+        if first is None:
+            return False
+        self.preview(data, shots, first)
+        return True
+
+    def preview(self, data, shots, first):
+        """Play the movie from shots[first]."""
+        self.stop()
+        start = sum(shot.get_duration() for shot in shots[:first])
+        length = sum(shot.get_duration() for shot in shots)
+        self.render = FilterGraphRender(shots[first:], data.get('music'))
+        self.render.offset = start
+        for filter in data.get('multiplexer', {}).get('vf', []):
+            self.render.append_vf(filter[0], **filter[1])
+        for filter in data.get('multiplexer', {}).get('af', []):
+            self.render.append_af(filter[0], **filter[1])
+        if self.showinfo:
+            self.render.append_vf("showdata", length=length)
+        self.player = Player(self.render.mux())
+        self.logger.debug("Previewing from shot {} at {}.".format(
+            first + 1, start
+            ))
+        if self.callback is not None:
+            self.callback(first, start)
+
+    def stop(self):
+        """Kill the preview being played, if any."""
+        for process in (
+            getattr(self.player, "process", None),
+            getattr(self.render, "process", None),
+            ):
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+        self.player = None
+        self.render = None
+
+    def run(self):
+        """Check the project every interval seconds until interrupted."""
+        try:
+            while True:
+                self.check()
+                time.sleep(self.interval)
+        finally:
+            self.stop()
@@ -21,13 +21,31 @@
 
 
 # Imports                                        {{{1
+import os
+import pickle
 import os.path
+import hashlib
 import logging
+import tempfile
 
 import yaml
+try:
+    # LibYAML is many times faster than the pure Python loader.
+    from yaml import CSafeLoader as YAML_LOADER
+except ImportError:
+    from yaml import SafeLoader as YAML_LOADER
+
+from .formats import FormatRegistry
+from .utils import get_cache_dir
 
 
 # Global variables                               {{{1
+# Checked projects are cached in this directory, so that a project is
+# parsed and checked again only when its file changes. It may be moved
+# with the VID_PROJECT_CACHE environment variable.
+PROJECT_CACHE_DIR = get_cache_dir("projects", 'VID_PROJECT_CACHE')
+# Bump this when the checks canonicalize data differently.
+PROJECT_CACHE_VERSION = 2
 # This YAML template is used both as user documentation
 # and as a starting point for making a new movie with Vid.
 # The CLI will write this to stdout if requested.
@@ -85,6 +103,21 @@ movie:
   #           y: 10
   #           text: My title
   # - - [42, 4, 2, {{filters: [[drawtext, {{x: 10, y: 10, text: My title}}]]}}]
+variants:  # Optional
+  # Other cuts of the movie, as lists of shots like the movie section.
+  # "vid yaml -o cut-{{variant}}.webm" renders the movie and every
+  # variant, rendering the shots they have in common only once.
+  # short:
+  #   - [42, 4, 2]
+  ~
+formats:  # Optional
+  # Output formats to add or override, by file extension. A format is
+  # a list of ffmpeg arguments, or a mapping of the draft, normal and
+  # final tiers to such lists. "vid yaml -t draft" picks the tier.
+  # mp4:
+  #   normal: [-f, mp4, -vcodec, libx264, -preset, fast, -acodec, aac]
+  #   final: [-f, mp4, -vcodec, libx264, -preset, slow, -acodec, aac]
+  ~
 multiplexer:
   filters:
     # A mapping of video filters to give as the filter keyword argument
@@ -103,10 +136,21 @@ multiplexer:
 
 class YAMLReader():                              #{{{1
 
-    """Reads YAML, checks the sanity of the data structure."""
+    """Reads YAML, checks the sanity of the data structure.
+
+    Projects loaded from a file are cached in cache_dir once checked.
+    Pass None to disable the cache.
 
-    def __init__(self):
+    Sequence file names are relative to the directory of the project,
+    or to the working directory if the project is not a file.
+    """
+
+    def __init__(self, cache_dir=PROJECT_CACHE_DIR):
+        self.logger = logging.getLogger(__name__+".YAMLReader")
         self.data = None
+        self.cache_dir = cache_dir
+        # The directory of the file being loaded, if any.
+        self.directory = None
 
     def _load(self, source):
         """Load YAML. No data validation is made at this point.
@@ -118,24 +162,150 @@ class YAMLReader():                              #{{{1
         if isinstance(source, str) and os.path.isfile(source):
             # if source is a filename, read the corresponding file.
             with open(source) as file:
-                data = yaml.load(file)
+                data = yaml.load(file, Loader=YAML_LOADER)
         else:
             # source may be str, bytes, or an open file in txt or bytes mode.
-            data = yaml.load(source)
+            data = yaml.load(source, Loader=YAML_LOADER)
         return data
 
     def load(self, source):
-        data = self._load(source)
-        # Do checks.
+        """Load and check YAML, return the canonicalized data.
+
+        If source is a file name and the file did not change since it
+        was last loaded, the data is read from the cache instead.
+        """
+        if isinstance(source, str) and os.path.isfile(source):
+            self.directory = os.path.dirname(os.path.abspath(source))
+        else:
+            self.directory = None
+        if (self.cache_dir is not None and
+            isinstance(source, str) and
+            os.path.isfile(source)
+            ):
+            data = self._load_cached(source)
+        else:
+            data = self._check(self._load(source))
+
+        # All checks passed, set self.data.
+        self.data = data
+        return self.data
+
+    def _check(self, data):
         keys = self._check_root(data)
         sane_data = {}
         for key in keys:
             # Dynamically call check methods.
             sane_data[key] = getattr(self, "_check_"+key)(data[key])
+        return sane_data
 
-        # All checks passed, set self.data.
-        self.data = sane_data
-        return self.data
+    def _get_cache_path(self, filename):
+        name = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + ".pickle")
+
+    def _load_cached(self, filename):
+        """Return the checked data of filename, from the cache if possible.
+
+        The cache entry is used as is if the file has the same size and
+        modification time. Otherwise, it is used if the file has the same
+        hash, for instance after a checkout or a touch. Either way, the
+        files named by the project are checked again, see _check_files().
+        """
+        st = os.stat(filename)
+        path = self._get_cache_path(filename)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            if entry['version'] != PROJECT_CACHE_VERSION:
+                entry = None
+        except Exception:
+            # Missing, truncated or from an older version of Vid.
+            entry = None
+        if (entry is not None and
+            entry['mtime_ns'] == st.st_mtime_ns and
+            entry['size'] == st.st_size
+            ):
+            self.logger.debug("Loaded {} from {}.".format(filename, path))
+            return self._check_files(entry['data'])
+        with open(filename, "rb") as f:
+            source = f.read()
+        digest = hashlib.sha1(source).hexdigest()
+        if entry is not None and entry['sha1'] == digest:
+            data = self._check_files(entry['data'])
+        else:
+            data = self._check(self._load(source))
+        entry = {
+            'version': PROJECT_CACHE_VERSION,
+            'mtime_ns': st.st_mtime_ns,
+            'size': st.st_size,
+            'sha1': digest,
+            'data': data,
+            }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+            with open(fd, "wb") as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as err:
+            # The cache is an optimization only.
+            self.logger.warning("Could not cache {}: {}".format(filename, err))
+        return data
+
+    def _check_files(self, data):
+        """Check that the music and sequence files of data exist.
+
+        These are the only checks that depend on other files than the
+        project and on the working directory, so cached data must pass
+        them again. Returns data.
+        """
+        self._check_music(data.get('music'))
+        movies = [data['movie']] + list(data.get('variants', {}).values())
+        for movie in movies:
+            for shot in movie:
+                sequence = shot[-1].get('sequence')
+                if sequence is not None and not os.path.isfile(sequence):
+                    raise FileNotFoundError(
+                        "Sequence file {} not found.".format(sequence)
+                        )
+        return data
+
+    def get_shots_arguments(self, pattern=None, variant=None):
+        """Return the arguments to the Shot constructor for every shot.
+
+        Must be called after load(). Keyword arguments from the globals
+        section are merged with the shot's own keyword arguments. The
+        pattern argument, if given, overrides the pattern of the globals
+        section but not the pattern of a shot.
+
+        Returns:
+        A list of (args, kwargs) tuples, args being a list and kwargs a
+        dict. For a sub-sequence, args is empty and kwargs has a
+        "sequence" key. See make_shot().
+
+        If variant is given, the shots of that variant are returned
+        instead of those of the movie.
+        """
+        shots = []
+        if variant is None:
+            movie = self.data['movie']
+        else:
+            movie = self.data['variants'][variant]
+        for argslist in movie:
+            if 'sequence' in argslist[-1]:
+                # A sequence has globals of its own.
+                kwargs = dict(argslist[-1])
+                if pattern:
+                    kwargs['pattern'] = pattern
+                shots.append(([], kwargs))
+                continue
+            kwargs = {}
+            if 'globals' in self.data:
+                kwargs.update(self.data['globals'])
+            if pattern:
+                kwargs['pattern'] = pattern
+            kwargs.update(argslist[-1])
+            shots.append((list(argslist[:-1]), kwargs))
+        return shots
 
     def _check_root(self, data):
         if not isinstance(data, dict):
@@ -145,10 +315,12 @@ class YAMLReader():                              #{{{1
             'movie',
             }
         optional_keys = {
+            'formats',
             'multiplexer',
             'music',
             'meta',
             'globals',
+            'variants',
             }
         allowed_keys = required_keys | optional_keys
         if not keys <= allowed_keys:
@@ -168,22 +340,45 @@ class YAMLReader():                              #{{{1
                 keys.remove(k)
         return keys
 
-    def _check_movie(self, data):
+    def _check_movie(self, data, variant=None):
         """Check and canonicalize movie data.
 
+        If variant is given, data is the list of shots of that variant
+        and error messages name it.
         """
+        if variant is None:
+            key, name, where = "movie", "Movie", ['movie']
+        else:
+            key, name = variant, "Variant {}".format(variant)
+            where = ['variants', variant]
         if not isinstance(data, list):
-            raise TypeError("The \"movie\" key must contain a list!")
+            raise TypeError("The \"{}\" key must contain a list!".format(key))
         if len(data) == 0:
-            raise ValueError("Movie has no shots in it!")
+            raise ValueError("{} has no shots in it!".format(name))
         shots = []
         index = 0
         for shot in data:
             index += 1
-            where = ['movie', "shot #{}".format(index)]
-            shots.append(self._check_shot(shot, where))
+            shots.append(
+                self._check_shot(shot, where + ["shot #{}".format(index)])
+                )
         return shots
 
+    def _check_variants(self, data):
+        """Check and canonicalize variants data.
+
+        Variants are a mapping of names to lists of shots, such as a
+        short cut of the movie. Each list is checked like the movie.
+        """
+        if not isinstance(data, dict):
+            raise TypeError("The \"variants\" key must contain a mapping!")
+        if "movie" in data:
+            raise KeyError("\"movie\" is the name of the main variant.")
+        return {
+            str(name): self._check_movie(movie, str(name))
+            for name, movie in data.items()
+            }
+
     def _check_shot(self, data, where):
         """Check and canonicalize shot data.
 
@@ -195,16 +390,24 @@ class YAMLReader():                              #{{{1
         - [42, 4]
         - [42, 4, 2]
         - [42, 4, 2, {filters: […]}]
+        - {sequence: intro.yaml}
+        - {sequence: intro.yaml, seek: 2, af: […]}
 
         Returns:
-        A list of 1 to 3 ints plus a possibly empty dict.
+        A list of 1 to 3 ints plus a possibly empty dict, or a list of a
+        single dict for a sub-sequence.
         """
         error_msg = (
             "Invalid shot specification: {}\n"
             "Element {}.\n".format(data, self._format_where(where))
             )
+        if isinstance(data, dict):
+            return self._check_sequence(data, where, error_msg)
         if not isinstance(data, (int, list)):
-            reason = "Shot specification must be a list or an integer."
+            reason = (
+                "Shot specification must be a list, an integer or a "
+                "sequence mapping."
+                )
             raise TypeError(error_msg+reason)
         if isinstance(data, int):
             data = [data]
@@ -241,6 +444,52 @@ class YAMLReader():                              #{{{1
         data.append(kwargs)
         return data
 
+    def _check_sequence(self, data, where, error_msg):
+        """Check and canonicalize a sub-sequence.
+
+        The "sequence" key names another YAML file, relative to the
+        directory of the project. The keyword arguments of a shot are
+        accepted, except for the pattern.
+
+        Returns:
+        A list of a single dict, with the sequence file name joined to
+        the directory of the project.
+        """
+        valid_keys = {
+            'sequence', 'seek', 'dur', 'silent', 'filters', 'vf', 'af',
+            }
+        if 'sequence' not in data:
+            reason = "A mapping must have a \"sequence\" key."
+            raise KeyError(error_msg+reason)
+        if not set(data) <= valid_keys:
+            reason = "Valid keys in a sequence are: {}.".format(valid_keys)
+            raise KeyError(error_msg+reason)
+        if 'filters' in data:
+            if 'vf' in data:
+                reason = "Must use only one of \"filters\" or \"vf\"."
+                raise KeyError(error_msg+reason)
+            data['vf'] = data.pop('filters')
+        for key in ('seek', 'dur'):
+            value = data.get(key, 0)
+            if key == 'dur' and value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                reason = "\"{}\" must be a number.".format(key)
+                raise TypeError(error_msg+reason)
+            if value < 0:
+                reason = "\"{}\" must not be negative.".format(key)
+                raise ValueError(error_msg+reason)
+        if self.directory is not None:
+            data['sequence'] = os.path.join(self.directory, data['sequence'])
+        if not os.path.isfile(data['sequence']):
+            raise FileNotFoundError(
+                "Sequence file {} not found.".format(data['sequence'])
+                )
+        for key in ('vf', 'af'):
+            if key in data:
+                data[key] = [self._check_filter(f, where) for f in data[key]]
+        return [data]
+
     def _check_multiplexer(self, data):
         """Check and canonicalize multiplexer data.
 
@@ -288,6 +537,14 @@ class YAMLReader():                              #{{{1
             data['af'] = sane_filters
         return data
 
+    def _check_formats(self, data):
+        """Check and canonicalize output formats.
+
+        Formats are added to or override those of vid.formats.FORMATS.
+        See FormatRegistry.check().
+        """
+        return FormatRegistry.check(data)
+
     def _check_music(self, data):
         """Check and canonicalize music data.
 